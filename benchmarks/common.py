@@ -0,0 +1,92 @@
+import os
+import json
+import time
+from contextlib import asynccontextmanager
+
+import asyncpg
+from dotenv import load_dotenv
+
+from database import Database
+
+load_dotenv()
+
+
+@asynccontextmanager
+async def scratch_schema(keep: bool = False):
+    """Connect to DATABASE_URL and work inside a throwaway schema.
+
+    Nothing outside the schema is touched, so the benchmarks can run against
+    a development database. The schema is dropped afterwards unless `keep`.
+    """
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    schema = f"bench_{os.getpid()}"
+    try:
+        await conn.execute(f'CREATE SCHEMA {schema}')
+        await conn.execute(f'SET search_path TO {schema}')
+        yield conn
+    finally:
+        if not keep:
+            await conn.execute(f'DROP SCHEMA IF EXISTS {schema} CASCADE')
+        else:
+            print(f"Kept schema {schema}")
+        await conn.close()
+
+
+async def bench_database(conn: asyncpg.Connection) -> Database:
+    """A Database whose pool works inside the same scratch schema as `conn`"""
+    schema = await conn.fetchval('SELECT current_schema()')
+    db = Database()
+    db.pool = await asyncpg.create_pool(
+        os.getenv("DATABASE_URL"),
+        min_size=1,
+        max_size=2,
+        server_settings={'search_path': schema}
+    )
+    return db
+
+
+async def seed_users_and_images(conn: asyncpg.Connection, users: int, images: int):
+    started = time.perf_counter()
+    await conn.execute('''
+        INSERT INTO users (telegram_id, username, is_admin, is_blocked, created_at)
+        SELECT g, 'user' || g, g % 10000 = 0, g % 100 = 0, NOW() - g * INTERVAL '1 minute'
+        FROM generate_series(1, $1) g
+    ''', users)
+    # A few heavy users and a long tail, spread over the last year
+    await conn.execute('''
+        INSERT INTO images (file_id, user_id, prompt, created_at)
+        SELECT 'file' || g,
+               1 + floor(power(random(), 3) * $2)::int,
+               (ARRAY['a beautiful sunset over mountains', 'a cute cat playing with yarn',
+                      'an astronaut riding a horse on mars', 'a castle in the clouds',
+                      'portrait of an old fisherman'])[1 + g % 5] || ' ' || md5(g::text),
+               NOW() - random() * INTERVAL '365 days'
+        FROM generate_series(1, $1) g
+    ''', images, users)
+    await conn.execute('ANALYZE users')
+    await conn.execute('ANALYZE images')
+    print(f"Seeded {users} users and {images} images in {time.perf_counter() - started:.1f}s")
+
+
+async def explain(conn: asyncpg.Connection, query: str, *args) -> dict:
+    """Run EXPLAIN ANALYZE and return the plan as a dict"""
+    raw = await conn.fetchval(f'EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) {query}', *args)
+    return (json.loads(raw) if isinstance(raw, str) else raw)[0]
+
+
+def plan_nodes(plan: dict) -> list:
+    """Flatten a plan tree into 'Node Type on relation using index' strings"""
+    node = plan['Plan'] if 'Plan' in plan else plan
+    text = node['Node Type']
+    if 'Relation Name' in node:
+        text += f" on {node['Relation Name']}"
+    if 'Index Name' in node:
+        text += f" using {node['Index Name']}"
+    nodes = [text]
+    for child in node.get('Plans', []):
+        nodes.extend(plan_nodes(child))
+    return nodes
+
+
+def print_plan(name: str, plan: dict):
+    print(f"  {name:<24} {plan['Execution Time']:>10.2f} ms   {' > '.join(plan_nodes(plan))}")
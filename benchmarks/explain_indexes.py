@@ -0,0 +1,54 @@
+"""Query plans of the hot users/images queries before and after migration 4.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.explain_indexes --users 100000 --images 1000000
+"""
+import asyncio
+import argparse
+
+from migrations import migrate
+from benchmarks.common import scratch_schema, seed_users_and_images, explain, print_plan
+
+INDEX_MIGRATION = 4
+
+QUERIES = [
+    ('get_user_images_page', '''
+        SELECT * FROM images WHERE user_id = $1 AND (created_at, id) < (NOW() - INTERVAL '30 days', 0)
+        ORDER BY created_at DESC, id DESC LIMIT 11
+    ''', (2,)),
+    ('get_user_by_username', 'SELECT * FROM users WHERE username = $1', ('user4242',)),
+    ('get_all_admins', 'SELECT * FROM users WHERE is_admin = TRUE ORDER BY id ASC', ()),
+    ('get_users_paginated', 'SELECT * FROM users ORDER BY created_at DESC LIMIT 25 OFFSET 0', ()),
+    ('active_users', 'SELECT COUNT(DISTINCT user_id) FROM images', ()),
+    ('images_today', '''
+        SELECT COUNT(*) FROM images WHERE created_at >= CURRENT_DATE AND created_at < CURRENT_DATE + 1
+    ''', ()),
+    ('blocked_users', 'SELECT COUNT(*) FROM users WHERE is_blocked = TRUE', ()),
+]
+
+
+async def run_queries(conn, title: str):
+    print(title)
+    for name, query, args in QUERIES:
+        print_plan(name, await explain(conn, query, *args))
+
+
+async def main(args):
+    async with scratch_schema(keep=args.keep) as conn:
+        await migrate(conn, target=INDEX_MIGRATION - 1)
+        await seed_users_and_images(conn, args.users, args.images)
+
+        await run_queries(conn, "Before indexes:")
+
+        await migrate(conn, target=INDEX_MIGRATION)
+        await conn.execute('ANALYZE users')
+        await conn.execute('ANALYZE images')
+
+        await run_queries(conn, "After indexes:")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--images', type=int, default=1000000)
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark schema")
+    asyncio.run(main(parser.parse_args()))
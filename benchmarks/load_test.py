@@ -0,0 +1,354 @@
+"""End-to-end load test: synthetic users driving the real handlers against local stubs.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.load_test --users 1000 --output baseline.json
+    DATABASE_URL=postgresql://... python -m benchmarks.load_test --users 1000 --baseline baseline.json
+
+Every user sends /start, /generate, a prompt, /myimages and /stats. The updates
+go through `dp.process_update`, so middlewares, rate limits, the database and
+the job queue all take part; Telegram and Leonardo are the stubs in stubs/.
+Telegram pacing and the global rate limit are lifted unless they are set in
+the environment, so the numbers show the bot itself.
+"""
+import os
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import traceback
+from urllib.parse import urlsplit, urlunsplit
+
+from benchmarks.common import scratch_schema
+from stubs.telegram import TelegramStub
+from stubs.leonardo import LeonardoStub, API_PREFIX
+
+PROMPTS = [
+    'a beautiful sunset over mountains', 'a cute cat playing with yarn',
+    'an astronaut riding a horse on mars', 'a castle in the clouds', 'portrait of an old fisherman',
+]
+
+# Synthetic users get ids from here on, away from ADMIN_ID and real accounts
+FIRST_USER_ID = 10_000_000
+
+# Jobs in these statuses are still on their way to the user
+UNFINISHED = ('queued', 'submitted', 'polling', 'downloading')
+
+# Compared with the baseline; for all of them lower is better except throughput
+SUMMARY = [
+    ('throughput', 'updates/s'),
+    ('latency.all.p50', 'ms'),
+    ('latency.all.p99', 'ms'),
+    ('loop_lag.p99', 'ms'),
+    ('loop_lag.max', 'ms'),
+    ('db_calls_per_update', 'calls'),
+    ('delivery.p50', 's'),
+    ('delivery.p99', 's'),
+]
+
+
+def percentile(values: list, share: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(share * len(ordered)))]
+
+
+def distribution(values: list, scale: float = 1000) -> dict:
+    """count, p50, p99 and max, in milliseconds by default"""
+    return {
+        'count': len(values),
+        'p50': round(percentile(values, 0.50) * scale, 3),
+        'p99': round(percentile(values, 0.99) * scale, 3),
+        'max': round(max(values, default=0.0) * scale, 3),
+    }
+
+
+def with_search_path(url: str, schema: str) -> str:
+    """asyncpg passes unknown DSN parameters on as server settings"""
+    parts = urlsplit(url)
+    query = f"{parts.query}&search_path={schema}" if parts.query else f"search_path={schema}"
+    return urlunsplit(parts._replace(query=query))
+
+
+def configure(args, telegram: TelegramStub, leonardo: LeonardoStub, database_url: str):
+    """Point the bot at the stubs. Must run before bot is imported, it reads the environment then"""
+    os.environ['TELEGRAM_API_URL'] = telegram.base_url
+    os.environ['LEONARDO_API_URL'] = f"{leonardo.base_url}{API_PREFIX}"
+    os.environ['LEONARDO_API_KEY'] = 'stub'
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['LEONARDO_CALLBACK_ENABLED'] = 'false'
+    os.environ['JOB_RESUME_ON_START'] = 'false'
+    os.environ['METRICS_ENABLED'] = 'false'
+    defaults = {
+        'TELEGRAM_TOKEN': '123456:load-test',
+        'ADMIN_ID': '1',
+        'LOG_FILE': '',
+        'LOG_LEVEL': 'WARNING',
+        'TELEGRAM_GLOBAL_RATE': '1000000',
+        'TELEGRAM_GLOBAL_BURST': '1000000',
+        'TELEGRAM_CHAT_RATE': '1000',
+        'TELEGRAM_CHAT_BURST': '1000',
+        'RATE_LIMIT_GLOBAL_BURST': '1000000',
+        'RATE_LIMIT_GLOBAL_PER_MINUTE': '1000000',
+        'POLL_EXPECTED_DURATION': str(args.generation_time),
+        'POLL_MIN_INTERVAL': str(max(0.1, args.generation_time / 4)),
+    }
+    for name, value in defaults.items():
+        os.environ.setdefault(name, value)
+
+
+class UpdateFactory:
+    def __init__(self):
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+
+    def message(self, user_id: int, text: str) -> dict:
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Load', 'username': f"load{user_id}"},
+            'text': text,
+        }
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+        return {'update_id': next(self._update_ids), 'message': message}
+
+
+def scenario(user_id: int, unique_prompts: float) -> list:
+    """(label, text) steps of one user, sent one after the other"""
+    prompt = random.choice(PROMPTS)
+    if random.random() < unique_prompts:
+        prompt += f" #{user_id}"
+    return [
+        ('start', '/start'),
+        ('generate', '/generate'),
+        ('prompt', prompt),
+        ('myimages', '/myimages'),
+        ('stats', '/stats'),
+    ]
+
+
+class LoopLagMonitor:
+    """Measures how late the event loop wakes a task up"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.lags = []
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append(max(0.0, loop.time() - expected))
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+
+async def drive(dp, args) -> dict:
+    """Run every user's scenario, at most `args.concurrency` users at a time"""
+    from aiogram import types
+
+    factory = UpdateFactory()
+    latencies = {}
+    errors = []
+    slots = asyncio.Semaphore(args.concurrency)
+
+    async def user(user_id: int):
+        async with slots:
+            for label, text in scenario(user_id, args.unique_prompts):
+                update = types.Update(**factory.message(user_id, text))
+                started = time.perf_counter()
+                try:
+                    await dp.process_update(update)
+                except Exception as e:
+                    errors.append(f"{label}: {str(e)}")
+                latencies.setdefault(label, []).append(time.perf_counter() - started)
+                if args.think_time:
+                    await asyncio.sleep(random.uniform(0, 2 * args.think_time))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(user(FIRST_USER_ID + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - started
+
+    updates = sum(len(values) for values in latencies.values())
+    latency = {label: distribution(values) for label, values in latencies.items()}
+    latency['all'] = distribution(list(itertools.chain(*latencies.values())))
+    return {
+        'updates': updates,
+        'elapsed': round(elapsed, 3),
+        'throughput': round(updates / elapsed, 1) if elapsed else 0.0,
+        'latency': latency,
+        'errors': len(errors),
+        'error_samples': errors[:10],
+    }
+
+
+async def wait_for_jobs(conn, timeout: float) -> dict:
+    """Wait until the generation jobs are delivered or failed, then summarise them"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        unfinished = await conn.fetchval('SELECT count(*) FROM jobs WHERE status = ANY($1::text[])', list(UNFINISHED))
+        if not unfinished:
+            break
+        await asyncio.sleep(0.5)
+
+    rows = await conn.fetch('SELECT status, count(*) AS count FROM jobs GROUP BY status')
+    durations = await conn.fetch('''
+        SELECT EXTRACT(EPOCH FROM updated_at - created_at) AS seconds
+        FROM jobs WHERE status = 'delivered'
+    ''')
+    return {
+        'jobs': {row['status']: row['count'] for row in rows},
+        'delivery': distribution([float(row['seconds']) for row in durations], scale=1),
+    }
+
+
+async def make_admins(conn, args):
+    """The first users are admins, so /stats also takes the full path and not only the refusal"""
+    await conn.execute('''
+        INSERT INTO users (telegram_id, username, is_admin)
+        SELECT g, 'load' || g, TRUE FROM generate_series($1::bigint, $2::bigint) g
+        ON CONFLICT (telegram_id) DO UPDATE SET is_admin = TRUE
+    ''', FIRST_USER_ID, FIRST_USER_ID + min(args.admins, args.users) - 1)
+
+
+async def run(args) -> dict:
+    telegram = TelegramStub(args.telegram_latency, args.flood_rate)
+    leonardo_stub = LeonardoStub(
+        generation_time=args.generation_time,
+        latency=args.leonardo_latency,
+        failure_rate=args.failure_rate,
+        rate_limit_rate=args.rate_limit_rate
+    )
+    await telegram.start(port=0)
+    await leonardo_stub.start(port=0)
+    monitor = LoopLagMonitor()
+    try:
+        async with scratch_schema(keep=args.keep) as conn:
+            schema = await conn.fetchval('SELECT current_schema()')
+            configure(args, telegram, leonardo_stub, with_search_path(os.getenv("DATABASE_URL"), schema))
+
+            # Imported only now, the modules read their settings from the environment
+            from aiogram import Bot, Dispatcher
+            import bot as app
+
+            Dispatcher.set_current(app.dp)
+            Bot.set_current(app.bot)
+            await app.on_startup(app.dp)
+            if app.db.pool is None:
+                raise RuntimeError("The bot did not start, see the log above")
+            try:
+                if args.admins:
+                    await make_admins(conn, args)
+                calls_before = dict(app.db.metrics.calls)
+                monitor.start()
+                results = await drive(app.dp, args)
+                results.update(await wait_for_jobs(conn, args.drain_timeout))
+                calls = {
+                    method: count - calls_before.get(method, 0)
+                    for method, count in app.db.metrics.calls.most_common()
+                    if count > calls_before.get(method, 0)
+                }
+            finally:
+                await monitor.stop()
+                await app.on_shutdown(app.dp)
+                await app.dp.storage.close()
+                await app.dp.storage.wait_closed()
+                await app.bot.session.close()
+    finally:
+        await telegram.stop()
+        await leonardo_stub.stop()
+
+    results['loop_lag'] = distribution(monitor.lags)
+    results['db_calls'] = calls
+    results['db_calls_total'] = sum(calls.values())
+    results['db_calls_per_update'] = round(results['db_calls_total'] / max(1, results['updates']), 2)
+    results['telegram_requests'] = telegram.requests
+    results['leonardo_requests'] = leonardo_stub.requests
+    results['config'] = {name: value for name, value in vars(args).items() if name not in ('output', 'baseline')}
+    return results
+
+
+def lookup(results: dict, path: str):
+    value = results
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value
+
+
+def report(results: dict, baseline: dict = None):
+    print(f"{results['updates']} updates from {results['config']['users']} users in {results['elapsed']}s"
+          f", {results['errors']} errors")
+    print(f"  {'handler':<10} {'count':>7} {'p50 ms':>10} {'p99 ms':>10} {'max ms':>10}")
+    for label, stats in results['latency'].items():
+        print(f"  {label:<10} {stats['count']:>7} {stats['p50']:>10.2f} {stats['p99']:>10.2f} {stats['max']:>10.2f}")
+    print(f"  jobs: {results['jobs']}")
+    print(f"  database calls: {results['db_calls_total']} ({results['db_calls_per_update']} per update)")
+    for method, count in list(results['db_calls'].items())[:10]:
+        print(f"    {method:<32} {count:>8}")
+    print(f"  telegram: {results['telegram_requests']}")
+    print(f"  leonardo: {results['leonardo_requests']}")
+
+    print(f"  {'':<22} {'value':>12} {'baseline':>12} {'change':>9}")
+    for path, unit in SUMMARY:
+        value = lookup(results, path)
+        previous = lookup(baseline, path) if baseline else None
+        line = f"  {path:<22} {value if value is not None else '-':>12}"
+        if previous is not None:
+            change = f"{(value - previous) / previous * 100:+.1f}%" if previous and value is not None else '-'
+            line += f" {previous:>12} {change:>9}"
+        print(f"{line}  {unit}")
+
+
+async def main(args):
+    random.seed(args.seed)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    try:
+        results = await run(args)
+    except Exception as e:
+        print(f"Load test failed: {str(e)}\n{traceback.format_exc()}")
+        raise SystemExit(1)
+
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=200, help="users active at once")
+    parser.add_argument('--think-time', type=float, default=0.0, help="mean seconds between a user's updates")
+    parser.add_argument('--admins', type=int, default=10, help="users who get the full /stats answer")
+    parser.add_argument('--unique-prompts', type=float, default=0.5,
+                        help="share of users with a prompt nobody else sends")
+    parser.add_argument('--generation-time', type=float, default=1.0)
+    parser.add_argument('--leonardo-latency', type=float, default=0.05)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help="share of Leonardo calls answered with 500")
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="share of Leonardo calls answered with 429")
+    parser.add_argument('--telegram-latency', type=float, default=0.02)
+    parser.add_argument('--flood-rate', type=float, default=0.0, help="share of Telegram sends answered with 429")
+    parser.add_argument('--drain-timeout', type=float, default=120, help="seconds to wait for the jobs to finish")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--baseline', help="compare with results written earlier by --output")
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark schema")
+    asyncio.run(main(parser.parse_args()))
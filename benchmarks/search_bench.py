@@ -0,0 +1,69 @@
+"""Prompt search against the old ILIKE query, before and after the full-text index.
+
+    DATABASE_URL=postgresql://... python -m benchmarks.search_bench --users 100000 --images 1000000
+"""
+import time
+import asyncio
+import argparse
+import statistics
+
+from migrations import migrate
+from benchmarks.common import scratch_schema, seed_users_and_images, bench_database
+
+SEARCH_MIGRATION = 5
+
+# Common, rare and missing words; the seeded prompts come from a handful of templates
+TERMS = ['sunset', 'astronaut horse', 'castle clouds', 'fisherman', 'dragon']
+
+ILIKE_QUERY = '''
+    SELECT * FROM images
+    WHERE prompt ILIKE $1 AND ($2::int IS NULL OR user_id = $2)
+    ORDER BY created_at DESC
+'''
+
+
+async def timed(func, repeat: int) -> tuple:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = await func()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), max(timings), result
+
+
+async def run(conn, db, title: str, repeat: int):
+    print(title)
+    for scope in (None, 2):
+        for term in TERMS:
+            ilike_ms, _, rows = await timed(lambda: conn.fetch(ILIKE_QUERY, f'%{term}%', scope), repeat)
+            search_ms, search_max, (images, _) = await timed(
+                lambda: db.search_images_by_prompt(term, user_id=scope, limit=10), repeat
+            )
+            label = f"{term} ({'all' if scope is None else 'one user'})"
+            print(f"  {label:<32} ILIKE {ilike_ms:>9.2f} ms ({len(rows)} rows)"
+                  f"   search {search_ms:>8.2f} ms, max {search_max:.2f} ms ({len(images)} rows)")
+
+
+async def main(args):
+    async with scratch_schema(keep=args.keep) as conn:
+        await migrate(conn, target=SEARCH_MIGRATION - 1)
+        await seed_users_and_images(conn, args.users, args.images)
+        db = await bench_database(conn)
+        try:
+            await run(conn, db, "Without the full-text index:", args.repeat)
+
+            await migrate(conn, target=SEARCH_MIGRATION)
+            await conn.execute('ANALYZE images')
+
+            await run(conn, db, "With the full-text index:", args.repeat)
+        finally:
+            await db.pool.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--images', type=int, default=1000000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help="keep the benchmark schema")
+    asyncio.run(main(parser.parse_args()))
@@ -1,29 +1,40 @@
 import os
+import io
+import csv
+import math
+import time
 import logging
 import json
-import requests
 import traceback
+from contextlib import aclosing
 from aiogram import Bot, Dispatcher, types
+from aiogram.bot.api import TelegramAPIServer
 from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.handler import CancelHandler, current_handler
 from aiogram.dispatcher.middlewares import BaseMiddleware
-from aiogram.utils.exceptions import TelegramAPIError
+from aiogram.utils.exceptions import TelegramAPIError, BadRequest
 from dotenv import load_dotenv
 from database import db
-import time
-from datetime import datetime
+from leonardo import leonardo, generation_governor
+from cache import prompt_cache, USER_CACHE_TTL
+from redis_store import create_redis, RedisStorage, RedisUserCache, RedisJobBackend, RedisRateLimiter, REDIS_URL
+from ratelimit import LocalRateLimiter, rate_limit, buckets_for
+from sender import ScheduledBot, send_priority, NORMAL, BULK
+from poller import poller, LEONARDO_CALLBACK_ENABLED
+from callbacks import callback_server
+from webhook import start_webhook, WEBHOOK_URL
+from metrics import Histogram, CallbackMetric, metrics_server, METRICS_ENABLED
+from logs import setup_logging, set_log_context
+from jobs import JobQueue, GenerationJob, JobStatus, QueueFullError, JOB_RESUME_ON_START
+from datetime import datetime, timedelta
 
 load_dotenv()
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    filename='bot.log'
-)
+# Records are written by a background thread, see logs.py
+setup_logging()
 logger = logging.getLogger(__name__)
 
 # Initialize bot and dispatcher
@@ -31,9 +42,26 @@ TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 LEONARDO_API_KEY = os.getenv('LEONARDO_API_KEY')
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
 ADMIN_USERNAME = os.getenv('ADMIN_USERNAME', 'admin')  # Default value if not set
+BOT_USERNAME = None  # Set in on_startup
+# Another Bot API server, such as a local one or stubs/telegram.py for load tests
+TELEGRAM_API_URL = os.getenv('TELEGRAM_API_URL', '')
+TELEGRAM_PHOTO_BY_URL = os.getenv('TELEGRAM_PHOTO_BY_URL', 'true').lower() in ('1', 'true', 'yes')
 
-storage = MemoryStorage()
-bot = Bot(token=TELEGRAM_TOKEN)
+# With REDIS_URL set, FSM states, the user cache, rate limits and the job
+# queue are shared between bot instances
+redis = create_redis() if REDIS_URL else None
+if redis:
+    storage = RedisStorage(redis)
+    db.user_cache = RedisUserCache(redis, USER_CACHE_TTL)
+    rate_limiter = RedisRateLimiter(redis)
+else:
+    storage = MemoryStorage()
+    rate_limiter = LocalRateLimiter()
+# Sends, replies and edits are paced by bot.scheduler to stay under Telegram's flood limits
+if TELEGRAM_API_URL:
+    bot = ScheduledBot(token=TELEGRAM_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+else:
+    bot = ScheduledBot(token=TELEGRAM_TOKEN)
 dp = Dispatcher(bot, storage=storage)
 
 # States
@@ -46,6 +74,8 @@ BOT_COMMANDS = [
     types.BotCommand(command="help", description="Yordam"),
     types.BotCommand(command="generate", description="Rasm yaratish"),
     types.BotCommand(command="myimages", description="Mening rasmlarim"),
+    types.BotCommand(command="search", description="Rasmlarni prompt bo'yicha qidirish"),
+    types.BotCommand(command="fresh", description="Yangi generatsiya rejimi"),
     types.BotCommand(command="stats", description="Statistika"),
     types.BotCommand(command="admin", description="Admin paneli"),
 ]
@@ -63,6 +93,8 @@ Buyruqlar:
 /help - Yordam
 /generate - Yangi rasm yaratish
 /myimages - Mening rasmlarim
+/search - Rasmlarimni prompt bo'yicha qidirish
+/fresh - Bir xil tavsiflar uchun ham har doim yangi rasm yaratish
 /stats - Statistika
 /admin - Admin paneli
 
@@ -90,83 +122,97 @@ async def setup_bot_commands(bot: Bot):
     except Exception as e:
         logger.error(f"Error setting up bot commands: {str(e)}")
 
-# Leonardo API functions
-def generate_image_with_leonardo(prompt: str):
-    try:
-        api_key = os.getenv("LEONARDO_API_KEY")
-        if not api_key:
-            logger.error("LEONARDO_API_KEY not found in environment variables")
-            return None
-            
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json"
-        }
-        
-        # Create generation
-        data = {
-            "prompt": prompt,
-            "num_images": 1,
-            "width": 512,
-            "height": 512
-        }
-        
-        logger.info(f"Sending generation request to Leonardo API with prompt: {prompt}")
-        response = requests.post(
-            "https://cloud.leonardo.ai/api/rest/v1/generations",
-            headers=headers,
-            json=data
+# Generation jobs
+async def deliver_generation(job: GenerationJob, image_url: str) -> str:
+    caption = f"🎨 Rasm generatsiya qilindi!\n\n📝 Prompt: {job.prompt}"
+    sent_photo = None
+
+    # Let Telegram fetch the image itself, so the bytes never pass through the bot
+    if TELEGRAM_PHOTO_BY_URL:
+        try:
+            sent_photo = await bot.send_photo(
+                job.chat_id,
+                image_url,
+                caption=caption,
+                reply_to_message_id=job.message_id,
+                allow_sending_without_reply=True
+            )
+        except BadRequest as e:
+            logger.warning(f"Telegram could not fetch image by URL, uploading it: {str(e)}")
+
+    if sent_photo is None:
+        # Stream the download straight into the multipart upload
+        async with leonardo.open_image(image_url) as chunks:
+            sent_photo = await bot.send_photo(
+                job.chat_id,
+                ('image.png', chunks),
+                caption=caption,
+                reply_to_message_id=job.message_id,
+                allow_sending_without_reply=True
+            )
+
+    file_id = sent_photo.photo[-1].file_id
+    prompt_cache.set(job.cache_key, file_id)
+    await save_delivered_image(job, file_id)
+    return file_id
+
+async def share_generation(job: GenerationJob, file_id: str):
+    await bot.send_photo(
+        job.chat_id,
+        file_id,
+        caption=f"🎨 Rasm generatsiya qilindi!\n\n📝 Prompt: {job.prompt}",
+        reply_to_message_id=job.message_id,
+        allow_sending_without_reply=True
+    )
+    await save_delivered_image(job, file_id)
+
+async def save_delivered_image(job: GenerationJob, file_id: str):
+    # Save image to database
+    user = await db.get_user_cached(job.user_id)
+    if user:
+        # Written in the next batch, nothing here needs to wait for it
+        db.queue_image(
+            file_id,
+            user['id'],
+            job.prompt
         )
-        
-        logger.info(f"Leonardo API generation response status code: {response.status_code}")
-        if response.status_code == 200:
-            result = response.json()
-            logger.info(f"Leonardo API generation response: {result}")
-            
-            if 'sdGenerationJob' in result and 'generationId' in result['sdGenerationJob']:
-                generation_id = result['sdGenerationJob']['generationId']
-                
-                # Wait for generation to complete and get the result
-                max_attempts = 30  # Maximum number of attempts (5 minutes total)
-                attempt = 0
-                while attempt < max_attempts:
-                    logger.info(f"Checking generation status, attempt {attempt + 1}/{max_attempts}")
-                    
-                    # Get generation result
-                    result_response = requests.get(
-                        f"https://cloud.leonardo.ai/api/rest/v1/generations/{generation_id}",
-                        headers=headers
-                    )
-                    
-                    if result_response.status_code == 200:
-                        result_data = result_response.json()
-                        logger.info(f"Generation status response: {result_data}")
-                        
-                        if 'generations_by_pk' in result_data and result_data['generations_by_pk'].get('status') == 'COMPLETE':
-                            images = result_data['generations_by_pk'].get('generated_images', [])
-                            if images:
-                                return {'image_url': images[0].get('url')}
-                            break
-                        elif result_data['generations_by_pk'].get('status') == 'FAILED':
-                            logger.error("Generation failed")
-                            break
-                    
-                    attempt += 1
-                    time.sleep(10)  # Wait 10 seconds before next attempt
-                
-                if attempt >= max_attempts:
-                    logger.error("Generation timed out")
-            else:
-                logger.error("No generationId in response")
-            return None
-        else:
-            error_data = response.json()
-            error_message = error_data.get('error', 'Unknown error occurred')
-            logger.error(f"Leonardo API error: {response.status_code} - {response.text}")
-            return {'error': error_message}
-    except Exception as e:
-        logger.error(f"Error in generate_image_with_leonardo: {str(e)}\n{traceback.format_exc()}")
-        return {'error': str(e)}
+
+    if job.status_message_id:
+        try:
+            await bot.delete_message(job.chat_id, job.status_message_id)
+        except TelegramAPIError as e:
+            logger.error(f"Error deleting status message: {str(e)}")
+
+async def fail_generation(job: GenerationJob, failed_at: str):
+    if failed_at == JobStatus.SUBMITTED:
+        error_message = f"❌ Xatolik: {job.error}"
+    elif failed_at == JobStatus.POLLING:
+        error_message = "❌ Rasm yaratishda xatolik yuz berdi"
+    elif failed_at == JobStatus.DOWNLOADING:
+        error_message = "❌ Rasm yuklab olishda xatolik yuz berdi"
+    else:
+        error_message = "❌ Tizimda xatolik yuz berdi"
+
+    if job.status_message_id:
+        await bot.edit_message_text(error_message, job.chat_id, job.status_message_id)
+    else:
+        await bot.send_message(job.chat_id, error_message)
+
+async def wait_generation(job: GenerationJob, estimated_wait: float):
+    if job.status_message_id:
+        await bot.edit_message_text(
+            f"⏳ Leonardo hozir band. Rasm taxminan {math.ceil(estimated_wait)} soniyadan keyin yaratila boshlaydi",
+            job.chat_id,
+            job.status_message_id
+        )
+
+job_queue = JobQueue(
+    deliver=deliver_generation,
+    share=share_generation,
+    fail=fail_generation,
+    wait=wait_generation,
+    backend=RedisJobBackend(redis) if redis else None
+)
 
 # Command handlers
 @dp.message_handler(commands=['start'])
@@ -209,15 +255,45 @@ async def send_help(message_or_callback: types.Message | types.CallbackQuery):
         else:
             await message_or_callback.reply(error_message)
 
+STATS_HISTORY_DAYS = 7
+
+def format_daily_stats(days) -> str:
+    """Images per day as a text bar chart, with new and active users"""
+    most = max((day['images'] for day in days), default=0) or 1
+    lines = [f"📈 Oxirgi {len(days)} kun (rasmlar / yangi / faol foydalanuvchilar):"]
+    for day in days:
+        bar = '▇' * round(10 * day['images'] / most)
+        lines.append(f"{day['day'].strftime('%m-%d')} {bar or '·'} {day['images']} / {day['new_users']} / {day['active_users']}")
+    return '\n'.join(lines)
+
+def format_pool_stats(pool) -> str:
+    """Database pool usage and the methods that used it most"""
+    busiest = sorted(pool['calls'].items(), key=lambda item: item[1], reverse=True)[:5]
+    lines = [
+        f"🗄 Baza ulanishlari: {pool['in_use']}/{pool['size']} band (maks {pool['max_size']}), "
+        f"kutish o'rtacha {pool['acquire_wait_avg'] * 1000:.1f} ms, eng ko'pi {pool['acquire_wait_max'] * 1000:.1f} ms"
+    ]
+    if pool['acquire_timeouts']:
+        lines.append(f"⚠️ Ulanish kutish vaqti tugagan: {pool['acquire_timeouts']} marta")
+    lines.extend(f"  {method}: {count}" for method, count in busiest)
+    return '\n'.join(lines)
+
+def format_leonardo_stats() -> str:
+    return (
+        f"🎛 Leonardo: {generation_governor.active}/{generation_governor.limit} generatsiya, "
+        f"{generation_governor.waiting} ta kutmoqda, qayta urinishlar: {leonardo.retries}, "
+        f"holat: {leonardo.breaker.state}"
+    )
+
 @dp.message_handler(commands=['stats'])
-async def show_stats(message: types.Message):
+async def show_stats(message: types.Message, user=None):
     try:
-        user = await db.get_user(message.from_user.id)
         if not user or not user['is_admin']:
             await message.reply("❌ Bu buyruq faqat adminlar uchun")
             return
             
         stats = await db.get_stats()
+        daily_stats = await db.get_daily_stats(STATS_HISTORY_DAYS)
         
         stats_message = (
             "📊 Bot statistikasi:\n\n"
@@ -226,7 +302,11 @@ async def show_stats(message: types.Message):
             f"🖼 Jami rasmlar: {stats['total_images']}\n"
             f"🎨 Bugun yaratilgan rasmlar: {stats['images_today']}\n"
             f"🚫 Bloklangan foydalanuvchilar: {stats['blocked_users']}\n"
-            f"👨‍💼 Adminlar soni: {stats['admin_count']}"
+            f"👨‍💼 Adminlar soni: {stats['admin_count']}\n"
+            f"♻️ Kesh: {prompt_cache.hits} topildi / {prompt_cache.misses} topilmadi\n"
+            f"{format_leonardo_stats()}\n"
+            f"{format_pool_stats(db.pool_stats())}\n\n"
+            f"{format_daily_stats(daily_stats)}"
         )
         
         await message.reply(stats_message)
@@ -234,9 +314,26 @@ async def show_stats(message: types.Message):
         logger.error(f"Error in show_stats: {str(e)}\n{traceback.format_exc()}")
         await message.reply("❌ Tizimda xatolik yuz berdi")
 
+@dp.message_handler(commands=['fresh'])
+async def toggle_fresh_generations(message: types.Message, user=None):
+    try:
+        if not user:
+            await message.reply("❌ Foydalanuvchi topilmadi")
+            return
+
+        fresh = not user['fresh_generations']
+        await db.set_fresh_generations(message.from_user.id, fresh)
+        if fresh:
+            await message.reply("🆕 Yangi generatsiya rejimi yoqildi: har bir tavsif uchun yangi rasm yaratiladi")
+        else:
+            await message.reply("♻️ Yangi generatsiya rejimi o'chirildi: bir xil tavsiflar uchun tayyor rasm yuboriladi")
+    except Exception as e:
+        logger.error(f"Error in toggle_fresh_generations: {str(e)}\n{traceback.format_exc()}")
+        await message.reply("❌ Tizimda xatolik yuz berdi")
+
 @dp.message_handler(commands=['generate'])
 @dp.callback_query_handler(lambda c: c.data == 'generate')
-async def process_generate(message_or_callback: types.Message | types.CallbackQuery):
+async def process_generate(message_or_callback: types.Message | types.CallbackQuery, user=None):
     try:
         if isinstance(message_or_callback, types.CallbackQuery):
             await bot.answer_callback_query(message_or_callback.id)
@@ -246,7 +343,6 @@ async def process_generate(message_or_callback: types.Message | types.CallbackQu
             message = message_or_callback
             user_id = message.from_user.id
             
-        user = await db.get_user(user_id)
         if not user:
             error_message = "❌ Foydalanuvchi topilmadi"
             if isinstance(message_or_callback, types.CallbackQuery):
@@ -315,7 +411,8 @@ async def cancel_handler(callback_query: types.CallbackQuery, state: FSMContext)
         await bot.send_message(callback_query.from_user.id, "❌ Tizimda xatolik yuz berdi")
 
 @dp.message_handler(state=GenerateImage.waiting_for_prompt)
-async def process_prompt(message: types.Message, state: FSMContext):
+@rate_limit('generate')
+async def process_prompt(message: types.Message, state: FSMContext, user=None):
     try:
         user_id = message.from_user.id
         prompt = message.text
@@ -323,43 +420,48 @@ async def process_prompt(message: types.Message, state: FSMContext):
         # Log the generation request
         logger.info(f"Starting image generation for user {user_id} with prompt: {prompt}")
         
+        job = GenerationJob(
+            user_id=user_id,
+            chat_id=message.chat.id,
+            prompt=prompt,
+            message_id=message.message_id
+        )
+
+        # Answer repeated prompts with an already generated image
+        if user and not user['fresh_generations']:
+            file_id = prompt_cache.get(job.cache_key)
+            if file_id:
+                logger.info(f"Prompt cache hit for user {user_id}")
+                try:
+                    await message.reply_photo(
+                        file_id,
+                        caption=f"🎨 Rasm generatsiya qilindi!\n\n📝 Prompt: {prompt}"
+                    )
+                    db.queue_image(file_id, user['id'], prompt)
+                    return
+                except TelegramAPIError as e:
+                    logger.error(f"Cached file_id could not be sent, generating again: {str(e)}")
+                    prompt_cache.invalidate(job.cache_key)
+
         # Send initial status message
         status_message = await message.reply("🎨 Rasm generatsiya qilinmoqda...")
+        job.status_message_id = status_message.message_id
 
-        # Generate image
-        logger.info(f"Sending generation request to Leonardo API with prompt: {prompt}")
-        result = generate_image_with_leonardo(prompt)
-
-        if result and 'image_url' in result:
-            # Download the image
-            image_url = result['image_url']
-            image_response = requests.get(image_url)
-            
-            if image_response.status_code == 200:
-                # Send the image
-                sent_photo = await message.reply_photo(
-                    image_response.content,
-                    caption=f"🎨 Rasm generatsiya qilindi!\n\n📝 Prompt: {prompt}"
-                )
+        try:
+            position = await job_queue.enqueue(job, coalesce=not (user and user['fresh_generations']))
+        except QueueFullError:
+            logger.warning(f"Generation queue is full, rejecting prompt from user {user_id}")
+            await status_message.edit_text("⏳ Hozir so'rovlar juda ko'p. Birozdan keyin qayta urinib ko'ring")
+            return
 
-                # Save image to database
-                user = await db.get_user(user_id)
-                if user:
-                    await db.add_image(
-                        sent_photo.photo[-1].file_id,
-                        user['id'],
-                        prompt
-                    )
-                
-                await status_message.delete()
-            else:
-                logger.error(f"Failed to download image: {image_response.status_code} - {image_response.text}")
-                await status_message.edit_text("❌ Rasm yuklab olishda xatolik yuz berdi")
-        elif result and 'error' in result:
-            await status_message.edit_text(f"❌ Xatolik: {result['error']}")
-        else:
-            logger.error("No image_url in Leonardo API response")
-            await status_message.edit_text("❌ Rasm yaratishda xatolik yuz berdi")
+        if position == 0:
+            await status_message.edit_text(
+                "🎨 Xuddi shu tavsif bo'yicha rasm yaratilmoqda, tayyor bo'lishi bilan sizga ham yuboriladi"
+            )
+        elif position > 1:
+            await status_message.edit_text(
+                f"🎨 So'rovingiz navbatga qo'yildi\n\n⏳ Navbatdagi o'rningiz: {position}"
+            )
 
     except Exception as e:
         logger.error(f"Error in process_prompt: {str(e)}\n{traceback.format_exc()}")
@@ -367,12 +469,75 @@ async def process_prompt(message: types.Message, state: FSMContext):
     finally:
         await state.finish()
 
+GALLERY_PAGE_SIZE = 10
+EPOCH = datetime(1970, 1, 1)
+
+def encode_keyset_cursor(row) -> str:
+    """(created_at, id) of an image or user row, short enough for callback data"""
+    micros = (row['created_at'] - EPOCH) // timedelta(microseconds=1)
+    return f"{micros}:{row['id']}"
+
+def decode_keyset_cursor(value: str) -> tuple:
+    micros, row_id = value.split(':')
+    return EPOCH + timedelta(microseconds=int(micros)), int(row_id)
+
+async def send_images(chat_id: int, images):
+    """Send saved images with their prompts, as a media group if there are several"""
+    media = types.MediaGroup()
+    for image in images:
+        created_at = image['created_at'].replace(tzinfo=None) if image['created_at'] else datetime.now()
+        caption = (
+            f"🎨 Prompt: {image['prompt']}\n"
+            f"📅 Sana: {created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
+            f"🤖 @{BOT_USERNAME}"
+        )
+        # aiogram 2.14 fails on caption_entities=None, which attach_photo() passes
+        media.attach(types.InputMediaPhoto(image['file_id'], caption=caption, caption_entities=[]))
+
+    # Galleries wait behind interactive replies and generated images
+    with send_priority(BULK):
+        if len(images) == 1:
+            await bot.send_photo(chat_id, images[0]['file_id'], caption=media.media[0].caption)
+        else:
+            await bot.send_media_group(chat_id, media)
+
+async def send_gallery_page(chat_id: int, user_db_id: int, cursor: str = None, newer: bool = False) -> bool:
+    """Send one page of the user's images as a media group. Returns False if there are none"""
+    images, has_more = await db.get_user_images_page(
+        user_db_id,
+        decode_keyset_cursor(cursor) if cursor else None,
+        newer=newer,
+        limit=GALLERY_PAGE_SIZE
+    )
+    if not images:
+        return False
+
+    await send_images(chat_id, images)
+
+    # Coming from one side means there are images on that side too
+    has_newer = has_more if newer else cursor is not None
+    has_older = cursor is not None if newer else has_more
+
+    buttons = []
+    if has_newer:
+        buttons.append(InlineKeyboardButton(
+            "◀️ Yangiroq", callback_data=f"gallery:newer:{encode_keyset_cursor(images[0])}"
+        ))
+    if has_older:
+        buttons.append(InlineKeyboardButton(
+            "Eskiroq ▶️", callback_data=f"gallery:older:{encode_keyset_cursor(images[-1])}"
+        ))
+    if buttons:
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        keyboard.add(*buttons)
+        await bot.send_message(chat_id, "🖼 Boshqa rasmlarni ko'rish:", reply_markup=keyboard)
+    return True
+
 @dp.message_handler(commands=['myimages'])
 @dp.callback_query_handler(lambda c: c.data == 'my_images')
-async def show_user_images(message_or_callback: types.Message | types.CallbackQuery):
+async def show_user_images(message_or_callback: types.Message | types.CallbackQuery, user=None):
     try:
         user_id = message_or_callback.from_user.id
-        user = await db.get_user(user_id)
         
         if not user:
             error_message = "❌ Foydalanuvchi topilmadi"
@@ -383,33 +548,18 @@ async def show_user_images(message_or_callback: types.Message | types.CallbackQu
                 await message_or_callback.reply(error_message)
             return
             
-        images = await db.get_user_images(user['id'])
-        
-        if not images:
+        if isinstance(message_or_callback, types.CallbackQuery):
+            await bot.answer_callback_query(message_or_callback.id)
+            chat_id = user_id
+        else:
+            chat_id = message_or_callback.chat.id
+
+        if not await send_gallery_page(chat_id, user['id']):
             no_images_message = "🖼 Sizda hali saqlangan rasmlar yo'q"
             if isinstance(message_or_callback, types.CallbackQuery):
-                await bot.answer_callback_query(message_or_callback.id)
                 await bot.send_message(user_id, no_images_message)
             else:
                 await message_or_callback.reply(no_images_message)
-            return
-            
-        if isinstance(message_or_callback, types.CallbackQuery):
-            await bot.answer_callback_query(message_or_callback.id)
-        
-        for image in images:
-            created_at = image['created_at'].replace(tzinfo=None) if image['created_at'] else datetime.now()
-            caption = (
-                f"🎨 Prompt: {image['prompt']}\n"
-                f"📅 Sana: {created_at.strftime('%Y-%m-%d %H:%M')}\n\n"
-                f"🤖 @{(await bot.me).username}"
-            )
-            
-            # Send each image with caption
-            if isinstance(message_or_callback, types.CallbackQuery):
-                await bot.send_photo(user_id, image['file_id'], caption=caption)
-            else:
-                await bot.send_photo(message_or_callback.chat.id, image['file_id'], caption=caption)
                 
     except Exception as e:
         logger.error(f"Error in show_user_images: {str(e)}\n{traceback.format_exc()}")
@@ -419,40 +569,112 @@ async def show_user_images(message_or_callback: types.Message | types.CallbackQu
         else:
             await message_or_callback.reply(error_message)
 
-@dp.callback_query_handler(lambda c: c.data == 'my_images')
-async def show_user_images(callback_query: types.CallbackQuery):
+@dp.callback_query_handler(lambda c: c.data.startswith('gallery:'))
+async def show_gallery_page(callback_query: types.CallbackQuery, user=None):
     try:
-        user = await db.get_user(callback_query.from_user.id)
-        images = await db.get_user_images(user['id'])
-        
-        if not images:
-            await bot.answer_callback_query(callback_query.id)
-            await bot.send_message(
-                callback_query.from_user.id,
-                "🖼 Sizda hali rasmlar yo'q"
-            )
+        await bot.answer_callback_query(callback_query.id)
+        if not user:
+            await bot.send_message(callback_query.from_user.id, "❌ Foydalanuvchi topilmadi")
             return
 
-        await bot.answer_callback_query(callback_query.id)
-        for image in images:
-            await bot.send_photo(
-                callback_query.from_user.id,
-                image['file_id'],
-                caption=f"🎨 Prompt: {image['prompt']}\n"
-                       f"📅 Sana: {image['created_at'].strftime('%Y-%m-%d %H:%M')}"
-            )
+        _, direction, cursor = callback_query.data.split(':', 2)
+
+        # Remove the old navigation buttons, the new page brings its own
+        try:
+            await bot.delete_message(callback_query.message.chat.id, callback_query.message.message_id)
+        except TelegramAPIError as e:
+            logger.error(f"Error deleting message: {str(e)}")
+
+        if not await send_gallery_page(callback_query.message.chat.id, user['id'], cursor, newer=direction == 'newer'):
+            await bot.send_message(callback_query.message.chat.id, "🖼 Boshqa rasmlar yo'q")
     except Exception as e:
-        logger.error(f"Error in show_user_images: {str(e)}\n{traceback.format_exc()}")
-        await bot.answer_callback_query(callback_query.id)
-        await bot.send_message(
-            callback_query.from_user.id,
-            "❌ Tizimda xatolik yuz berdi"
+        logger.error(f"Error in show_gallery_page: {str(e)}\n{traceback.format_exc()}")
+        await bot.send_message(callback_query.from_user.id, "❌ Tizimda xatolik yuz berdi")
+
+SEARCH_PAGE_SIZE = 10
+
+def encode_search_cursor(image) -> str:
+    return f"{image['rank']!r}:{image['id']}"
+
+def decode_search_cursor(value: str) -> tuple:
+    rank, image_id = value.rsplit(':', 1)
+    return float(rank), int(image_id)
+
+async def send_search_page(chat_id: int, user_db_id: int, query: str, cursor: str = None) -> bool:
+    """Send one page of the user's images matching the query. Returns False if there are none"""
+    images, has_more = await db.search_images_by_prompt(
+        query,
+        user_id=user_db_id,
+        cursor=decode_search_cursor(cursor) if cursor else None,
+        limit=SEARCH_PAGE_SIZE
+    )
+    if not images:
+        return False
+
+    await send_images(chat_id, images)
+
+    if has_more:
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(InlineKeyboardButton(
+            "Yana ▶️", callback_data=f"search:{encode_search_cursor(images[-1])}"
+        ))
+        await bot.send_message(chat_id, f"🔍 \"{query}\" bo'yicha boshqa rasmlar:", reply_markup=keyboard)
+    return True
+
+@dp.message_handler(commands=['search'])
+async def search_images(message: types.Message, user=None):
+    try:
+        if not user:
+            await message.reply("❌ Foydalanuvchi topilmadi")
+            return
+
+        query = message.get_args().strip()
+        if not query:
+            await message.reply("🔍 Rasmlaringizni prompt bo'yicha qidirish uchun so'z yozing, masalan:\n/search mushuk")
+            return
+
+        # The query does not fit into callback data, so the next pages read it from here
+        await dp.storage.update_bucket(
+            chat=message.chat.id,
+            user=message.from_user.id,
+            bucket={'search_query': query}
         )
+        if not await send_search_page(message.chat.id, user['id'], query):
+            await message.reply(f"🔍 \"{query}\" bo'yicha rasmlar topilmadi")
+    except Exception as e:
+        logger.error(f"Error in search_images: {str(e)}\n{traceback.format_exc()}")
+        await message.reply("❌ Tizimda xatolik yuz berdi")
+
+@dp.callback_query_handler(lambda c: c.data.startswith('search:'))
+async def show_search_page(callback_query: types.CallbackQuery, user=None):
+    try:
+        await bot.answer_callback_query(callback_query.id)
+        chat_id = callback_query.message.chat.id
+        if not user:
+            await bot.send_message(chat_id, "❌ Foydalanuvchi topilmadi")
+            return
+
+        bucket = await dp.storage.get_bucket(chat=chat_id, user=callback_query.from_user.id)
+        query = bucket.get('search_query')
+        if not query:
+            await bot.send_message(chat_id, "🔍 Qidiruvni qaytadan yuboring: /search so'z")
+            return
+
+        try:
+            await bot.delete_message(chat_id, callback_query.message.message_id)
+        except TelegramAPIError as e:
+            logger.error(f"Error deleting message: {str(e)}")
+
+        cursor = callback_query.data.split(':', 1)[1]
+        if not await send_search_page(chat_id, user['id'], query, cursor):
+            await bot.send_message(chat_id, "🔍 Boshqa rasmlar yo'q")
+    except Exception as e:
+        logger.error(f"Error in show_search_page: {str(e)}\n{traceback.format_exc()}")
+        await bot.send_message(callback_query.from_user.id, "❌ Tizimda xatolik yuz berdi")
 
 # Admin handlers
 @dp.message_handler(commands=['admin'])
-async def admin_panel(message: types.Message):
-    user = await db.get_user(message.from_user.id)
+async def admin_panel(message: types.Message, user=None):
     if not user or not user['is_admin']:
         await message.reply("❌ Bu buyruq faqat adminlar uchun")
         return
@@ -471,8 +693,7 @@ class AdminStates(StatesGroup):
     waiting_for_username = State()
 
 @dp.callback_query_handler(lambda c: c.data == "add_admin")
-async def add_admin_start(callback_query: types.CallbackQuery):
-    user = await db.get_user(callback_query.from_user.id)
+async def add_admin_start(callback_query: types.CallbackQuery, user=None):
     if not user or not user['is_admin']:
         await callback_query.answer("❌ Bu funksiya faqat adminlar uchun", show_alert=True)
         return
@@ -533,8 +754,7 @@ async def process_admin_username(message: types.Message, state: FSMContext):
         await state.finish()
 
 @dp.callback_query_handler(lambda c: c.data == "remove_admin")
-async def remove_admin_start(callback_query: types.CallbackQuery):
-    user = await db.get_user(callback_query.from_user.id)
+async def remove_admin_start(callback_query: types.CallbackQuery, user=None):
     if not user or not user['is_admin']:
         await callback_query.answer("❌ Bu funksiya faqat adminlar uchun", show_alert=True)
         return
@@ -730,10 +950,25 @@ async def manage_users(callback_query: types.CallbackQuery):
         await bot.answer_callback_query(callback_query.id)
         await bot.send_message(callback_query.from_user.id, "❌ Xatolik yuz berdi")
 
-@dp.callback_query_handler(lambda c: c.data == "users_list", user_id=int(os.getenv("ADMIN_ID")))
+USERS_PAGE_SIZE = 25
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+@dp.callback_query_handler(
+    lambda c: c.data == "users_list" or c.data.startswith("users_page:"),
+    user_id=int(os.getenv("ADMIN_ID"))
+)
 async def list_users(callback_query: types.CallbackQuery):
     try:
-        users = await db.get_all_users()
+        cursor, newer = None, False
+        if callback_query.data.startswith("users_page:"):
+            _, direction, cursor = callback_query.data.split(':', 2)
+            newer = direction == 'newer'
+
+        users, has_more, total_users = await db.get_users_paginated(
+            decode_keyset_cursor(cursor) if cursor else None,
+            newer=newer,
+            limit=USERS_PAGE_SIZE
+        )
         
         if not users:
             await bot.answer_callback_query(callback_query.id)
@@ -747,15 +982,30 @@ async def list_users(callback_query: types.CallbackQuery):
             )
             return
 
-        users_text = "👥 Foydalanuvchilar ro'yxati:\n\n"
+        users_text = f"👥 Foydalanuvchilar ro'yxati ({total_users} ta):\n\n"
         for user in users:
             username = f"@{user['username']}" if user['username'] else f"ID: {user['telegram_id']}"
             status = "🚫" if user.get('is_blocked') else "✅"
             users_text += f"• {username} {status}\n"
 
-        keyboard = InlineKeyboardMarkup().add(
-            InlineKeyboardButton("◀️ Orqaga", callback_data="manage_users")
-        )
+        # Coming from one side means there are users on that side too
+        has_newer = has_more if newer else cursor is not None
+        has_older = cursor is not None if newer else has_more
+
+        keyboard = InlineKeyboardMarkup(row_width=2)
+        buttons = []
+        if has_newer:
+            buttons.append(InlineKeyboardButton(
+                "◀️ Yangiroq", callback_data=f"users_page:newer:{encode_keyset_cursor(users[0])}"
+            ))
+        if has_older:
+            buttons.append(InlineKeyboardButton(
+                "Eskiroq ▶️", callback_data=f"users_page:older:{encode_keyset_cursor(users[-1])}"
+            ))
+        if buttons:
+            keyboard.add(*buttons)
+        keyboard.add(InlineKeyboardButton("📥 CSV yuklab olish", callback_data="users_export"))
+        keyboard.add(InlineKeyboardButton("◀️ Orqaga", callback_data="manage_users"))
         
         await bot.answer_callback_query(callback_query.id)
         await bot.edit_message_text(
@@ -772,10 +1022,50 @@ async def list_users(callback_query: types.CallbackQuery):
             "❌ Tizimda xatolik yuz berdi"
         )
 
+async def users_csv():
+    """All users as CSV, in chunks of about EXPORT_CHUNK_SIZE bytes"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(['telegram_id', 'username', 'is_admin', 'is_blocked', 'fresh_generations', 'created_at'])
+    async for user in db.iter_users():
+        writer.writerow([
+            user['telegram_id'],
+            user['username'] or '',
+            user['is_admin'],
+            user['is_blocked'],
+            user['fresh_generations'],
+            user['created_at'].isoformat() if user['created_at'] else ''
+        ])
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue().encode('utf-8')
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue().encode('utf-8')
+
+@dp.callback_query_handler(lambda c: c.data == "users_export", user_id=int(os.getenv("ADMIN_ID")))
+async def export_users(callback_query: types.CallbackQuery):
+    try:
+        await bot.answer_callback_query(callback_query.id, "📥 Eksport tayyorlanmoqda...")
+        # The CSV is streamed from the database cursor straight into the upload
+        with send_priority(BULK):
+            async with aclosing(users_csv()) as chunks:
+                await bot.send_document(
+                    callback_query.from_user.id,
+                    (f"users-{datetime.now().strftime('%Y-%m-%d')}.csv", chunks),
+                    caption="👥 Foydalanuvchilar ro'yxati"
+                )
+    except Exception as e:
+        logger.error(f"Error in export_users: {str(e)}\n{traceback.format_exc()}")
+        await bot.send_message(
+            callback_query.from_user.id,
+            "❌ Tizimda xatolik yuz berdi"
+        )
+
 @dp.callback_query_handler(lambda c: c.data == "show_stats", user_id=int(os.getenv("ADMIN_ID")))
 async def show_stats_callback(callback_query: types.CallbackQuery):
     try:
         stats = await db.get_stats()
+        daily_stats = await db.get_daily_stats(STATS_HISTORY_DAYS)
         
         stats_text = "📊 Bot statistikasi:\n\n"
         stats_text += f"👥 Jami foydalanuvchilar: {stats['total_users']}\n"
@@ -784,6 +1074,10 @@ async def show_stats_callback(callback_query: types.CallbackQuery):
         stats_text += f"🎨 Bugun yaratilgan rasmlar: {stats['images_today']}\n"
         stats_text += f"🚫 Bloklangan foydalanuvchilar: {stats['blocked_users']}\n"
         stats_text += f"👮‍♂️ Adminlar soni: {stats['admin_count']}\n"
+        stats_text += f"♻️ Kesh: {prompt_cache.hits} topildi / {prompt_cache.misses} topilmadi\n"
+        stats_text += f"{format_leonardo_stats()}\n"
+        stats_text += f"{format_pool_stats(db.pool_stats())}\n\n"
+        stats_text += format_daily_stats(daily_stats)
         
         keyboard = InlineKeyboardMarkup()
         keyboard.add(InlineKeyboardButton("◀️ Orqaga", callback_data="manage_users"))
@@ -812,27 +1106,148 @@ def get_admin_keyboard():
     keyboard.add(types.InlineKeyboardButton("🔙 Orqaga", callback_data="admin_back"))
     return keyboard
 
-# Add message handler middleware to check if user is blocked
+# Add message handler middleware to check if user is blocked.
+# It also loads the user row once per update and passes it to handlers as `user`
 class MessageMiddleware(BaseMiddleware):
     async def on_pre_process_message(self, message: types.Message, data: dict):
+        set_log_context(user_id=message.from_user.id)
+        user = await db.get_user_cached(message.from_user.id)
+        data['user'] = user
         if message.from_user.id != int(os.getenv("ADMIN_ID")):
-            is_blocked = await db.is_user_blocked(message.from_user.id)
-            if is_blocked:
+            if user and user['is_blocked']:
                 await message.reply("⛔️ Kechirasiz, siz bloklangansiz")
                 raise CancelHandler()
 
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        set_log_context(user_id=callback_query.from_user.id)
+        data['user'] = await db.get_user_cached(callback_query.from_user.id)
+
+class RateLimitMiddleware(BaseMiddleware):
+    """Checks the token buckets of handlers marked with @rate_limit"""
+
+    def __init__(self, limiter):
+        super().__init__()
+        self.limiter = limiter
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        key = getattr(current_handler.get(), 'rate_limit_key', None)
+        if key is None:
+            return
+
+        user = data.get('user')
+        is_admin = message.from_user.id == ADMIN_ID or bool(user and user['is_admin'])
+        bucket, retry_after = await self.limiter.acquire(buckets_for(key, message.from_user.id, is_admin))
+        if bucket is None:
+            return
+
+        seconds = max(1, math.ceil(retry_after))
+        if bucket.endswith(':global'):
+            await message.reply(f"⏳ Bot hozir juda band. {seconds} soniyadan keyin qayta urinib ko'ring")
+        else:
+            await message.reply(f"⏳ Juda ko'p so'rov. {seconds} soniyadan keyin qayta urinib ko'ring")
+        raise CancelHandler()
+
+HANDLER_SECONDS = Histogram(
+    'imagebot_handler_seconds', "Time from receiving an update to the end of its handler", ['handler']
+)
+
+class MetricsMiddleware(BaseMiddleware):
+    """Times updates per handler, the other middlewares included"""
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        data['received_at'] = time.perf_counter()
+
+    async def on_pre_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['received_at'] = time.perf_counter()
+
+    async def on_process_message(self, message: types.Message, data: dict):
+        data['handler_name'] = current_handler.get().__name__
+
+    async def on_process_callback_query(self, callback_query: types.CallbackQuery, data: dict):
+        data['handler_name'] = current_handler.get().__name__
+
+    async def on_post_process_message(self, message: types.Message, results: list, data: dict):
+        self.observe(data)
+
+    async def on_post_process_callback_query(self, callback_query: types.CallbackQuery, results: list, data: dict):
+        self.observe(data)
+
+    def observe(self, data: dict):
+        # Updates no handler matched are not timed
+        if 'handler_name' in data:
+            HANDLER_SECONDS.observe(time.perf_counter() - data['received_at'], data['handler_name'])
+
 # Register middleware
+dp.middleware.setup(MetricsMiddleware())
 dp.middleware.setup(MessageMiddleware())
+dp.middleware.setup(RateLimitMiddleware(rate_limiter))
+
+# Metrics read from the counters the components already keep
+CallbackMetric(
+    'imagebot_cache_lookups_total', "Cache lookups by cache and result",
+    lambda: {
+        ('prompt', 'hit'): prompt_cache.hits,
+        ('prompt', 'miss'): prompt_cache.misses,
+        ('user', 'hit'): db.metrics.user_cache_hits,
+        ('user', 'miss'): db.metrics.user_cache_misses,
+    },
+    type='counter', labelnames=['cache', 'result']
+)
+CallbackMetric(
+    'imagebot_telegram_flood_waits_total', "RetryAfter answers from Telegram",
+    lambda: bot.scheduler.flood_waits, type='counter'
+)
+CallbackMetric(
+    'imagebot_telegram_merged_edits_total', "Message edits replaced by a later edit before being sent",
+    lambda: bot.scheduler.merged_edits, type='counter'
+)
+CallbackMetric('imagebot_telegram_send_waiting', "Requests waiting for the global send lane", lambda: bot.scheduler.waiting)
+CallbackMetric('imagebot_job_queue_depth', "Generation jobs waiting in the queue", job_queue.depth)
+CallbackMetric('imagebot_jobs_in_flight', "Generation jobs being run by this process", lambda: job_queue.in_flight)
 
 async def on_startup(dp):
+    global BOT_USERNAME
     try:
+        BOT_USERNAME = (await bot.me).username
         await db.create_pool()
         await db.create_tables()
+        await leonardo.create_session()
+        await poller.start()
+        if LEONARDO_CALLBACK_ENABLED:
+            try:
+                await callback_server.start()
+            except ValueError as e:
+                logger.error(f"{str(e)}, polling Leonardo instead")
+                poller.callback_mode = False
+        # Worker tasks inherit the lane, so deliveries go after interactive replies
+        with send_priority(NORMAL):
+            await job_queue.start()
+            if JOB_RESUME_ON_START:
+                job_queue.resume()
         await setup_bot_commands(bot)
+        if METRICS_ENABLED:
+            await metrics_server.start()
         logging.info("Bot started")
     except Exception as e:
         logger.error(f"Error in on_startup: {str(e)}\n{traceback.format_exc()}")
 
+async def on_shutdown(dp):
+    try:
+        await metrics_server.stop()
+        await job_queue.stop()
+        await callback_server.stop()
+        await poller.stop()
+        await leonardo.close()
+        # After the job queue, so images of the last deliveries are saved too
+        await db.close()
+        await bot.scheduler.stop()
+        logging.info("Bot stopped")
+    except Exception as e:
+        logger.error(f"Error in on_shutdown: {str(e)}\n{traceback.format_exc()}")
+
 if __name__ == '__main__':
-    from aiogram import executor
-    executor.start_polling(dp, on_startup=on_startup, skip_updates=True)
+    if WEBHOOK_URL:
+        start_webhook(dp, on_startup=on_startup, on_shutdown=on_shutdown)
+    else:
+        from aiogram import executor
+        executor.start_polling(dp, on_startup=on_startup, on_shutdown=on_shutdown, skip_updates=True)
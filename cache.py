@@ -0,0 +1,89 @@
+import os
+import re
+import time
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PROMPT_CACHE_SIZE = int(os.getenv("PROMPT_CACHE_SIZE", "10000"))
+PROMPT_CACHE_TTL = float(os.getenv("PROMPT_CACHE_TTL", "86400"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+
+
+class TTLCache:
+    """LRU cache whose entries also expire `ttl` seconds after they were set"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+
+        value, expires_at = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return None
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._data[key] = (value, time.monotonic() + self.ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._data.pop(key, None)
+
+    def clear(self):
+        self._data.clear()
+
+
+def normalize_prompt(prompt: str) -> str:
+    prompt = re.sub(r'\s+', ' ', prompt).strip().lower()
+    return prompt.rstrip('.!?,; ')
+
+
+def prompt_key(prompt: str, width: int, height: int, num_images: int, model_id: Optional[str] = None) -> tuple:
+    return (normalize_prompt(prompt), width, height, num_images, model_id)
+
+
+# Telegram file_id of an already generated image, keyed by prompt_key()
+prompt_cache = TTLCache(PROMPT_CACHE_SIZE, PROMPT_CACHE_TTL)
+
+
+class LocalUserCache:
+    """users rows keyed by telegram_id, kept in this process.
+
+    RedisUserCache in redis_store.py has the same interface and is shared by
+    all instances.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self._cache = TTLCache(max_size, ttl)
+
+    async def get(self, telegram_id: int):
+        return self._cache.get(telegram_id)
+
+    async def set(self, telegram_id: int, user):
+        self._cache.set(telegram_id, user)
+
+    async def invalidate(self, telegram_id: int):
+        self._cache.invalidate(telegram_id)
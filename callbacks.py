@@ -0,0 +1,92 @@
+import os
+import hmac
+import logging
+import traceback
+from typing import Optional
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+from poller import poller
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+CALLBACK_HOST = os.getenv("CALLBACK_HOST", "0.0.0.0")
+CALLBACK_PORT = int(os.getenv("CALLBACK_PORT", "8081"))
+CALLBACK_PATH = os.getenv("CALLBACK_PATH", "/leonardo/callback")
+# Webhook callback API key configured for the API key in Leonardo's dashboard; required
+LEONARDO_CALLBACK_SECRET = os.getenv("LEONARDO_CALLBACK_SECRET", "")
+
+
+def parse_callback(payload: dict):
+    """Extract (generation_id, status, image_url) from a Leonardo webhook payload"""
+    generation = (payload.get('data') or {}).get('object') or {}
+    generation_id = generation.get('id')
+    status = generation.get('status')
+    if status is None:
+        # image_generation.complete events do not always carry the status field
+        status = 'COMPLETE' if payload.get('type') == 'image_generation.complete' else 'FAILED'
+    images = generation.get('images') or generation.get('generated_images') or []
+    image_url = images[0].get('url') if images else None
+    return generation_id, status, image_url
+
+
+class CallbackServer:
+    """HTTP endpoint that receives Leonardo generation completion callbacks"""
+
+    def __init__(self, path: str = CALLBACK_PATH, secret: str = LEONARDO_CALLBACK_SECRET):
+        self.path = path
+        self.secret = secret
+        self.runner: Optional[web.AppRunner] = None
+        self.received = 0
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post(self.path, self.handle)
+
+    async def start(self, host: str = CALLBACK_HOST, port: int = CALLBACK_PORT):
+        # Without it anyone who learns a generation id could post an image URL for it
+        if not self.secret:
+            raise ValueError("LEONARDO_CALLBACK_SECRET is required for Leonardo callbacks")
+        app = web.Application()
+        self.setup_routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Leonardo callback server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _authorized(self, request: web.Request) -> bool:
+        if not self.secret:
+            return False
+        authorization = request.headers.get('Authorization', '')
+        token = authorization[7:] if authorization.startswith('Bearer ') else authorization
+        return hmac.compare_digest(token, self.secret)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            logger.warning(f"Rejected unauthorized Leonardo callback from {request.remote}")
+            return web.Response(status=401)
+
+        try:
+            payload = await request.json()
+            generation_id, status, image_url = parse_callback(payload)
+        except Exception as e:
+            logger.error(f"Invalid Leonardo callback: {str(e)}\n{traceback.format_exc()}")
+            return web.Response(status=400)
+
+        if not generation_id:
+            return web.Response(status=400)
+
+        self.received += 1
+        logger.info(f"Leonardo callback for generation {generation_id}: {status}")
+        poller.complete(generation_id, status, image_url)
+        return web.json_response({'ok': True})
+
+
+callback_server = CallbackServer()
@@ -1,124 +1,540 @@
+import re
+import time
+import random
+import asyncio
+import logging
 import asyncpg
-from typing import Optional
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import Awaitable, Callable, List, Optional
 from datetime import datetime
 import os
 from dotenv import load_dotenv
+from cache import LocalUserCache, TTLCache
+from migrations import migrate
+from metrics import Histogram, CallbackMetric
+from logs import start_background_task
 
 load_dotenv()
 
+# Connection pool
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+# 0 disables prepared statements, e.g. behind pgbouncer in transaction mode
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+# Connections are replaced after this many queries or seconds of being idle
+DB_MAX_QUERIES = int(os.getenv("DB_MAX_QUERIES", "50000"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+
+STATS_CACHE_TTL = float(os.getenv("STATS_CACHE_TTL", "5"))
+# Rows each stats counter is spread over, more slots means less lock contention
+STATS_COUNTER_SLOTS = int(os.getenv("STATS_COUNTER_SLOTS", "8"))
+# Buffered add_user/add_image writes go out when this many are waiting, or
+# DB_WRITE_FLUSH_INTERVAL seconds after the first one arrived
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "500"))
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "0.05"))
+
+logger = logging.getLogger(__name__)
+
+# jobs.owner of the jobs waiting in a shared queue, which outlives any one instance
+SHARED_QUEUE_OWNER = 'queue'
+
+# Errors caused by the rows themselves; a smaller batch without the bad row can succeed
+ROW_ERRORS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+
+def _consume_exception(future: asyncio.Future):
+    # Failed writes are logged by WriteBuffer, so callers may drop the future
+    if not future.cancelled():
+        future.exception()
+
+
+class WriteBuffer:
+    """Collects rows and writes them in batches from one background task.
+
+    `write` gets a list of rows and returns one result per row. Every row added
+    gets a future that resolves with its result once the batch is committed.
+    A batch rejected because of its data is split in halves and retried, so
+    one bad row only fails its own future. Any other error, such as the
+    database being unreachable, fails the whole batch at once.
+    """
+
+    def __init__(self, name: str, write: Callable[[list], Awaitable[list]],
+                 batch_size: int = DB_WRITE_BATCH_SIZE, interval: float = DB_WRITE_FLUSH_INTERVAL):
+        self.name = name
+        self.write = write
+        self.batch_size = batch_size
+        self.interval = interval
+        self._pending: list = []
+        self._has_rows: Optional[asyncio.Event] = None
+        self._full: Optional[asyncio.Event] = None
+        self._lock: Optional[asyncio.Lock] = None
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        self._stopped = False
+        self.batches = 0
+        self.rows = 0
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def start(self):
+        if self._task is None:
+            self._has_rows = asyncio.Event()
+            self._full = asyncio.Event()
+            self._lock = asyncio.Lock()
+            self._closing = False
+            self._task = start_background_task(self._loop())
+
+    async def stop(self):
+        """Write everything still buffered and stop the background task"""
+        self._stopped = True
+        if self._task is None:
+            return
+        self._closing = True
+        self._update_events()
+        await self._task
+        self._task = None
+
+    def add(self, row) -> asyncio.Future:
+        if self._stopped:
+            raise RuntimeError(f"The {self.name} write buffer is stopped")
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        future.add_done_callback(_consume_exception)
+        self._pending.append((row, future))
+        self._update_events()
+        return future
+
+    def _update_events(self):
+        if self._pending or self._closing:
+            self._has_rows.set()
+        else:
+            self._has_rows.clear()
+        if len(self._pending) >= self.batch_size or self._closing:
+            self._full.set()
+        else:
+            self._full.clear()
+
+    async def _loop(self):
+        while self._pending or not self._closing:
+            await self._has_rows.wait()
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            while self._pending:
+                batch = self._pending[:self.batch_size]
+                self._pending = self._pending[self.batch_size:]
+                self._update_events()
+                await self._write_batch(batch)
+
+    async def _write_batch(self, batch: list):
+        try:
+            results = await self.write([row for row, _ in batch])
+        except ROW_ERRORS as e:
+            if len(batch) > 1:
+                logger.warning(f"Batched {self.name} write of {len(batch)} rows failed, splitting it: {str(e)}")
+                middle = len(batch) // 2
+                await self._write_batch(batch[:middle])
+                await self._write_batch(batch[middle:])
+                return
+            logger.error(f"Error writing {self.name} {batch[0][0]}: {str(e)}")
+            self._fail(batch, e)
+            return
+        except Exception as e:
+            logger.error(f"Batched {self.name} write of {len(batch)} rows failed: {str(e)}")
+            self._fail(batch, e)
+            return
+
+        self.batches += 1
+        self.rows += len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    @staticmethod
+    def _fail(batch: list, error: Exception):
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(error)
+
+
+DB_CALL_SECONDS = Histogram(
+    'imagebot_db_call_seconds', "Time a Database method held its pool connection", ['method']
+)
+DB_ACQUIRE_WAIT_SECONDS = Histogram('imagebot_db_acquire_wait_seconds', "Time spent waiting for a pool connection")
+
+
+class PoolMetrics:
+    """Connection acquire waits and calls per Database method"""
+
+    def __init__(self):
+        self.acquires = 0
+        self.acquire_wait = 0.0
+        self.acquire_wait_max = 0.0
+        self.acquire_timeouts = 0
+        self.calls = Counter()
+        self.call_time = Counter()
+        self.user_cache_hits = 0
+        self.user_cache_misses = 0
+
+    def record_acquire(self, wait: float):
+        self.acquires += 1
+        self.acquire_wait += wait
+        self.acquire_wait_max = max(self.acquire_wait_max, wait)
+
+    def record_call(self, method: str, duration: float):
+        self.calls[method] += 1
+        self.call_time[method] += duration
+
+    def record_user_cache(self, hit: bool):
+        if hit:
+            self.user_cache_hits += 1
+        else:
+            self.user_cache_misses += 1
+
+
+# Queries run often enough to keep as prepared statements on every connection
+GET_USER_QUERY = 'SELECT * FROM users WHERE telegram_id = $1'
+MARK_IMAGE_DAY_QUERY = '''
+    UPDATE users SET last_image_on = CURRENT_DATE
+    FROM (
+        SELECT id, last_image_on FROM users
+        WHERE id = ANY($1::int[])
+        ORDER BY id
+        FOR UPDATE
+    ) previous
+    WHERE users.id = previous.id
+    AND users.last_image_on IS DISTINCT FROM CURRENT_DATE
+    RETURNING previous.last_image_on IS NULL AS ever
+'''
+
+
 class Database:
     def __init__(self):
         self.pool: Optional[asyncpg.Pool] = None
+        self.metrics = PoolMetrics()
+        # Prepared statements by server pid of the connection, then by query
+        self._statements: dict = {}
+        # Replaced by a RedisUserCache when the bot runs with REDIS_URL
+        self.user_cache = LocalUserCache()
+        self.stats_cache = TTLCache(1, STATS_CACHE_TTL)
+        self.user_writes = WriteBuffer('users', self._write_users)
+        self.image_writes = WriteBuffer('images', self._write_images)
 
     async def create_pool(self):
         self.pool = await asyncpg.create_pool(
             os.getenv("DATABASE_URL"),
-            min_size=2,
-            max_size=10
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            max_queries=DB_MAX_QUERIES,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            init=self._init_connection
         )
 
+    async def _init_connection(self, conn: asyncpg.Connection):
+        pid = conn.get_server_pid()
+        self._statements.pop(pid, None)
+        conn.add_termination_listener(lambda _: self._statements.pop(pid, None))
+
+    @asynccontextmanager
+    async def acquire(self, method: str):
+        """Acquire a pool connection, recording the wait and the call under `method`"""
+        started = time.perf_counter()
+        try:
+            conn = await self.pool.acquire(timeout=DB_ACQUIRE_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.metrics.acquire_timeouts += 1
+            logger.error(f"No database connection free after {DB_ACQUIRE_TIMEOUT}s in {method}")
+            raise
+        acquired = time.perf_counter()
+        self.metrics.record_acquire(acquired - started)
+        DB_ACQUIRE_WAIT_SECONDS.observe(acquired - started)
+        try:
+            yield conn
+        finally:
+            duration = time.perf_counter() - acquired
+            self.metrics.record_call(method, duration)
+            DB_CALL_SECONDS.observe(duration, method)
+            await self.pool.release(conn)
+
+    async def _prepared(self, conn, query: str):
+        """Prepared statement for `query` on this connection, created on first use.
+
+        Unlike asyncpg's statement cache these are never evicted by other queries.
+        """
+        statements = self._statements.setdefault(conn.get_server_pid(), {})
+        statement = statements.get(query)
+        if statement is None:
+            statement = statements[query] = await conn.prepare(query)
+        return statement
+
+    async def _fetch_prepared(self, conn, method: str, query: str, *args):
+        """Run a hot query through its prepared statement; `method` is fetch, fetchrow or fetchval"""
+        if not DB_STATEMENT_CACHE_SIZE:
+            return await getattr(conn, method)(query, *args)
+        try:
+            return await getattr(await self._prepared(conn, query), method)(*args)
+        except asyncpg.exceptions.InvalidCachedStatementError:
+            # The schema changed under the statement, e.g. by a migration
+            self._statements.get(conn.get_server_pid(), {}).pop(query, None)
+            return await getattr(await self._prepared(conn, query), method)(*args)
+
+    def pool_stats(self) -> dict:
+        size = self.pool.get_size() if self.pool else 0
+        idle = self.pool.get_idle_size() if self.pool else 0
+        acquires = self.metrics.acquires
+        return {
+            'size': size,
+            'in_use': size - idle,
+            'max_size': DB_POOL_MAX_SIZE,
+            'acquires': acquires,
+            'acquire_wait_avg': self.metrics.acquire_wait / acquires if acquires else 0.0,
+            'acquire_wait_max': self.metrics.acquire_wait_max,
+            'acquire_timeouts': self.metrics.acquire_timeouts,
+            'calls': dict(self.metrics.calls)
+        }
+
+    async def close(self):
+        """Flush the buffered writes and close the pool"""
+        await self.user_writes.stop()
+        await self.image_writes.stop()
+        if self.pool:
+            await self.pool.close()
+
     async def create_tables(self):
-        async with self.pool.acquire() as conn:
-            
-            # Users table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    id SERIAL PRIMARY KEY,
-                    telegram_id BIGINT UNIQUE,
-                    username VARCHAR(255),
-                    is_admin BOOLEAN DEFAULT FALSE,
-                    is_blocked BOOLEAN DEFAULT FALSE,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
+        async with self.acquire('create_tables') as conn:
+            await migrate(conn)
 
-            # Images table
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS images (
-                    id SERIAL PRIMARY KEY,
-                    file_id VARCHAR(255),
-                    user_id INTEGER REFERENCES users(id),
-                    prompt TEXT,
-                    created_at TIMESTAMP DEFAULT NOW()
-                )
-            ''')
-            
             # Add initial admin user if ADMIN_ID is set
             admin_id = os.getenv("ADMIN_ID")
             if admin_id:
-                await conn.execute('''
-                    INSERT INTO users (telegram_id, is_admin)
-                    VALUES ($1, TRUE)
-                    ON CONFLICT (telegram_id) 
-                    DO UPDATE SET is_admin = TRUE
-                ''', int(admin_id))
+                async with conn.transaction():
+                    inserted = await conn.fetchval('''
+                        INSERT INTO users (telegram_id)
+                        VALUES ($1)
+                        ON CONFLICT (telegram_id) DO NOTHING
+                        RETURNING id
+                    ''', int(admin_id))
+                    if inserted:
+                        await self._bump_stats(conn, total_users=1)
+                        await self._bump_daily_stats(conn, new_users=1)
+
+        if admin_id:
+            await self.set_admin(int(admin_id), True)
+
+    async def _bump_stats(self, conn, **deltas):
+        """Add to the totals counters in the caller's transaction"""
+        # Always lock the rows in the same order
+        names = sorted(name for name, delta in deltas.items() if delta)
+        if not names:
+            return
+        await conn.execute('''
+            INSERT INTO stats_totals (name, slot, value)
+            SELECT unnest($1::text[]), $2, unnest($3::bigint[])
+            ON CONFLICT (name, slot) DO UPDATE SET value = stats_totals.value + EXCLUDED.value
+        ''', names, random.randrange(STATS_COUNTER_SLOTS), [deltas[name] for name in names])
+
+    async def _bump_daily_stats(self, conn, **deltas):
+        """Add to today's rollup counters in the caller's transaction"""
+        names = sorted(name for name, delta in deltas.items() if delta)
+        if not names:
+            return
+        await conn.execute('''
+            INSERT INTO stats_daily (day, name, slot, value)
+            SELECT CURRENT_DATE, unnest($1::text[]), $2, unnest($3::bigint[])
+            ON CONFLICT (day, name, slot) DO UPDATE SET value = stats_daily.value + EXCLUDED.value
+        ''', names, random.randrange(STATS_COUNTER_SLOTS), [deltas[name] for name in names])
 
     async def add_user(self, telegram_id: int, username: str) -> bool:
-        async with self.pool.acquire() as conn:
-            try:
-                await conn.execute('''
-                    INSERT INTO users (telegram_id, username)
-                    VALUES ($1, $2)
-                    ON CONFLICT (telegram_id) 
-                    DO UPDATE SET username = $2
-                ''', telegram_id, username)
-                return True
-            except Exception as e:
-                print(f"Error adding user: {e}")
-                return False
+        """Add or update a user. Waits until the buffered write is committed"""
+        try:
+            await self.user_writes.add((telegram_id, username))
+            return True
+        except Exception as e:
+            print(f"Error adding user: {e}")
+            return False
+
+    async def _write_users(self, rows: List[tuple]) -> list:
+        # The same user can be queued twice in one batch, the latest username wins
+        usernames = dict(rows)
+        telegram_ids = sorted(usernames)
+        async with self.acquire('add_user') as conn:
+            async with conn.transaction():
+                # xmax is 0 only for rows this statement inserted
+                inserted = await conn.fetchval('''
+                    WITH upserted AS (
+                        INSERT INTO users (telegram_id, username)
+                        SELECT * FROM unnest($1::bigint[], $2::varchar[])
+                        ON CONFLICT (telegram_id)
+                        DO UPDATE SET username = EXCLUDED.username
+                        RETURNING xmax = 0 AS inserted
+                    )
+                    SELECT COUNT(*) FILTER (WHERE inserted) FROM upserted
+                ''', telegram_ids, [usernames[telegram_id] for telegram_id in telegram_ids])
+                await self._bump_stats(conn, total_users=inserted)
+                await self._bump_daily_stats(conn, new_users=inserted)
+
+        # The rows are committed, a cache error must not fail their futures
+        try:
+            for telegram_id in telegram_ids:
+                await self.user_cache.invalidate(telegram_id)
+        except Exception as e:
+            logger.error(f"Error invalidating {len(telegram_ids)} cached users after saving them: {str(e)}")
+        return [True] * len(rows)
 
     async def get_user(self, telegram_id: int):
-        async with self.pool.acquire() as conn:
-            return await conn.fetchrow(
-                'SELECT * FROM users WHERE telegram_id = $1',
-                telegram_id
-            )
+        async with self.acquire('get_user') as conn:
+            return await self._fetch_prepared(conn, 'fetchrow', GET_USER_QUERY, telegram_id)
+
+    async def get_user_cached(self, telegram_id: int):
+        """Get a user through the in-process cache. Missing users are not cached"""
+        user = await self.user_cache.get(telegram_id)
+        self.metrics.record_user_cache(user is not None)
+        if user is None:
+            user = await self.get_user(telegram_id)
+            if user is not None:
+                await self.user_cache.set(telegram_id, user)
+        return user
+
+    def queue_image(self, file_id: str, user_id: int, prompt: str) -> asyncio.Future:
+        """Buffer an image row. The returned future resolves once it is committed"""
+        return self.image_writes.add((file_id, user_id, prompt))
 
     async def add_image(self, file_id: str, user_id: int, prompt: str):
-        async with self.pool.acquire() as conn:
-            return await conn.execute('''
-                INSERT INTO images (file_id, user_id, prompt)
-                VALUES ($1, $2, $3)
-            ''', file_id, user_id, prompt)
-
-    async def get_user_images(self, user_id: int):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch('''
-                SELECT * FROM images 
-                WHERE user_id = $1 
-                ORDER BY created_at DESC
-            ''', user_id)
+        """Save an image and wait until the buffered write is committed"""
+        return await self.queue_image(file_id, user_id, prompt)
 
-    async def search_images_by_prompt(self, prompt: str):
-        async with self.pool.acquire() as conn:
-            return await conn.fetch('''
-                SELECT * FROM images 
-                WHERE prompt ILIKE $1
-                ORDER BY created_at DESC
-            ''', f'%{prompt}%')
+    async def _write_images(self, rows: List[tuple]) -> list:
+        async with self.acquire('add_image') as conn:
+            async with conn.transaction():
+                await conn.copy_records_to_table(
+                    'images',
+                    records=rows,
+                    columns=['file_id', 'user_id', 'prompt']
+                )
+
+                # Returns a row for each user whose first image today is in this batch
+                first_images = await self._fetch_prepared(
+                    conn, 'fetch', MARK_IMAGE_DAY_QUERY, sorted({row[1] for row in rows})
+                )
+
+                await self._bump_stats(
+                    conn,
+                    total_images=len(rows),
+                    active_users=sum(1 for row in first_images if row['ever'])
+                )
+                await self._bump_daily_stats(conn, images=len(rows), active_users=len(first_images))
+        return [None] * len(rows)
+
+    async def get_user_images_page(self, user_id: int, cursor: Optional[tuple] = None,
+                                   newer: bool = False, limit: int = 10):
+        """Get one page of a user's images, newest first, using keyset pagination.
+
+        `cursor` is the (created_at, id) of the image the page starts after;
+        with `newer` the page goes towards newer images instead of older ones.
+        Returns the images and whether there are more in that direction.
+        """
+        async with self.acquire('get_user_images_page') as conn:
+            if cursor is None:
+                rows = await conn.fetch('''
+                    SELECT * FROM images
+                    WHERE user_id = $1
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $2
+                ''', user_id, limit + 1)
+            elif newer:
+                rows = await conn.fetch('''
+                    SELECT * FROM images
+                    WHERE user_id = $1 AND (created_at, id) > ($2, $3)
+                    ORDER BY created_at ASC, id ASC
+                    LIMIT $4
+                ''', user_id, cursor[0], cursor[1], limit + 1)
+            else:
+                rows = await conn.fetch('''
+                    SELECT * FROM images
+                    WHERE user_id = $1 AND (created_at, id) < ($2, $3)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $4
+                ''', user_id, cursor[0], cursor[1], limit + 1)
+
+            has_more = len(rows) > limit
+            rows = rows[:limit]
+            if newer:
+                rows.reverse()
+            return rows, has_more
+
+    async def search_images_by_prompt(self, query: str, user_id: Optional[int] = None,
+                                      cursor: Optional[tuple] = None, limit: int = 10):
+        """Full-text search over image prompts, best matches first.
+
+        Every word of `query` has to match the start of a word in the prompt.
+        `user_id` limits the search to one user's images, `cursor` is the
+        (rank, id) of the last result of the previous page.
+        Returns the images and whether there are more results.
+        """
+        words = re.findall(r'[^\W_]+', query.lower())
+        if not words:
+            return [], False
+        ts_query = ' & '.join(f'{word}:*' for word in words)
+
+        async with self.acquire('search_images_by_prompt') as conn:
+            rows = await conn.fetch('''
+                SELECT * FROM (
+                    SELECT images.*, ts_rank(to_tsvector('simple', prompt), query) AS rank
+                    FROM images, to_tsquery('simple', $1) AS query
+                    WHERE to_tsvector('simple', prompt) @@ query
+                    AND ($2::int IS NULL OR user_id = $2)
+                ) found
+                WHERE $3::real IS NULL OR (rank, id) < ($3::real, $4::int)
+                ORDER BY rank DESC, id DESC
+                LIMIT $5
+            ''', ts_query, user_id, cursor[0] if cursor else None, cursor[1] if cursor else None, limit + 1)
+            return rows[:limit], len(rows) > limit
 
     async def set_admin(self, telegram_id: int, is_admin: bool = True):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('set_admin') as conn:
             try:
-                await conn.execute('''
-                    UPDATE users 
-                    SET is_admin = $2 
-                    WHERE telegram_id = $1
-                ''', telegram_id, is_admin)
+                async with conn.transaction():
+                    changed = await conn.fetchval('''
+                        UPDATE users 
+                        SET is_admin = $2 
+                        WHERE telegram_id = $1 AND COALESCE(is_admin, FALSE) <> $2
+                        RETURNING id
+                    ''', telegram_id, is_admin)
+                    if changed:
+                        await self._bump_stats(conn, admin_count=1 if is_admin else -1)
+                await self.user_cache.invalidate(telegram_id)
                 return True
             except Exception as e:
                 print(f"Error setting admin status: {e}")
                 return False
 
+    async def set_fresh_generations(self, telegram_id: int, fresh: bool):
+        async with self.acquire('set_fresh_generations') as conn:
+            await conn.execute('''
+                UPDATE users 
+                SET fresh_generations = $2 
+                WHERE telegram_id = $1
+            ''', telegram_id, fresh)
+        await self.user_cache.invalidate(telegram_id)
+
     async def get_user_by_username(self, username: str):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_user_by_username') as conn:
             return await conn.fetchrow('''
                 SELECT * FROM users 
                 WHERE username = $1
             ''', username)
 
     async def get_all_admins(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_all_admins') as conn:
             return await conn.fetch('''
                 SELECT * FROM users 
                 WHERE is_admin = TRUE 
@@ -126,7 +542,7 @@ class Database:
             ''')
 
     async def get_admins(self):
-        async with self.pool.acquire() as conn:
+        async with self.acquire('get_admins') as conn:
             return await conn.fetch('''
                 SELECT * FROM users 
                 WHERE is_admin = TRUE 
@@ -134,88 +550,188 @@ class Database:
             ''')
 
     async def toggle_user_block(self, telegram_id: int, block_status: bool):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE users 
-                SET is_blocked = $2 
-                WHERE telegram_id = $1
-            ''', telegram_id, block_status)
-
-    async def is_user_blocked(self, telegram_id: int) -> bool:
-        async with self.pool.acquire() as conn:
-            result = await conn.fetchval('''
-                SELECT is_blocked FROM users 
-                WHERE telegram_id = $1
-            ''', telegram_id)
-            return result or False
+        await self.set_blocked(telegram_id, block_status)
 
     async def set_blocked(self, telegram_id: int, is_blocked: bool):
-        async with self.pool.acquire() as conn:
-            await conn.execute('''
-                UPDATE users 
-                SET is_blocked = $2 
-                WHERE telegram_id = $1
-            ''', telegram_id, is_blocked)
+        async with self.acquire('set_blocked') as conn:
+            async with conn.transaction():
+                changed = await conn.fetchval('''
+                    UPDATE users 
+                    SET is_blocked = $2 
+                    WHERE telegram_id = $1 AND COALESCE(is_blocked, FALSE) <> $2
+                    RETURNING id
+                ''', telegram_id, is_blocked)
+                if changed:
+                    await self._bump_stats(conn, blocked_users=1 if is_blocked else -1)
+        await self.user_cache.invalidate(telegram_id)
 
     async def get_stats(self):
-        async with self.pool.acquire() as conn:
-            stats = {}
-            
-            # Total users
-            stats['total_users'] = await conn.fetchval(
-                'SELECT COUNT(*) FROM users'
-            )
-            
-            # Active users (who have generated images)
-            stats['active_users'] = await conn.fetchval(
-                'SELECT COUNT(DISTINCT user_id) FROM images'
-            )
-            
-            # Total images
-            stats['total_images'] = await conn.fetchval(
-                'SELECT COUNT(*) FROM images'
-            )
-            
-            # Images created today
-            stats['images_today'] = await conn.fetchval('''
-                SELECT COUNT(*) FROM images 
-                WHERE DATE(created_at) = CURRENT_DATE
-            ''')
-            
-            # Blocked users
-            stats['blocked_users'] = await conn.fetchval(
-                'SELECT COUNT(*) FROM users WHERE is_blocked = TRUE'
-            )
-            
-            # Admin count
-            stats['admin_count'] = await conn.fetchval(
-                'SELECT COUNT(*) FROM users WHERE is_admin = TRUE'
-            )
-            
+        """Read the counters kept up to date by the write methods, cached for STATS_CACHE_TTL"""
+        stats = self.stats_cache.get('stats')
+        if stats is not None:
             return stats
 
-    async def get_users_paginated(self, offset: int = 0, limit: int = 25):
-        async with self.pool.acquire() as conn:
-            # Get total count
-            total_count = await conn.fetchval('SELECT COUNT(*) FROM users')
-            
-            # Get users for current page
-            users = await conn.fetch('''
-                SELECT * FROM users 
-                ORDER BY created_at DESC
-                LIMIT $1 OFFSET $2
-            ''', limit, offset)
-            
-            return users, total_count
-
-    async def get_all_users(self):
-        """Get all users from the database"""
-        async with self.pool.acquire() as conn:
-            users = await conn.fetch("""
-                SELECT telegram_id, username, is_admin, is_blocked 
-                FROM users 
-                ORDER BY created_at DESC
-            """)
-            return users
+        async with self.acquire('get_stats') as conn:
+            rows = await conn.fetch('''
+                SELECT name, SUM(value) AS value FROM stats_totals GROUP BY name
+                UNION ALL
+                SELECT 'images_today', SUM(value) FROM stats_daily
+                WHERE day = CURRENT_DATE AND name = 'images'
+            ''')
+
+        stats = dict.fromkeys(
+            ('total_users', 'active_users', 'total_images', 'images_today', 'blocked_users', 'admin_count'), 0
+        )
+        stats.update((row['name'], int(row['value'] or 0)) for row in rows)
+        self.stats_cache.set('stats', stats)
+        return stats
+
+    async def get_daily_stats(self, days: int = 7):
+        """Get new users, images and active users per day for the last `days` days, oldest first"""
+        async with self.acquire('get_daily_stats') as conn:
+            rows = await conn.fetch('''
+                SELECT day,
+                       COALESCE(SUM(value) FILTER (WHERE name = 'new_users'), 0)::bigint AS new_users,
+                       COALESCE(SUM(value) FILTER (WHERE name = 'images'), 0)::bigint AS images,
+                       COALESCE(SUM(value) FILTER (WHERE name = 'active_users'), 0)::bigint AS active_users
+                FROM (
+                    SELECT generate_series(CURRENT_DATE - ($1::int - 1), CURRENT_DATE, INTERVAL '1 day')::date AS day
+                ) days
+                LEFT JOIN stats_daily USING (day)
+                GROUP BY day
+                ORDER BY day ASC
+            ''', days)
+            return rows
+
+    async def add_job(self, telegram_id: int, chat_id: int, prompt: str,
+                      message_id: Optional[int] = None, status_message_id: Optional[int] = None,
+                      owner: Optional[str] = None) -> int:
+        async with self.acquire('add_job') as conn:
+            return await conn.fetchval('''
+                INSERT INTO jobs (telegram_id, chat_id, prompt, message_id, status_message_id, owner)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                RETURNING id
+            ''', telegram_id, chat_id, prompt, message_id, status_message_id, owner)
+
+    async def update_job(self, job_id: int, status: str, generation_id: Optional[str] = None,
+                         error: Optional[str] = None):
+        async with self.acquire('update_job') as conn:
+            await conn.execute('''
+                UPDATE jobs
+                SET status = $2,
+                    generation_id = COALESCE($3, generation_id),
+                    error = COALESCE($4, error),
+                    updated_at = NOW()
+                WHERE id = $1
+            ''', job_id, status, generation_id, error)
+
+    async def set_job_owner(self, job_id: int, owner: str):
+        async with self.acquire('set_job_owner') as conn:
+            await conn.execute('UPDATE jobs SET owner = $2 WHERE id = $1', job_id, owner)
+
+    async def heartbeat_job_owner(self, owner: str) -> datetime:
+        """Record that `owner` is alive and return the time of the heartbeat"""
+        async with self.acquire('heartbeat_job_owner') as conn:
+            return await conn.fetchval('''
+                INSERT INTO job_owners (owner) VALUES ($1)
+                ON CONFLICT (owner) DO UPDATE SET heartbeat_at = NOW()
+                RETURNING heartbeat_at
+            ''', owner)
+
+    async def remove_job_owner(self, owner: str):
+        async with self.acquire('remove_job_owner') as conn:
+            await conn.execute('DELETE FROM job_owners WHERE owner = $1', owner)
+
+    async def take_over_jobs(self, owner: str, new_owner: str, ttl: float, own_before: Optional[datetime] = None,
+                             after_id: int = 0, limit: int = 100):
+        """Hand a batch of unfinished jobs whose owner is gone to `new_owner`, ordered by id.
+
+        A job's owner is gone when it has not sent a heartbeat for `ttl`
+        seconds. With `own_before`, jobs of `owner` itself last updated before
+        then are taken too, as they were left by its previous run. Jobs waiting
+        in the shared queue are never taken. `age` is the seconds since the job
+        was last updated, by the database's clock.
+        """
+        async with self.acquire('take_over_jobs') as conn:
+            rows = await conn.fetch('''
+                WITH orphaned AS (
+                    SELECT id FROM jobs
+                    WHERE status NOT IN ('delivered', 'failed') AND id > $1
+                    AND owner IS DISTINCT FROM $2
+                    AND (owner IS NULL OR (owner = $4 AND updated_at < $3) OR owner NOT IN (
+                        SELECT owner FROM job_owners WHERE heartbeat_at > NOW() - make_interval(secs => $5)
+                    ))
+                    ORDER BY id ASC
+                    LIMIT $6
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE jobs SET owner = $7
+                FROM orphaned
+                WHERE jobs.id = orphaned.id
+                RETURNING jobs.*, EXTRACT(EPOCH FROM NOW() - jobs.updated_at)::float AS age
+            ''', after_id, SHARED_QUEUE_OWNER, own_before, owner, float(ttl), limit, new_owner)
+        return sorted(rows, key=lambda row: row['id'])
+
+    async def get_users_paginated(self, cursor: Optional[tuple] = None, newer: bool = False, limit: int = 25):
+        """Get one page of users, newest first, using keyset pagination.
+
+        `cursor` and `newer` work as in get_user_images_page. Returns the users,
+        whether there are more in that direction and the total user count,
+        which comes from the stats counters instead of COUNT(*).
+        """
+        async with self.acquire('get_users_paginated') as conn:
+            if cursor is None:
+                users = await conn.fetch('''
+                    SELECT * FROM users
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $1
+                ''', limit + 1)
+            elif newer:
+                users = await conn.fetch('''
+                    SELECT * FROM users
+                    WHERE (created_at, id) > ($1, $2)
+                    ORDER BY created_at ASC, id ASC
+                    LIMIT $3
+                ''', cursor[0], cursor[1], limit + 1)
+            else:
+                users = await conn.fetch('''
+                    SELECT * FROM users
+                    WHERE (created_at, id) < ($1, $2)
+                    ORDER BY created_at DESC, id DESC
+                    LIMIT $3
+                ''', cursor[0], cursor[1], limit + 1)
+
+        has_more = len(users) > limit
+        users = users[:limit]
+        if newer:
+            users.reverse()
+        stats = await self.get_stats()
+        return users, has_more, stats['total_users']
+
+    async def iter_users(self, batch_size: int = 1000):
+        """Yield every user, oldest first, through a server-side cursor.
+
+        Only `batch_size` rows are held in memory at a time. The connection is
+        kept until the generator is exhausted or closed.
+        """
+        async with self.acquire('iter_users') as conn:
+            async with conn.transaction(readonly=True):
+                async for user in conn.cursor('''
+                    SELECT telegram_id, username, is_admin, is_blocked, fresh_generations, created_at
+                    FROM users
+                    ORDER BY id ASC
+                ''', prefetch=batch_size):
+                    yield user
 
 db = Database()
+
+CallbackMetric('imagebot_db_pool_connections', "Open pool connections", lambda: db.pool_stats()['size'])
+CallbackMetric('imagebot_db_pool_in_use', "Pool connections in use", lambda: db.pool_stats()['in_use'])
+CallbackMetric(
+    'imagebot_db_acquire_timeouts_total', "Pool acquires that timed out",
+    lambda: db.metrics.acquire_timeouts, type='counter'
+)
+CallbackMetric(
+    'imagebot_db_buffered_writes', "Rows waiting in the write buffers",
+    lambda: {('users',): len(db.user_writes), ('images',): len(db.image_writes)}, labelnames=['table']
+)
@@ -0,0 +1,445 @@
+import os
+import time
+import socket
+import asyncio
+import logging
+import traceback
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from database import db, SHARED_QUEUE_OWNER
+from cache import prompt_key
+from leonardo import (leonardo, generation_governor, LeonardoError, LEONARDO_WIDTH, LEONARDO_HEIGHT,
+                      LEONARDO_NUM_IMAGES, LEONARDO_MODEL_ID)
+from poller import poller
+from metrics import Counter, Histogram
+from logs import set_log_context
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_WORKER_CONCURRENCY = int(os.getenv("JOB_WORKER_CONCURRENCY", "25"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_RESUME_BATCH_SIZE = int(os.getenv("JOB_RESUME_BATCH_SIZE", "100"))
+JOB_RESUME_BATCH_DELAY = float(os.getenv("JOB_RESUME_BATCH_DELAY", "1"))
+# Set to false on processes that should leave unfinished jobs to another one
+JOB_RESUME_ON_START = os.getenv("JOB_RESUME_ON_START", "true").lower() in ('1', 'true', 'yes')
+# Names this instance in jobs.owner, so it has to differ between running
+# instances. The default stays the same across restarts, so a restarted
+# instance takes its own unfinished jobs back right away
+JOB_OWNER_ID = os.getenv("JOB_OWNER_ID") or socket.gethostname()
+# An instance without a heartbeat for this long has its unfinished jobs taken
+# over, and its in-flight markers in Redis expire
+JOB_OWNER_TTL = int(os.getenv("JOB_OWNER_TTL", "900"))
+JOB_OWNER_HEARTBEAT = float(os.getenv("JOB_OWNER_HEARTBEAT", "60"))
+
+JOB_DELIVERY_SECONDS = Histogram(
+    'imagebot_job_delivery_seconds', "Time from queueing a generation job to delivering its image", ['shared']
+)
+JOB_SLOT_WAIT_SECONDS = Histogram('imagebot_job_slot_wait_seconds', "Time a job waited for a Leonardo generation slot")
+JOBS_FINISHED = Counter('imagebot_jobs_finished_total', "Generation jobs by final status", ['status'])
+
+
+class JobStatus:
+    QUEUED = 'queued'
+    SUBMITTED = 'submitted'
+    POLLING = 'polling'
+    DOWNLOADING = 'downloading'
+    DELIVERED = 'delivered'
+    FAILED = 'failed'
+
+
+@dataclass
+class GenerationJob:
+    user_id: int
+    chat_id: int
+    prompt: str
+    message_id: Optional[int] = None
+    status_message_id: Optional[int] = None
+    status: str = JobStatus.QUEUED
+    generation_id: Optional[str] = None
+    image_url: Optional[str] = None
+    error: Optional[str] = None
+    created_at: datetime = field(default_factory=datetime.now)
+    id: Optional[int] = None
+    width: int = LEONARDO_WIDTH
+    height: int = LEONARDO_HEIGHT
+    num_images: int = LEONARDO_NUM_IMAGES
+    model_id: Optional[str] = LEONARDO_MODEL_ID
+    # Seconds spent waiting for a free Leonardo generation slot
+    slot_wait: float = 0.0
+    # When the generation was submitted to Leonardo
+    submitted_at: Optional[datetime] = None
+
+    @property
+    def cache_key(self) -> tuple:
+        return prompt_key(self.prompt, self.width, self.height, self.num_images, self.model_id)
+
+    @classmethod
+    def from_record(cls, record) -> 'GenerationJob':
+        return cls(
+            user_id=record['telegram_id'],
+            chat_id=record['chat_id'],
+            prompt=record['prompt'],
+            message_id=record['message_id'],
+            status_message_id=record['status_message_id'],
+            status=record['status'],
+            generation_id=record['generation_id'],
+            error=record['error'],
+            created_at=record['created_at'],
+            id=record['id'],
+            # Close to the submit: the generation id is recorded right after it. The
+            # age is computed by the database, whose clock may not match this host's
+            submitted_at=datetime.now() - timedelta(seconds=record['age']) if record['generation_id'] else None
+        )
+
+    def to_dict(self) -> dict:
+        data = asdict(self)
+        data['created_at'] = self.created_at.isoformat()
+        if self.submitted_at:
+            data['submitted_at'] = self.submitted_at.isoformat()
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'GenerationJob':
+        data = dict(data, created_at=datetime.fromisoformat(data['created_at']))
+        if data.get('submitted_at'):
+            data['submitted_at'] = datetime.fromisoformat(data['submitted_at'])
+        return cls(**data)
+
+    def submitted_monotonic(self) -> Optional[float]:
+        """submitted_at as a time.monotonic() value, for the poller"""
+        if self.submitted_at is None:
+            return None
+        return time.monotonic() - max(0.0, (datetime.now() - self.submitted_at).total_seconds())
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class LocalJobBackend:
+    """Queue and in-flight bookkeeping for a single process.
+
+    The Redis backend in redis_store.py implements the same methods so that
+    several bot instances can share one queue.
+    """
+
+    # Queued jobs live in this process and are lost with it
+    shared = False
+
+    def __init__(self, max_size: int = JOB_QUEUE_SIZE):
+        self.max_size = max_size
+        self.queue: Optional[asyncio.Queue] = None
+        # Owner job id of every generation in flight, keyed by GenerationJob.cache_key
+        self._owners: Dict[tuple, int] = {}
+        # Jobs with the same prompt that wait for the owner job's generation
+        self._followers: Dict[int, List[GenerationJob]] = {}
+
+    async def start(self):
+        self.queue = asyncio.Queue(maxsize=self.max_size)
+
+    async def size(self) -> int:
+        return self.queue.qsize()
+
+    async def is_full(self) -> bool:
+        return self.queue.full()
+
+    async def put(self, job: GenerationJob) -> int:
+        try:
+            self.queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise QueueFullError("Generation queue is full")
+        return self.queue.qsize()
+
+    async def put_wait(self, job: GenerationJob):
+        await self.queue.put(job)
+
+    async def get(self) -> GenerationJob:
+        return await self.queue.get()
+
+    def task_done(self):
+        self.queue.task_done()
+
+    async def has_owner(self, job: GenerationJob) -> bool:
+        return job.cache_key in self._owners
+
+    async def attach(self, job: GenerationJob) -> Optional[int]:
+        owner_id = self._owners.get(job.cache_key)
+        if owner_id is not None:
+            self._followers.setdefault(owner_id, []).append(job)
+        return owner_id
+
+    async def claim(self, job: GenerationJob):
+        self._owners.setdefault(job.cache_key, job.id)
+
+    async def release(self, job: GenerationJob) -> List[GenerationJob]:
+        if self._owners.get(job.cache_key) == job.id:
+            del self._owners[job.cache_key]
+        return self._followers.pop(job.id, [])
+
+
+class JobQueue:
+    """Bounded queue of generation jobs consumed by a pool of async workers.
+
+    Each worker keeps up to `concurrency` jobs in flight, so the total number
+    of generations running at once is `workers * concurrency`.
+
+    Every job row records its owner, the instance that holds it: `owner` for
+    jobs in a local queue or being run, SHARED_QUEUE_OWNER for jobs waiting in
+    a shared one. Instances send heartbeats, and resume() takes over only the
+    jobs of owners that stopped sending them.
+    """
+
+    def __init__(self,
+                 deliver: Callable[[GenerationJob, str], Awaitable[str]],
+                 share: Callable[[GenerationJob, str], Awaitable[None]],
+                 fail: Callable[[GenerationJob, str], Awaitable[None]],
+                 wait: Optional[Callable[[GenerationJob, float], Awaitable[None]]] = None,
+                 workers: int = JOB_WORKERS,
+                 concurrency: int = JOB_WORKER_CONCURRENCY,
+                 backend=None,
+                 owner: str = JOB_OWNER_ID):
+        self.deliver = deliver
+        self.share = share
+        self.fail = fail
+        self.wait = wait
+        self.workers = workers
+        self.concurrency = concurrency
+        self.backend = backend or LocalJobBackend()
+        self.owner = owner
+        self._workers = []
+        self._running = set()
+        self._resume_task: Optional[asyncio.Task] = None
+        self._heartbeat_task: Optional[asyncio.Task] = None
+        # Database time of the first heartbeat; jobs of this owner older than
+        # that were left by its previous run
+        self._started_at: Optional[datetime] = None
+
+    @property
+    def queue_owner(self) -> str:
+        """Owner recorded for a job while it waits in the queue"""
+        return SHARED_QUEUE_OWNER if self.backend.shared else self.owner
+
+    async def start(self):
+        await self.backend.start()
+        self._started_at = await db.heartbeat_job_owner(self.owner)
+        self._heartbeat_task = asyncio.create_task(self._heartbeat())
+        self._workers = [
+            asyncio.create_task(self._worker(n)) for n in range(self.workers)
+        ]
+        logger.info(f"Started {self.workers} generation workers as job owner {self.owner}")
+
+    async def stop(self):
+        tasks = [task for task in (self._resume_task, self._heartbeat_task) if task]
+        for task in tasks + self._workers + list(self._running):
+            task.cancel()
+        await asyncio.gather(*tasks, *self._workers, *self._running, return_exceptions=True)
+        self._resume_task = self._heartbeat_task = None
+        self._workers = []
+        self._running.clear()
+        # The jobs cancelled above can be taken over without waiting for JOB_OWNER_TTL
+        try:
+            await db.remove_job_owner(self.owner)
+        except Exception as e:
+            logger.error(f"Error removing job owner {self.owner}: {str(e)}")
+
+    async def _heartbeat(self, interval: float = JOB_OWNER_HEARTBEAT):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await db.heartbeat_job_owner(self.owner)
+            except Exception as e:
+                logger.error(f"Error sending job owner heartbeat: {str(e)}")
+
+    async def depth(self) -> int:
+        return await self.backend.size()
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._running)
+
+    async def enqueue(self, job: GenerationJob, coalesce: bool = True) -> int:
+        """Persist a new job and add it to the queue.
+
+        Returns the job's position in line (1-based), or 0 if the job was
+        attached to an identical generation that is already in flight.
+        """
+        if not (coalesce and await self.backend.has_owner(job)) and await self.backend.is_full():
+            raise QueueFullError("Generation queue is full")
+
+        job.id = await db.add_job(
+            job.user_id, job.chat_id, job.prompt, job.message_id, job.status_message_id, owner=self.queue_owner
+        )
+
+        # The owner may have finished while the job was being saved, attach() re-checks
+        if coalesce:
+            owner_id = await self.backend.attach(job)
+            if owner_id is not None:
+                logger.info(f"Job {job.id} attached to in-flight job {owner_id}")
+                return 0
+
+        await self.backend.claim(job)
+        try:
+            return await self.backend.put(job)
+        except QueueFullError:
+            await self.backend.release(job)
+            await db.update_job(job.id, JobStatus.FAILED, error="Generation queue is full")
+            raise
+
+    def resume(self):
+        """Re-queue this instance's jobs left unfinished by its previous run, then
+        keep taking over the jobs of instances that stop sending heartbeats"""
+        self._resume_task = asyncio.create_task(self._resume_loop())
+
+    async def _resume_loop(self, interval: float = JOB_OWNER_HEARTBEAT):
+        await self._resume_unfinished(own=True)
+        while True:
+            await asyncio.sleep(interval)
+            await self._resume_unfinished()
+
+    async def _resume_unfinished(self, own: bool = False, batch_size: int = JOB_RESUME_BATCH_SIZE,
+                                 batch_delay: float = JOB_RESUME_BATCH_DELAY):
+        # Jobs are taken over in id order, one batch at a time. put_wait() waits
+        # for free space, so the workers set the pace at which Leonardo is polled.
+        last_id = 0
+        resumed = 0
+        try:
+            while True:
+                records = await db.take_over_jobs(
+                    self.owner, self.queue_owner, JOB_OWNER_TTL, own_before=self._started_at if own else None,
+                    after_id=last_id, limit=batch_size
+                )
+                if not records:
+                    break
+
+                for record in records:
+                    job = GenerationJob.from_record(record)
+                    if job.generation_id or await self.backend.attach(job) is None:
+                        await self.backend.claim(job)
+                        await self.backend.put_wait(job)
+                    resumed += 1
+
+                last_id = records[-1]['id']
+                if len(records) < batch_size:
+                    break
+                await asyncio.sleep(batch_delay)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Error resuming unfinished jobs: {str(e)}\n{traceback.format_exc()}")
+        finally:
+            if resumed or own:
+                logger.info(f"Resumed {resumed} unfinished generation jobs")
+
+    async def _set_status(self, job: GenerationJob, status: str):
+        job.status = status
+        await db.update_job(job.id, status, generation_id=job.generation_id, error=job.error)
+
+    async def _worker(self, number: int):
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            await slots.acquire()
+            try:
+                job = await self.backend.get()
+            except asyncio.CancelledError:
+                slots.release()
+                raise
+
+            task = asyncio.create_task(self._run(job))
+            self._running.add(task)
+
+            def done(task):
+                self._running.discard(task)
+                self.backend.task_done()
+                slots.release()
+
+            task.add_done_callback(done)
+
+    async def _run(self, job: GenerationJob):
+        # Each job runs in its own task, so this only tags the records of this job
+        set_log_context(job_id=job.id, user_id=job.user_id)
+        try:
+            if self.backend.shared:
+                # Taken off the shared queue, the job is this instance's to finish
+                await db.set_job_owner(job.id, self.owner)
+
+            # The slot is held until Leonardo has finished the generation
+            async with generation_governor.slot(on_wait=lambda eta: self._wait(job, eta)) as waited:
+                job.slot_wait = waited
+                JOB_SLOT_WAIT_SECONDS.observe(waited)
+                if waited >= 1:
+                    logger.info(f"Job {job.id} waited {waited:.1f}s for a Leonardo generation slot")
+
+                # A resumed job may already have a generation on Leonardo's side,
+                # a new one is polled as submitted now
+                submitted_at = job.submitted_monotonic()
+                if not job.generation_id:
+                    job.status = JobStatus.SUBMITTED
+                    job.generation_id = await leonardo.create_generation(
+                        job.prompt, job.width, job.height, job.num_images, job.model_id
+                    )
+                    job.submitted_at = datetime.now()
+
+                await self._set_status(job, JobStatus.POLLING)
+                job.image_url = await poller.wait(job.generation_id, submitted_at)
+                if not job.image_url:
+                    raise LeonardoError("No image_url in Leonardo API response")
+
+            await self._set_status(job, JobStatus.DOWNLOADING)
+            file_id = await self.deliver(job, job.image_url)
+            await self._set_status(job, JobStatus.DELIVERED)
+            self._observe_delivery(job, shared=False)
+            logger.info(f"Job {job.id} for user {job.user_id} delivered (generation {job.generation_id})")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if not isinstance(e, LeonardoError):
+                logger.error(f"Error in generation job {job.id}: {str(e)}\n{traceback.format_exc()}")
+            failed_at = job.status
+            followers = await self.backend.release(job)
+            await self._fail(job, str(e))
+            for follower in followers:
+                await self._fail(follower, str(e), failed_at=failed_at)
+            return
+
+        followers = await self.backend.release(job)
+        if followers:
+            await asyncio.gather(*(self._share(follower, file_id) for follower in followers))
+
+    async def _wait(self, job: GenerationJob, estimated_wait: float):
+        if self.wait is None:
+            return
+        try:
+            await self.wait(job, estimated_wait)
+        except Exception as e:
+            logger.error(f"Error reporting wait of job {job.id}: {str(e)}")
+
+    async def _share(self, job: GenerationJob, file_id: str):
+        set_log_context(job_id=job.id, user_id=job.user_id)
+        try:
+            await self.share(job, file_id)
+            await self._set_status(job, JobStatus.DELIVERED)
+            self._observe_delivery(job, shared=True)
+        except Exception as e:
+            logger.error(f"Error delivering shared job {job.id}: {str(e)}\n{traceback.format_exc()}")
+            await self._fail(job, str(e))
+
+    def _observe_delivery(self, job: GenerationJob, shared: bool):
+        JOB_DELIVERY_SECONDS.observe((datetime.now() - job.created_at).total_seconds(), 'true' if shared else 'false')
+        JOBS_FINISHED.inc(JobStatus.DELIVERED)
+
+    async def _fail(self, job: GenerationJob, error: str, failed_at: Optional[str] = None):
+        JOBS_FINISHED.inc(JobStatus.FAILED)
+        job.error = error
+        failed_at = failed_at or job.status
+        try:
+            await self._set_status(job, JobStatus.FAILED)
+            await self.fail(job, failed_at)
+        except Exception as e:
+            logger.error(f"Error reporting failed job {job.id}: {str(e)}\n{traceback.format_exc()}")
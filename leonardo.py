@@ -0,0 +1,430 @@
+import os
+import time
+import random
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Awaitable, Callable, Optional
+
+import aiohttp
+from dotenv import load_dotenv
+
+from metrics import Histogram, CallbackMetric
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+LEONARDO_API_URL = os.getenv("LEONARDO_API_URL", "https://cloud.leonardo.ai/api/rest/v1").rstrip("/")
+
+# HTTP session settings
+LEONARDO_POOL_SIZE = int(os.getenv("LEONARDO_POOL_SIZE", "100"))
+LEONARDO_KEEPALIVE = float(os.getenv("LEONARDO_KEEPALIVE", "30"))
+LEONARDO_CONNECT_TIMEOUT = float(os.getenv("LEONARDO_CONNECT_TIMEOUT", "10"))
+LEONARDO_REQUEST_TIMEOUT = float(os.getenv("LEONARDO_REQUEST_TIMEOUT", "30"))
+LEONARDO_DOWNLOAD_TIMEOUT = float(os.getenv("LEONARDO_DOWNLOAD_TIMEOUT", "60"))
+
+# Retries of rate limited (429) and failed (5xx) requests
+LEONARDO_MAX_RETRIES = int(os.getenv("LEONARDO_MAX_RETRIES", "3"))
+LEONARDO_RETRY_BASE_DELAY = float(os.getenv("LEONARDO_RETRY_BASE_DELAY", "1"))
+LEONARDO_RETRY_MAX_DELAY = float(os.getenv("LEONARDO_RETRY_MAX_DELAY", "30"))
+
+# Circuit breaker: after this many failures in a row requests fail at once,
+# until one trial request succeeds LEONARDO_BREAKER_RESET seconds later
+LEONARDO_BREAKER_THRESHOLD = int(os.getenv("LEONARDO_BREAKER_THRESHOLD", "5"))
+LEONARDO_BREAKER_RESET = float(os.getenv("LEONARDO_BREAKER_RESET", "30"))
+
+# Generations submitted by this process that Leonardo has not finished yet
+LEONARDO_MAX_CONCURRENT_GENERATIONS = int(os.getenv("LEONARDO_MAX_CONCURRENT_GENERATIONS", "10"))
+
+# Statuses worth another try. A POST that got 500, or a 502/504 from a gateway
+# that failed or timed out waiting for Leonardo, may have been processed and
+# billed, so only the answers that say it was not are retried
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+POST_RETRY_STATUSES = {429, 503}
+
+# Streaming image downloads
+IMAGE_CHUNK_SIZE = int(os.getenv("IMAGE_CHUNK_SIZE", str(64 * 1024)))
+IMAGE_MEMORY_BUDGET = int(os.getenv("IMAGE_MEMORY_BUDGET", str(16 * 1024 * 1024)))
+
+# Generation parameters
+LEONARDO_WIDTH = int(os.getenv("LEONARDO_WIDTH", "512"))
+LEONARDO_HEIGHT = int(os.getenv("LEONARDO_HEIGHT", "512"))
+LEONARDO_NUM_IMAGES = int(os.getenv("LEONARDO_NUM_IMAGES", "1"))
+LEONARDO_MODEL_ID = os.getenv("LEONARDO_MODEL_ID") or None
+
+
+# submit, poll, poll_batch and download, retries and waits for the circuit included
+LEONARDO_REQUEST_SECONDS = Histogram(
+    'imagebot_leonardo_request_seconds', "Leonardo API calls by operation", ['operation']
+)
+
+
+class LeonardoError(Exception):
+    def __init__(self, message: str, status: Optional[int] = None):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class ByteBudget:
+    """Caps the number of image bytes buffered at once across all downloads"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self._condition: Optional[asyncio.Condition] = None
+
+    async def acquire(self, size: int):
+        size = min(size, self.limit)
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.used + size <= self.limit)
+            self.used += size
+
+    async def release(self, size: int):
+        size = min(size, self.limit)
+        async with self._condition:
+            self.used -= size
+            self._condition.notify_all()
+
+
+image_budget = ByteBudget(IMAGE_MEMORY_BUDGET)
+
+
+class CircuitOpenError(LeonardoError):
+    pass
+
+
+class CircuitBreaker:
+    """Fails requests fast while the API looks down.
+
+    Opens after `threshold` failures in a row. After `reset_timeout` seconds
+    one trial request is let through, and its result closes the circuit or
+    opens it again.
+    """
+
+    def __init__(self, threshold: int = LEONARDO_BREAKER_THRESHOLD, reset_timeout: float = LEONARDO_BREAKER_RESET):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return 'closed'
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return 'half-open'
+        return 'open'
+
+    def check(self) -> bool:
+        """Raise while the circuit is open; True when the caller got the trial request"""
+        state = self.state
+        if state == 'open' or (state == 'half-open' and self._trial):
+            raise CircuitOpenError("Leonardo API is temporarily unavailable", 503)
+        if state == 'half-open':
+            self._trial = True
+            return True
+        return False
+
+    def release_trial(self):
+        """Let another request try when the trial ended without a result, e.g. on 429 or cancellation"""
+        self._trial = False
+
+    def record_success(self):
+        if self.opened_at is not None:
+            logger.info("Leonardo API is back, closing the circuit")
+        self.failures = 0
+        self.opened_at = None
+        self._trial = False
+
+    def record_failure(self):
+        self.failures += 1
+        self._trial = False
+        if self.opened_at is not None or self.failures >= self.threshold:
+            if self.opened_at is None:
+                logger.error(f"Leonardo API failed {self.failures} times in a row, opening the circuit")
+            self.opened_at = time.monotonic()
+
+
+class GenerationGovernor:
+    """Caps the generations submitted to Leonardo that have not finished yet"""
+
+    def __init__(self, limit: int = LEONARDO_MAX_CONCURRENT_GENERATIONS):
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        # Moving average of how long a generation holds its slot
+        self.hold_time = 15.0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+
+    def estimated_wait(self) -> float:
+        return (self.waiting // self.limit + 1) * self.hold_time
+
+    @asynccontextmanager
+    async def slot(self, on_wait: Optional[Callable[[float], Awaitable[None]]] = None):
+        """Hold a generation slot. Yields the seconds spent waiting for it.
+
+        `on_wait` is called with the estimated wait when no slot is free.
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+
+        started = time.monotonic()
+        if self._semaphore.locked():
+            self.waiting += 1
+            try:
+                if on_wait:
+                    await on_wait(self.estimated_wait())
+                await self._semaphore.acquire()
+            finally:
+                self.waiting -= 1
+        else:
+            await self._semaphore.acquire()
+
+        acquired = time.monotonic()
+        waited = acquired - started
+        if waited > 0:
+            self.waits += 1
+            self.wait_time += waited
+        self.active += 1
+        try:
+            yield waited
+        finally:
+            self.active -= 1
+            self._semaphore.release()
+            self.hold_time = 0.8 * self.hold_time + 0.2 * (time.monotonic() - acquired)
+
+
+generation_governor = GenerationGovernor()
+
+
+def retry_delay(response: Optional[aiohttp.ClientResponse], attempt: int) -> float:
+    """Seconds to wait before the next attempt, from Retry-After or exponential backoff"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if retry_after:
+        try:
+            return min(float(retry_after), LEONARDO_RETRY_MAX_DELAY)
+        except ValueError:
+            try:
+                delay = parsedate_to_datetime(retry_after).timestamp() - time.time()
+                return min(max(delay, 0), LEONARDO_RETRY_MAX_DELAY)
+            except (TypeError, ValueError):
+                pass
+    delay = min(LEONARDO_RETRY_BASE_DELAY * 2 ** attempt, LEONARDO_RETRY_MAX_DELAY)
+    return delay * random.uniform(0.5, 1)
+
+
+class LeonardoClient:
+    def __init__(self):
+        self.session: Optional[aiohttp.ClientSession] = None
+        self.user_id: Optional[str] = None
+        self.breaker = CircuitBreaker()
+        # Set by a 429 with Retry-After, every request waits until then
+        self._paused_until = 0.0
+        self.retries = 0
+
+    async def create_session(self):
+        connector = aiohttp.TCPConnector(
+            limit=LEONARDO_POOL_SIZE,
+            keepalive_timeout=LEONARDO_KEEPALIVE
+        )
+        timeout = aiohttp.ClientTimeout(
+            total=LEONARDO_REQUEST_TIMEOUT,
+            connect=LEONARDO_CONNECT_TIMEOUT
+        )
+        self.session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    async def close(self):
+        if self.session and not self.session.closed:
+            await self.session.close()
+        self.session = None
+
+    async def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            await self.create_session()
+        return self.session
+
+    @asynccontextmanager
+    async def _request(self, method: str, url: str, **kwargs):
+        """Send an API request, retrying 429 and 5xx responses.
+
+        Yields the final response. Rate limited requests wait for Retry-After,
+        and a 429 pauses all other requests of this client for as long.
+        Failures count towards the circuit breaker; 4xx answers do not.
+        """
+        session = await self._get_session()
+        retry_statuses = RETRY_STATUSES if method == 'GET' else POST_RETRY_STATUSES
+        attempt = 0
+        while True:
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            trial = self.breaker.check()
+            try:
+                try:
+                    response = await session.request(method, url, headers=self._headers(), **kwargs)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    self.breaker.record_failure()
+                    # A POST that timed out or was cut off may have been processed
+                    retryable = method == 'GET' or isinstance(e, aiohttp.ClientConnectorError)
+                    if not retryable or attempt >= LEONARDO_MAX_RETRIES:
+                        raise LeonardoError(f"Leonardo API request failed: {e.__class__.__name__}")
+                    delay = retry_delay(None, attempt)
+                    logger.warning(f"Leonardo API {method} failed ({e.__class__.__name__}), retrying in {delay:.1f}s")
+                else:
+                    if response.status not in retry_statuses or attempt >= LEONARDO_MAX_RETRIES:
+                        if response.status >= 500:
+                            self.breaker.record_failure()
+                        else:
+                            self.breaker.record_success()
+                        try:
+                            yield response
+                        finally:
+                            response.release()
+                        return
+
+                    delay = retry_delay(response, attempt)
+                    if response.status == 429:
+                        # Only success or a server error changes the circuit
+                        self._paused_until = max(self._paused_until, time.monotonic() + delay)
+                    else:
+                        self.breaker.record_failure()
+                    response.release()
+                    logger.warning(f"Leonardo API {method} returned {response.status}, retrying in {delay:.1f}s")
+            finally:
+                if trial:
+                    self.breaker.release_trial()
+
+            attempt += 1
+            self.retries += 1
+            await asyncio.sleep(delay)
+
+    def _headers(self) -> dict:
+        api_key = os.getenv("LEONARDO_API_KEY")
+        if not api_key:
+            raise LeonardoError("LEONARDO_API_KEY not found in environment variables")
+        return {
+            "Authorization": f"Bearer {api_key}",
+            "Content-Type": "application/json"
+        }
+
+    async def create_generation(self, prompt: str, width: int = LEONARDO_WIDTH, height: int = LEONARDO_HEIGHT,
+                                num_images: int = LEONARDO_NUM_IMAGES, model_id: Optional[str] = LEONARDO_MODEL_ID) -> str:
+        data = {
+            "prompt": prompt,
+            "num_images": num_images,
+            "width": width,
+            "height": height
+        }
+        if model_id:
+            data["modelId"] = model_id
+
+        logger.info(f"Sending generation request to Leonardo API with prompt: {prompt}")
+        with LEONARDO_REQUEST_SECONDS.time('submit'):
+            async with self._request('POST', f"{LEONARDO_API_URL}/generations", json=data) as response:
+                logger.info(f"Leonardo API generation response status code: {response.status}")
+                if response.status != 200:
+                    text = await response.text()
+                    logger.error(f"Leonardo API error: {response.status} - {text}")
+                    try:
+                        error_message = (await response.json(content_type=None)).get('error', 'Unknown error occurred')
+                    except ValueError:
+                        error_message = 'Unknown error occurred'
+                    raise LeonardoError(error_message, response.status)
+
+                result = await response.json()
+
+        generation_id = result.get('sdGenerationJob', {}).get('generationId')
+        if not generation_id:
+            logger.error("No generationId in response")
+            raise LeonardoError("No generationId in response", response.status)
+        return generation_id
+
+    async def get_generation(self, generation_id: str) -> Optional[dict]:
+        """Return the generations_by_pk object, or None if the status request failed"""
+        with LEONARDO_REQUEST_SECONDS.time('poll'):
+            async with self._request('GET', f"{LEONARDO_API_URL}/generations/{generation_id}") as response:
+                if response.status != 200:
+                    logger.warning(f"Generation status request failed: {response.status}")
+                    return None
+                result = await response.json()
+        return result.get('generations_by_pk') or {}
+
+    async def get_user_id(self) -> str:
+        """Get the id of the Leonardo account that owns the API key"""
+        if self.user_id is None:
+            async with self._request('GET', f"{LEONARDO_API_URL}/me") as response:
+                if response.status != 200:
+                    raise LeonardoError("Failed to get Leonardo user info", response.status)
+                result = await response.json()
+            self.user_id = result['user_details'][0]['user']['id']
+        return self.user_id
+
+    async def get_recent_generations(self, limit: int = 50) -> list:
+        """Get the latest generations of the account with their statuses in one request"""
+        user_id = await self.get_user_id()
+        with LEONARDO_REQUEST_SECONDS.time('poll_batch'):
+            async with self._request(
+                'GET',
+                f"{LEONARDO_API_URL}/generations/user/{user_id}",
+                params={"offset": 0, "limit": limit}
+            ) as response:
+                if response.status != 200:
+                    raise LeonardoError("Failed to list generations", response.status)
+                result = await response.json()
+        return result.get('generations', [])
+
+    @asynccontextmanager
+    async def open_image(self, url: str, chunk_size: int = IMAGE_CHUNK_SIZE):
+        """Open an image download and yield an async iterator over its chunks.
+
+        The response is checked before anything is read, so a failed download
+        raises here instead of in the middle of an upload.
+        """
+        session = await self._get_session()
+        timeout = aiohttp.ClientTimeout(total=LEONARDO_DOWNLOAD_TIMEOUT, connect=LEONARDO_CONNECT_TIMEOUT)
+        # Until the consumer is done, so a streamed upload is included
+        with LEONARDO_REQUEST_SECONDS.time('download'):
+            async with session.get(url, timeout=timeout) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    logger.error(f"Failed to download image: {response.status} - {text}")
+                    raise LeonardoError("Failed to download image", response.status)
+                yield self._iter_chunks(response, chunk_size)
+
+    async def _iter_chunks(self, response: aiohttp.ClientResponse, chunk_size: int) -> AsyncIterator[bytes]:
+        while True:
+            await image_budget.acquire(chunk_size)
+            try:
+                chunk = await response.content.read(chunk_size)
+                if not chunk:
+                    break
+                # The budget is held until the consumer asks for the next chunk
+                yield chunk
+            finally:
+                await image_budget.release(chunk_size)
+
+
+leonardo = LeonardoClient()
+
+CallbackMetric(
+    'imagebot_leonardo_retries_total', "Leonardo API requests sent again after a failure",
+    lambda: leonardo.retries, type='counter'
+)
+CallbackMetric(
+    'imagebot_leonardo_circuit_state', "1 for the current state of the Leonardo circuit breaker",
+    lambda: {(state,): int(leonardo.breaker.state == state) for state in ('closed', 'half-open', 'open')},
+    labelnames=['state']
+)
+CallbackMetric('imagebot_generation_slots_active', "Leonardo generation slots in use", lambda: generation_governor.active)
+CallbackMetric(
+    'imagebot_generation_slots_waiting', "Jobs waiting for a Leonardo generation slot",
+    lambda: generation_governor.waiting
+)
@@ -0,0 +1,214 @@
+import os
+import sys
+import json
+import asyncio
+import contextvars
+import queue
+import random
+import atexit
+import logging
+import traceback
+import logging.handlers
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+from dotenv import load_dotenv
+
+from metrics import CallbackMetric
+
+load_dotenv()
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Empty to log to stderr
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+# json, or text for the old one-line format
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "5"))
+# Longer messages, such as API payloads, are cut to this many characters.
+# Errors are kept whole, their messages carry the traceback
+LOG_MAX_MESSAGE_LENGTH = int(os.getenv("LOG_MAX_MESSAGE_LENGTH", "2000"))
+# Records waiting for the writer thread; when it falls behind, new records are dropped
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))
+# Per-module levels, e.g. "aiogram=WARNING,poller=DEBUG"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# Share of DEBUG and INFO records kept per module, e.g. "poller=0.1,leonardo=0.5".
+# Warnings and errors are always kept
+LOG_SAMPLING = os.getenv("LOG_SAMPLING", "")
+
+TEXT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Fields such as job_id and user_id added to every record logged in this context
+_context: ContextVar[Dict[str, object]] = ContextVar('log_context', default={})
+
+
+def set_log_context(**fields):
+    """Add fields to the records logged from now on in the current task"""
+    _context.set({**_context.get(), **fields})
+
+
+@contextmanager
+def log_context(**fields):
+    """Add fields to the records logged inside the block"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+def start_background_task(coro) -> asyncio.Task:
+    """Start a long-lived task in an empty context.
+
+    A task copies the context it is created in, so one started lazily inside
+    a handler would log with that handler's user_id for as long as it runs.
+    """
+    return contextvars.Context().run(asyncio.create_task, coro)
+
+
+def parse_settings(value: str) -> Dict[str, str]:
+    """"a=1,b.c=2" -> {'a': '1', 'b.c': '2'}"""
+    settings = {}
+    for item in value.split(','):
+        name, _, setting = item.partition('=')
+        if name.strip() and setting.strip():
+            settings[name.strip()] = setting.strip()
+    return settings
+
+
+class SamplingFilter(logging.Filter):
+    """Keeps only a share of the DEBUG and INFO records of the configured modules"""
+
+    def __init__(self, rates: Dict[str, float]):
+        super().__init__()
+        self.rates = rates
+        # Logger name -> rate of the closest configured module
+        self._resolved: Dict[str, float] = {}
+
+    def _rate(self, name: str) -> float:
+        rate = self._resolved.get(name)
+        if rate is None:
+            module = name
+            while module and module not in self.rates:
+                module = module.rpartition('.')[0]
+            rate = self._resolved[name] = self.rates.get(module, 1.0)
+        return rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING or not self.rates:
+            return True
+        rate = self._rate(record.name)
+        return rate >= 1.0 or random.random() < rate
+
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Puts records on a bounded queue without blocking the caller.
+
+    Only what has to happen in the caller runs here: the message is merged
+    with its arguments, anything below ERROR is cut to `max_length`, and the
+    current log context is attached. Formatting and writing are left to the
+    listener thread.
+    """
+
+    def __init__(self, log_queue: queue.Queue, max_length: int = LOG_MAX_MESSAGE_LENGTH):
+        super().__init__(log_queue)
+        self.max_length = max_length
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        message = record.getMessage()
+        if record.levelno < logging.ERROR and len(message) > self.max_length:
+            message = f"{message[:self.max_length]}... [{len(message) - self.max_length} more characters]"
+        if record.exc_info:
+            record.exc_text = ''.join(traceback.format_exception(*record.exc_info))
+        record.msg = message
+        record.args = None
+        record.exc_info = None
+        record.context = _context.get()
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, fields: Optional[dict] = None):
+        super().__init__()
+        # Added to every record, such as the shard of a worker process
+        self.fields = fields or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'process': record.process,
+        }
+        entry.update(self.fields)
+        entry.update(getattr(record, 'context', None) or {})
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        context = getattr(record, 'context', None)
+        if context:
+            line += ' [' + ' '.join(f"{name}={value}" for name, value in context.items()) + ']'
+        return line
+
+
+_handler: Optional[ContextQueueHandler] = None
+_listener: Optional[logging.handlers.QueueListener] = None
+
+
+def setup_logging(filename: str = LOG_FILE, level: str = LOG_LEVEL, format: str = LOG_FORMAT):
+    """Send all logging through a queue to a writer thread. Calling it again does nothing"""
+    global _handler, _listener
+    if _listener is not None:
+        return
+
+    if filename:
+        output = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8'
+        )
+    else:
+        output = logging.StreamHandler(sys.stderr)
+    fields = {'shard': int(os.environ['SHARD_INDEX'])} if os.getenv('SHARD_INDEX') else {}
+    output.setFormatter(JsonFormatter(fields) if format == 'json' else TextFormatter(TEXT_FORMAT))
+
+    _handler = ContextQueueHandler(queue.Queue(LOG_QUEUE_SIZE))
+    sampling = {name: float(rate) for name, rate in parse_settings(LOG_SAMPLING).items()}
+    if sampling:
+        _handler.addFilter(SamplingFilter(sampling))
+    _listener = logging.handlers.QueueListener(_handler.queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    root.handlers = [_handler]
+    for name, module_level in parse_settings(LOG_LEVELS).items():
+        logging.getLogger(name).setLevel(module_level.upper())
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out the queued records and stop the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+CallbackMetric(
+    'imagebot_log_records_dropped_total', "Log records dropped because the writer thread fell behind",
+    lambda: _handler.dropped if _handler else 0, type='counter'
+)
@@ -0,0 +1,194 @@
+import os
+import time
+import math
+import bisect
+import inspect
+import logging
+import traceback
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Optional, Sequence
+
+from aiohttp import web
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+
+# Seconds, from a cached database call up to a slow generation
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def _value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value))
+
+
+class Registry:
+    """Metrics rendered together in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics: Dict[str, 'Metric'] = {}
+
+    def register(self, metric: 'Metric'):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    async def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            try:
+                samples = await metric.samples()
+            except Exception as e:
+                logger.error(f"Error collecting metric {metric.name}: {str(e)}\n{traceback.format_exc()}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+default_registry = Registry()
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 registry: Optional[Registry] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        (registry or default_registry).register(self)
+
+    async def samples(self) -> List[str]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    async def samples(self) -> List[str]:
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_value(value)}"
+                for labels, value in self._values.items()]
+
+
+class Histogram(Metric):
+    """Counts observations per bucket; observe() is one bisect and two additions"""
+
+    type = 'histogram'
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> observations per bucket, the last one for +Inf, then their sum
+        self._values: Dict[tuple, list] = {}
+
+    def observe(self, value: float, *labels):
+        state = self._values.get(labels)
+        if state is None:
+            state = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        """Observe the seconds spent in the block, awaits included"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    async def samples(self) -> List[str]:
+        lines = []
+        names = self.labelnames + ('le',)
+        for labels, state in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(names, labels + (_value(bound),))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_value(state[-1])}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric(Metric):
+    """Reads a value the code already keeps, only when the metrics are scraped.
+
+    `collect` returns a number, or a dict of label values tuple -> number, and
+    may be a coroutine function.
+    """
+
+    def __init__(self, name: str, documentation: str, collect: Callable, type: str = 'gauge',
+                 labelnames: Sequence[str] = (), registry: Optional[Registry] = None):
+        super().__init__(name, documentation, labelnames, registry)
+        self.type = type
+        self.collect = collect
+
+    async def samples(self) -> List[str]:
+        values = self.collect()
+        if inspect.isawaitable(values):
+            values = await values
+        if values is None:
+            return []
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_labels(self.labelnames, labels)} {_value(value)}"
+                for labels, value in values.items()]
+
+
+class MetricsServer:
+    """HTTP endpoint that serves a registry for Prometheus to scrape"""
+
+    def __init__(self, registry: Registry = default_registry, path: str = METRICS_PATH):
+        self.registry = registry
+        self.path = path
+        self.runner: Optional[web.AppRunner] = None
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_get(self.path, self.handle)
+
+    async def start(self, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        app = web.Application()
+        self.setup_routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Metrics server listening on {host}:{port}{self.path}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    async def handle(self, request: web.Request) -> web.Response:
+        body = await self.registry.render()
+        return web.Response(body=body.encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+metrics_server = MetricsServer()
@@ -0,0 +1,262 @@
+import re
+import asyncio
+import logging
+from typing import List, Optional
+
+import asyncpg
+
+logger = logging.getLogger(__name__)
+
+# Any constant works, it only has to be the same for every instance
+MIGRATION_LOCK_ID = 7427301
+# Seconds between attempts to take the lock while another instance migrates
+MIGRATION_LOCK_POLL = 1.0
+
+# Index builds that an interrupted run can leave behind as INVALID
+CONCURRENT_INDEX = re.compile(r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)', re.IGNORECASE)
+
+
+class Migration:
+    def __init__(self, version: int, name: str, statements: List[str], transactional: bool = True):
+        self.version = version
+        self.name = name
+        self.statements = statements
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        self.transactional = transactional
+
+
+def not_null_statements(table: str, column: str) -> List[str]:
+    """SET NOT NULL on a live table without scanning it under an exclusive lock"""
+    constraint = f'{table}_{column}_not_null'
+    return [
+        # Left behind if an earlier run was interrupted
+        f'ALTER TABLE {table} DROP CONSTRAINT IF EXISTS {constraint}',
+        f'ALTER TABLE {table} ADD CONSTRAINT {constraint} CHECK ({column} IS NOT NULL) NOT VALID',
+        f'ALTER TABLE {table} VALIDATE CONSTRAINT {constraint}',
+        f'ALTER TABLE {table} ALTER COLUMN {column} SET NOT NULL',
+        f'ALTER TABLE {table} DROP CONSTRAINT {constraint}',
+    ]
+
+
+# Versions 1-3 match the schema that create_tables used to build, so they are
+# no-ops on existing databases and only get recorded as applied.
+MIGRATIONS = [
+    Migration(1, "create users and images", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT UNIQUE,
+            username VARCHAR(255),
+            is_admin BOOLEAN DEFAULT FALSE,
+            is_blocked BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS images (
+            id SERIAL PRIMARY KEY,
+            file_id VARCHAR(255),
+            user_id INTEGER REFERENCES users(id),
+            prompt TEXT,
+            created_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+    ]),
+    Migration(2, "create jobs", [
+        '''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id SERIAL PRIMARY KEY,
+            telegram_id BIGINT,
+            chat_id BIGINT,
+            prompt TEXT,
+            message_id BIGINT,
+            status_message_id BIGINT,
+            generation_id VARCHAR(64),
+            status VARCHAR(20) DEFAULT 'queued',
+            error TEXT,
+            created_at TIMESTAMP DEFAULT NOW(),
+            updated_at TIMESTAMP DEFAULT NOW()
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS jobs_unfinished_idx ON jobs (id)
+        WHERE status NOT IN ('delivered', 'failed')
+        ''',
+    ]),
+    Migration(3, "add users.fresh_generations", [
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS fresh_generations BOOLEAN DEFAULT FALSE',
+    ]),
+    Migration(4, "index images and users lookups", [
+        # get_user_images_page and COUNT(DISTINCT user_id)
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS images_user_created_idx
+        ON images (user_id, created_at DESC, id DESC)
+        ''',
+        # images created today
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS images_created_at_idx ON images (created_at)',
+        # get_user_by_username
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_username_idx ON users (username)',
+        # get_users_paginated
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_created_at_idx ON users (created_at DESC)',
+        # get_all_admins/get_admins and the admin and blocked counts only touch a few rows
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_admins_idx ON users (id) WHERE is_admin',
+        'CREATE INDEX CONCURRENTLY IF NOT EXISTS users_blocked_idx ON users (id) WHERE is_blocked',
+    ], transactional=False),
+    Migration(5, "full-text index on images.prompt", [
+        # search_images_by_prompt; 'simple' because prompts are not only English
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS images_prompt_fts_idx
+        ON images USING GIN (to_tsvector('simple', prompt))
+        ''',
+    ], transactional=False),
+    Migration(6, "stats counters and daily rollups", [
+        # Each counter is spread over a few slots so concurrent writers do not
+        # all queue up on one row; readers sum the slots
+        '''
+        CREATE TABLE IF NOT EXISTS stats_totals (
+            name VARCHAR(32),
+            slot SMALLINT,
+            value BIGINT DEFAULT 0,
+            PRIMARY KEY (name, slot)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS stats_daily (
+            day DATE,
+            name VARCHAR(32),
+            slot SMALLINT,
+            value BIGINT DEFAULT 0,
+            PRIMARY KEY (day, name, slot)
+        )
+        ''',
+        # Day of the user's latest image, to count active users once per day
+        'ALTER TABLE users ADD COLUMN IF NOT EXISTS last_image_on DATE',
+        '''
+        UPDATE users SET last_image_on = latest.day
+        FROM (SELECT user_id, MAX(created_at)::date AS day FROM images GROUP BY user_id) latest
+        WHERE users.id = latest.user_id
+        ''',
+        '''
+        INSERT INTO stats_totals (name, slot, value)
+        SELECT 'total_users', 0, COUNT(*) FROM users
+        UNION ALL SELECT 'active_users', 0, COUNT(*) FROM users WHERE last_image_on IS NOT NULL
+        UNION ALL SELECT 'total_images', 0, COUNT(*) FROM images
+        UNION ALL SELECT 'blocked_users', 0, COUNT(*) FROM users WHERE is_blocked
+        UNION ALL SELECT 'admin_count', 0, COUNT(*) FROM users WHERE is_admin
+        ON CONFLICT (name, slot) DO NOTHING
+        ''',
+        '''
+        INSERT INTO stats_daily (day, name, slot, value)
+        SELECT created_at::date, 'new_users', 0, COUNT(*) FROM users
+        WHERE created_at IS NOT NULL GROUP BY 1
+        UNION ALL SELECT created_at::date, 'images', 0, COUNT(*) FROM images
+        WHERE created_at IS NOT NULL GROUP BY 1
+        UNION ALL SELECT created_at::date, 'active_users', 0, COUNT(DISTINCT user_id) FROM images
+        WHERE created_at IS NOT NULL GROUP BY 1
+        ON CONFLICT (day, name, slot) DO NOTHING
+        ''',
+    ]),
+    Migration(7, "keyset index for the admin user list", [
+        '''
+        CREATE INDEX CONCURRENTLY IF NOT EXISTS users_created_id_idx
+        ON users (created_at DESC, id DESC)
+        ''',
+        'DROP INDEX CONCURRENTLY IF EXISTS users_created_at_idx',
+    ], transactional=False),
+    Migration(8, "users.created_at and images.created_at not null", [
+        # Keyset pagination compares (created_at, id) and builds cursors from
+        # created_at; rows without one were skipped or broke the cursor.
+        # They are dated at the epoch, so they come last, as the oldest
+        "UPDATE users SET created_at = TIMESTAMP 'epoch' WHERE created_at IS NULL",
+        "UPDATE images SET created_at = TIMESTAMP 'epoch' WHERE created_at IS NULL",
+        # SET NOT NULL alone scans the table under an ACCESS EXCLUSIVE lock. A
+        # validated CHECK lets it skip the scan, and VALIDATE only takes a lock
+        # that does not block writes. Each statement commits on its own for that
+        *not_null_statements('users', 'created_at'),
+        *not_null_statements('images', 'created_at'),
+    ], transactional=False),
+    Migration(9, "job owners", [
+        # The instance holding each unfinished job, see JobQueue
+        'ALTER TABLE jobs ADD COLUMN IF NOT EXISTS owner VARCHAR(255)',
+        '''
+        CREATE TABLE IF NOT EXISTS job_owners (
+            owner VARCHAR(255) PRIMARY KEY,
+            heartbeat_at TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        ''',
+    ]),
+]
+
+
+async def get_applied_versions(conn: asyncpg.Connection) -> set:
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT,
+            applied_at TIMESTAMP DEFAULT NOW()
+        )
+    ''')
+    rows = await conn.fetch('SELECT version FROM schema_migrations')
+    return {row['version'] for row in rows}
+
+
+async def migrate(conn: asyncpg.Connection, target: Optional[int] = None) -> List[int]:
+    """Apply every migration up to `target` (all by default) that is not applied yet.
+
+    A session advisory lock keeps several instances starting at once from
+    running the same migration twice. It is polled rather than waited for:
+    a session blocked in pg_advisory_lock holds a snapshot, and CREATE INDEX
+    CONCURRENTLY in the session holding the lock waits for every older
+    snapshot, so the two would deadlock. Returns the versions that were applied.
+    """
+    applied = []
+    while not await conn.fetchval('SELECT pg_try_advisory_lock($1)', MIGRATION_LOCK_ID):
+        await asyncio.sleep(MIGRATION_LOCK_POLL)
+    try:
+        done = await get_applied_versions(conn)
+        for migration in MIGRATIONS:
+            if migration.version in done or (target is not None and migration.version > target):
+                continue
+
+            logger.info(f"Applying migration {migration.version}: {migration.name}")
+            if migration.transactional:
+                async with conn.transaction():
+                    for statement in migration.statements:
+                        await conn.execute(statement)
+                    await _record(conn, migration)
+            else:
+                for statement in migration.statements:
+                    await _drop_invalid_index(conn, statement)
+                    await conn.execute(statement)
+                await _record(conn, migration)
+            applied.append(migration.version)
+    finally:
+        await conn.execute('SELECT pg_advisory_unlock($1)', MIGRATION_LOCK_ID)
+    return applied
+
+
+async def _record(conn: asyncpg.Connection, migration: Migration):
+    await conn.execute(
+        'INSERT INTO schema_migrations (version, name) VALUES ($1, $2)',
+        migration.version, migration.name
+    )
+
+
+async def _drop_invalid_index(conn: asyncpg.Connection, statement: str):
+    """Drop what an interrupted CREATE INDEX CONCURRENTLY left behind.
+
+    Such an index stays INVALID and is never used, but IF NOT EXISTS would
+    skip it and the migration would be recorded as applied.
+    """
+    match = CONCURRENT_INDEX.search(statement)
+    if not match:
+        return
+    name = match.group(1)
+    valid = await conn.fetchval('''
+        SELECT i.indisvalid FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indexrelid
+        WHERE c.relname = $1 AND c.relnamespace = current_schema()::regnamespace
+    ''', name)
+    if valid is False:
+        logger.warning(f"Index {name} was left invalid by an interrupted build, rebuilding it")
+        await conn.execute(f'DROP INDEX CONCURRENTLY IF EXISTS {name}')
@@ -0,0 +1,249 @@
+import os
+import time
+import heapq
+import itertools
+import random
+import asyncio
+import logging
+import traceback
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+from dotenv import load_dotenv
+
+from leonardo import leonardo
+from metrics import Histogram, CallbackMetric
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Expected time from submit to COMPLETE before any generation has been observed
+POLL_EXPECTED_DURATION = float(os.getenv("POLL_EXPECTED_DURATION", "12"))
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "2"))
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "15"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "1.5"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.2"))
+POLL_TIMEOUT = float(os.getenv("POLL_TIMEOUT", "300"))
+POLL_MAX_CONCURRENT_CHECKS = int(os.getenv("POLL_MAX_CONCURRENT_CHECKS", "20"))
+# With this many generations due at once, one list request replaces the per-id requests
+POLL_BATCH_THRESHOLD = int(os.getenv("POLL_BATCH_THRESHOLD", "5"))
+POLL_BATCH_LIMIT = int(os.getenv("POLL_BATCH_LIMIT", "50"))
+
+# When completion callbacks are enabled, polling only starts after this grace period
+LEONARDO_CALLBACK_ENABLED = os.getenv("LEONARDO_CALLBACK_ENABLED", "false").lower() in ("1", "true", "yes")
+LEONARDO_CALLBACK_GRACE = float(os.getenv("LEONARDO_CALLBACK_GRACE", "60"))
+# How many callbacks that arrive before anyone waits for the generation are
+# kept; the oldest are dropped first
+EARLY_RESULTS_SIZE = 1000
+
+# Weight of the newest sample in the moving average of completion times
+DURATION_SMOOTHING = 0.2
+
+GENERATION_SECONDS = Histogram('imagebot_generation_seconds', "Time from submit to a COMPLETE generation")
+
+
+def extract_image_url(generation: dict) -> Optional[str]:
+    images = generation.get('generated_images') or []
+    return images[0].get('url') if images else None
+
+
+class _PendingGeneration:
+    def __init__(self, generation_id: str, future: asyncio.Future, submitted_at: float, resumed: bool = False):
+        self.generation_id = generation_id
+        self.future = future
+        self.submitted_at = submitted_at
+        # Submitted before a restart, so its completion time includes the downtime
+        self.resumed = resumed
+        self.attempts = 0
+
+
+class GenerationPoller:
+    """Polls the status of all pending generations from a single timer loop.
+
+    The first check is scheduled from the moving average of completion times,
+    later checks back off exponentially with jitter so that polls for
+    generations submitted together do not line up.
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, _PendingGeneration] = {}
+        self._schedule: List[tuple] = []
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._running = set()
+        self._sequence = itertools.count()
+        self._checks: Optional[asyncio.Semaphore] = None
+        self._early_results: OrderedDict = OrderedDict()
+        self.expected_duration = POLL_EXPECTED_DURATION
+        self.callback_mode = LEONARDO_CALLBACK_ENABLED
+        self.api_calls = 0
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._checks = asyncio.Semaphore(POLL_MAX_CONCURRENT_CHECKS)
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for task in list(self._running):
+            task.cancel()
+        await asyncio.gather(*self._running, return_exceptions=True)
+        for pending in self._pending.values():
+            if not pending.future.done():
+                pending.future.cancel()
+        self._pending.clear()
+        self._schedule.clear()
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def wait(self, generation_id: str, submitted_at: Optional[float] = None) -> Optional[str]:
+        """Wait until the generation completes and return the first image URL.
+
+        `submitted_at` is only given for a resumed job: the time.monotonic() of
+        its submit before the restart. POLL_TIMEOUT counts from it, but its
+        completion time is not sampled into the expected duration.
+        """
+        if generation_id in self._early_results:
+            return self._early_results.pop(generation_id)
+
+        pending = self._pending.get(generation_id)
+        if pending is None:
+            future = asyncio.get_running_loop().create_future()
+            pending = _PendingGeneration(
+                generation_id, future, submitted_at or time.monotonic(), resumed=submitted_at is not None
+            )
+            self._pending[generation_id] = pending
+            self._reschedule(pending, self._first_delay())
+        return await asyncio.shield(pending.future)
+
+    def complete(self, generation_id: str, status: str, image_url: Optional[str] = None):
+        """Resolve a generation from a completion callback instead of polling"""
+        result = image_url if status == 'COMPLETE' else None
+        pending = self._pending.get(generation_id)
+        if pending is None:
+            self._early_results[generation_id] = result
+            while len(self._early_results) > EARLY_RESULTS_SIZE:
+                self._early_results.popitem(last=False)
+            return
+
+        if status == 'COMPLETE':
+            self._observe_duration(pending)
+        else:
+            logger.error(f"Generation {generation_id} failed")
+        self._resolve(pending, result)
+
+    def _first_delay(self) -> float:
+        delay = min(POLL_MAX_INTERVAL, max(POLL_MIN_INTERVAL, self.expected_duration * 0.8))
+        if self.callback_mode:
+            # Polling is only a fallback for callbacks that never arrive
+            delay = max(delay, LEONARDO_CALLBACK_GRACE)
+        return delay
+
+    def _next_delay(self, pending: _PendingGeneration) -> float:
+        delay = POLL_MIN_INTERVAL * (POLL_BACKOFF_FACTOR ** pending.attempts)
+        return min(POLL_MAX_INTERVAL, delay)
+
+    def _reschedule(self, pending: _PendingGeneration, delay: float):
+        delay *= random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        due = time.monotonic() + delay
+        wake = not self._schedule or due < self._schedule[0][0]
+        heapq.heappush(self._schedule, (due, next(self._sequence), pending.generation_id))
+        if wake and self._wakeup:
+            self._wakeup.set()
+
+    def _resolve(self, pending: _PendingGeneration, image_url: Optional[str]):
+        self._pending.pop(pending.generation_id, None)
+        if not pending.future.done():
+            pending.future.set_result(image_url)
+
+    def _observe_duration(self, pending: _PendingGeneration):
+        if pending.resumed:
+            return
+        # One generation that hung until it completed must not push out every first poll
+        duration = min(POLL_TIMEOUT, time.monotonic() - pending.submitted_at)
+        GENERATION_SECONDS.observe(duration)
+        self.expected_duration += DURATION_SMOOTHING * (duration - self.expected_duration)
+
+    async def _loop(self):
+        while True:
+            try:
+                self._wakeup.clear()
+                if not self._schedule:
+                    await self._wakeup.wait()
+                    continue
+
+                delay = self._schedule[0][0] - time.monotonic()
+                if delay > 0:
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+                        continue
+                    except asyncio.TimeoutError:
+                        pass
+
+                now = time.monotonic()
+                due = []
+                while self._schedule and self._schedule[0][0] <= now:
+                    _, _, generation_id = heapq.heappop(self._schedule)
+                    pending = self._pending.get(generation_id)
+                    if pending is not None and not pending.future.done():
+                        due.append(pending)
+
+                if due:
+                    task = asyncio.create_task(self._check(due))
+                    self._running.add(task)
+                    task.add_done_callback(self._running.discard)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in generation poller: {str(e)}\n{traceback.format_exc()}")
+                await asyncio.sleep(POLL_MIN_INTERVAL)
+
+    async def _check(self, due: List[_PendingGeneration]):
+        generations = {}
+        if len(due) >= POLL_BATCH_THRESHOLD:
+            try:
+                self.api_calls += 1
+                for generation in await leonardo.get_recent_generations(POLL_BATCH_LIMIT):
+                    generations[generation.get('id')] = generation
+            except Exception as e:
+                logger.warning(f"Batched generation status request failed: {str(e)}")
+
+        async def check_one(pending: _PendingGeneration):
+            generation = generations.get(pending.generation_id)
+            if generation is None:
+                async with self._checks:
+                    self.api_calls += 1
+                    try:
+                        generation = await leonardo.get_generation(pending.generation_id)
+                    except Exception as e:
+                        logger.warning(f"Generation status request failed: {str(e)}")
+            self._update(pending, generation)
+
+        await asyncio.gather(*(check_one(pending) for pending in due))
+
+    def _update(self, pending: _PendingGeneration, generation: Optional[dict]):
+        pending.attempts += 1
+        status = generation.get('status') if generation else None
+
+        if status == 'COMPLETE':
+            self._observe_duration(pending)
+            self._resolve(pending, extract_image_url(generation))
+        elif status == 'FAILED':
+            logger.error(f"Generation {pending.generation_id} failed")
+            self._resolve(pending, None)
+        elif time.monotonic() - pending.submitted_at >= POLL_TIMEOUT:
+            logger.error(f"Generation {pending.generation_id} timed out")
+            self._resolve(pending, None)
+        else:
+            self._reschedule(pending, self._next_delay(pending))
+
+
+poller = GenerationPoller()
+
+CallbackMetric('imagebot_generations_pending', "Generations waiting for their result", lambda: poller.pending_count)
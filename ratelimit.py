@@ -0,0 +1,90 @@
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Token buckets: up to *_BURST requests at once, refilled at *_PER_MINUTE.
+# A rate of 0 disables that bucket
+RATE_LIMIT_USER_BURST = float(os.getenv("RATE_LIMIT_USER_BURST", "3"))
+RATE_LIMIT_USER_PER_MINUTE = float(os.getenv("RATE_LIMIT_USER_PER_MINUTE", "5"))
+RATE_LIMIT_ADMIN_BURST = float(os.getenv("RATE_LIMIT_ADMIN_BURST", "10"))
+RATE_LIMIT_ADMIN_PER_MINUTE = float(os.getenv("RATE_LIMIT_ADMIN_PER_MINUTE", "30"))
+RATE_LIMIT_GLOBAL_BURST = float(os.getenv("RATE_LIMIT_GLOBAL_BURST", "50"))
+RATE_LIMIT_GLOBAL_PER_MINUTE = float(os.getenv("RATE_LIMIT_GLOBAL_PER_MINUTE", "300"))
+# Buckets kept by LocalRateLimiter; the least recently used ones are dropped
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+
+
+class Budget:
+    def __init__(self, burst: float, per_minute: float):
+        self.capacity = burst
+        self.rate = per_minute / 60
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0 and self.capacity > 0
+
+
+USER_BUDGET = Budget(RATE_LIMIT_USER_BURST, RATE_LIMIT_USER_PER_MINUTE)
+ADMIN_BUDGET = Budget(RATE_LIMIT_ADMIN_BURST, RATE_LIMIT_ADMIN_PER_MINUTE)
+GLOBAL_BUDGET = Budget(RATE_LIMIT_GLOBAL_BURST, RATE_LIMIT_GLOBAL_PER_MINUTE)
+
+# (bucket key, budget) pairs that one request has to fit into
+Buckets = List[Tuple[str, Budget]]
+
+
+def rate_limit(key: str):
+    """Mark a handler as limited by the `key` buckets of RateLimitMiddleware"""
+    def decorator(func):
+        setattr(func, 'rate_limit_key', key)
+        return func
+    return decorator
+
+
+def buckets_for(key: str, user_id: int, is_admin: bool = False) -> Buckets:
+    """The user's own bucket, sized by their tier, and the bucket shared by everyone"""
+    buckets = [
+        (f"{key}:user:{user_id}", ADMIN_BUDGET if is_admin else USER_BUDGET),
+        (f"{key}:global", GLOBAL_BUDGET),
+    ]
+    return [(name, budget) for name, budget in buckets if budget.enabled]
+
+
+class LocalRateLimiter:
+    """Token buckets kept in this process.
+
+    RedisRateLimiter in redis_store.py has the same interface and shares the
+    buckets between instances.
+    """
+
+    def __init__(self, max_buckets: int = RATE_LIMIT_MAX_BUCKETS):
+        self.max_buckets = max_buckets
+        # key -> (tokens, updated_at)
+        self._buckets: OrderedDict = OrderedDict()
+
+    async def acquire(self, buckets: Buckets, cost: float = 1) -> Tuple[Optional[str], float]:
+        """Take `cost` tokens from every bucket, or from none of them.
+
+        Returns (None, 0) if the request is allowed, otherwise the key of the
+        bucket that is short and the seconds until it has enough tokens.
+        """
+        now = time.monotonic()
+        levels = []
+        for key, budget in buckets:
+            tokens, updated_at = self._buckets.get(key, (budget.capacity, now))
+            tokens = min(budget.capacity, tokens + (now - updated_at) * budget.rate)
+            if tokens < cost:
+                return key, (cost - tokens) / budget.rate
+            levels.append(tokens)
+
+        for (key, _), tokens in zip(buckets, levels):
+            self._buckets[key] = (tokens - cost, now)
+            self._buckets.move_to_end(key)
+        # A dropped bucket only starts full again
+        while len(self._buckets) > self.max_buckets:
+            self._buckets.popitem(last=False)
+        return None, 0.0
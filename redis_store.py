@@ -0,0 +1,320 @@
+import os
+import json
+import hashlib
+import asyncio
+import logging
+import typing
+from datetime import date, datetime
+from typing import List, Optional, Tuple
+
+from aiogram.dispatcher.storage import BaseStorage
+from dotenv import load_dotenv
+from redis.asyncio import ConnectionPool, Redis
+
+from jobs import GenerationJob, QueueFullError, JOB_QUEUE_SIZE, JOB_OWNER_TTL
+from ratelimit import Buckets
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# redis://host:6379/0, or fakeredis:// for an in-process stand-in
+REDIS_URL = os.getenv("REDIS_URL", "")
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+REDIS_PREFIX = os.getenv("REDIS_PREFIX", "imagebot")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", "86400"))
+
+
+def create_redis(url: str = REDIS_URL) -> Redis:
+    if url.startswith("fakeredis://"):
+        import fakeredis
+        return fakeredis.FakeAsyncRedis(decode_responses=True)
+
+    pool = ConnectionPool.from_url(
+        url,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        decode_responses=True,
+        health_check_interval=30
+    )
+    return Redis(connection_pool=pool)
+
+
+def make_key(*parts) -> str:
+    return ':'.join((REDIS_PREFIX,) + tuple(map(str, parts)))
+
+
+class RedisStorage(BaseStorage):
+    """aiogram FSM storage on top of redis.asyncio.
+
+    aiogram's own RedisStorage2 needs the aioredis 1.x API, so this one is
+    written against the redis-py client. Every key expires after FSM_STATE_TTL
+    seconds of inactivity.
+    """
+
+    def __init__(self, redis: Redis, ttl: int = FSM_STATE_TTL):
+        self.redis = redis
+        self.ttl = ttl or None
+
+    def _key(self, chat, user, part: str) -> str:
+        return make_key('fsm', chat, user, part)
+
+    async def close(self):
+        await self.redis.close()
+
+    async def wait_closed(self):
+        return True
+
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        default: Optional[str] = None) -> Optional[str]:
+        chat, user = self.check_address(chat=chat, user=user)
+        return await self.redis.get(self._key(chat, user, 'state')) or self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       default: Optional[dict] = None) -> typing.Dict:
+        chat, user = self.check_address(chat=chat, user=user)
+        raw = await self.redis.get(self._key(chat, user, 'data'))
+        return json.loads(raw) if raw else (default or {})
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        state: Optional[typing.AnyStr] = None):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = self._key(chat, user, 'state')
+        if state is None:
+            await self.redis.delete(key)
+        else:
+            await self.redis.set(key, self.resolve_state(state), ex=self.ttl)
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = self._key(chat, user, 'data')
+        if data:
+            await self.redis.set(key, json.dumps(data), ex=self.ttl)
+        else:
+            await self.redis.delete(key)
+
+    async def update_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        if data is None:
+            data = {}
+        temp_data = await self.get_data(chat=chat, user=user, default={})
+        temp_data.update(data, **kwargs)
+        await self.set_data(chat=chat, user=user, data=temp_data)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                         default: Optional[dict] = None) -> typing.Dict:
+        chat, user = self.check_address(chat=chat, user=user)
+        raw = await self.redis.get(self._key(chat, user, 'bucket'))
+        return json.loads(raw) if raw else (default or {})
+
+    async def set_bucket(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        chat, user = self.check_address(chat=chat, user=user)
+        key = self._key(chat, user, 'bucket')
+        if bucket:
+            await self.redis.set(key, json.dumps(bucket), ex=self.ttl)
+        else:
+            await self.redis.delete(key)
+
+    async def update_bucket(self, *, chat: typing.Union[str, int, None] = None,
+                            user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        if bucket is None:
+            bucket = {}
+        temp_bucket = await self.get_bucket(chat=chat, user=user)
+        temp_bucket.update(bucket, **kwargs)
+        await self.set_bucket(chat=chat, user=user, bucket=temp_bucket)
+
+
+def _encode_value(value):
+    """json.dumps default that keeps users.created_at and last_image_on typed"""
+    if isinstance(value, datetime):
+        return {'$datetime': value.isoformat()}
+    if isinstance(value, date):
+        return {'$date': value.isoformat()}
+    raise TypeError(f"Cannot cache a {type(value).__name__}")
+
+
+def _decode_value(obj: dict):
+    if '$datetime' in obj:
+        return datetime.fromisoformat(obj['$datetime'])
+    if '$date' in obj:
+        return date.fromisoformat(obj['$date'])
+    return obj
+
+
+class RedisUserCache:
+    """User rows shared by all instances, so invalidations are seen everywhere.
+
+    Dates are stored tagged, so a cached row has the same types as one read
+    from the database.
+    """
+
+    def __init__(self, redis: Redis, ttl: int):
+        self.redis = redis
+        self.ttl = int(ttl)
+
+    async def get(self, telegram_id: int) -> Optional[dict]:
+        raw = await self.redis.get(make_key('user', telegram_id))
+        return json.loads(raw, object_hook=_decode_value) if raw else None
+
+    async def set(self, telegram_id: int, user):
+        await self.redis.set(make_key('user', telegram_id), json.dumps(dict(user), default=_encode_value), ex=self.ttl)
+
+    async def invalidate(self, telegram_id: int):
+        await self.redis.delete(make_key('user', telegram_id))
+
+
+# KEYS: queue list; ARGV: max size, job json. Returns the new length or -1 if full
+PUT_SCRIPT = """
+if redis.call('LLEN', KEYS[1]) >= tonumber(ARGV[1]) then
+    return -1
+end
+return redis.call('LPUSH', KEYS[1], ARGV[2])
+"""
+
+# KEYS: owner key; ARGV: followers key prefix, follower json.
+# Returns the owner job id, or nil if nothing with this prompt is in flight
+ATTACH_SCRIPT = """
+local owner = redis.call('GET', KEYS[1])
+if owner then
+    redis.call('RPUSH', ARGV[1] .. owner, ARGV[2])
+end
+return owner
+"""
+
+# KEYS: owner key, followers key; ARGV: job id. Returns the followers' json
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    redis.call('DEL', KEYS[1])
+end
+local followers = redis.call('LRANGE', KEYS[2], 0, -1)
+redis.call('DEL', KEYS[2])
+return followers
+"""
+
+
+class RedisJobBackend:
+    """Generation queue and in-flight bookkeeping shared by all bot instances"""
+
+    # Queued jobs stay in Redis when the instance that queued them stops
+    shared = True
+
+    def __init__(self, redis: Redis, max_size: int = JOB_QUEUE_SIZE):
+        self.redis = redis
+        self.max_size = max_size
+        self.queue_key = make_key('jobs', 'queue')
+        self._put = redis.register_script(PUT_SCRIPT)
+        self._attach = redis.register_script(ATTACH_SCRIPT)
+        self._release = redis.register_script(RELEASE_SCRIPT)
+
+    def _owner_key(self, job: GenerationJob) -> str:
+        digest = hashlib.sha1(json.dumps(job.cache_key).encode()).hexdigest()
+        return make_key('jobs', 'owner', digest)
+
+    def _followers_prefix(self) -> str:
+        return make_key('jobs', 'followers', '')
+
+    async def start(self):
+        pass
+
+    async def size(self) -> int:
+        return await self.redis.llen(self.queue_key)
+
+    async def is_full(self) -> bool:
+        return await self.size() >= self.max_size
+
+    async def put(self, job: GenerationJob) -> int:
+        position = await self._put(keys=[self.queue_key], args=[self.max_size, json.dumps(job.to_dict())])
+        if position < 0:
+            raise QueueFullError("Generation queue is full")
+        return position
+
+    async def put_wait(self, job: GenerationJob):
+        while True:
+            try:
+                return await self.put(job)
+            except QueueFullError:
+                await asyncio.sleep(1)
+
+    async def get(self) -> GenerationJob:
+        _, raw = await self.redis.brpop(self.queue_key)
+        return GenerationJob.from_dict(json.loads(raw))
+
+    def task_done(self):
+        pass
+
+    async def has_owner(self, job: GenerationJob) -> bool:
+        return bool(await self.redis.exists(self._owner_key(job)))
+
+    async def attach(self, job: GenerationJob) -> Optional[int]:
+        owner_id = await self._attach(
+            keys=[self._owner_key(job)],
+            args=[self._followers_prefix(), json.dumps(job.to_dict())]
+        )
+        return int(owner_id) if owner_id is not None else None
+
+    async def claim(self, job: GenerationJob):
+        await self.redis.set(self._owner_key(job), job.id, nx=True, ex=JOB_OWNER_TTL)
+
+    async def release(self, job: GenerationJob) -> List[GenerationJob]:
+        followers = await self._release(
+            keys=[self._owner_key(job), self._followers_prefix() + str(job.id)],
+            args=[job.id]
+        )
+        return [GenerationJob.from_dict(json.loads(raw)) for raw in followers]
+
+
+# KEYS: buckets; ARGV: capacity and rate per second of each bucket, then cost.
+# Uses the redis clock so all instances agree. Returns {0, '0'} if the tokens
+# were taken, otherwise {index of the short bucket, seconds to wait}
+TOKEN_BUCKET_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local cost = tonumber(ARGV[#ARGV])
+local levels = {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local state = redis.call('HMGET', key, 'tokens', 'updated_at')
+    local tokens = tonumber(state[1]) or capacity
+    local updated_at = tonumber(state[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated_at) * rate)
+    if tokens < cost then
+        return {i, tostring((cost - tokens) / rate)}
+    end
+    levels[i] = tokens
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[2 * i - 1])
+    local rate = tonumber(ARGV[2 * i])
+    local tokens = levels[i] - cost
+    redis.call('HSET', key, 'tokens', tostring(tokens), 'updated_at', tostring(now))
+    -- A bucket that would be full again can just as well not exist
+    redis.call('PEXPIRE', key, math.ceil((capacity - tokens) / rate * 1000) + 1000)
+end
+return {0, '0'}
+"""
+
+
+class RedisRateLimiter:
+    """Token buckets shared by all bot instances, checked and taken in one script"""
+
+    def __init__(self, redis: Redis):
+        self.redis = redis
+        self._acquire = redis.register_script(TOKEN_BUCKET_SCRIPT)
+
+    async def acquire(self, buckets: Buckets, cost: float = 1) -> Tuple[Optional[str], float]:
+        if not buckets:
+            return None, 0.0
+        args = []
+        for _, budget in buckets:
+            args.extend([budget.capacity, budget.rate])
+        args.append(cost)
+        index, retry_after = await self._acquire(keys=[make_key('ratelimit', key) for key, _ in buckets], args=args)
+        if int(index) == 0:
+            return None, 0.0
+        return buckets[int(index) - 1][0], float(retry_after)
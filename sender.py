@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import heapq
+import asyncio
+import logging
+import itertools
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+from aiogram import Bot
+from aiogram.utils.exceptions import RetryAfter
+from dotenv import load_dotenv
+
+from metrics import Histogram
+from logs import start_background_task
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Telegram allows about 30 messages per second overall, one per second in a
+# private chat and 20 per minute in a group
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "30"))
+TELEGRAM_GLOBAL_BURST = float(os.getenv("TELEGRAM_GLOBAL_BURST", "30"))
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = float(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", "0.33"))
+TELEGRAM_SEND_RETRIES = int(os.getenv("TELEGRAM_SEND_RETRIES", "3"))
+TELEGRAM_MAX_TRACKED_CHATS = int(os.getenv("TELEGRAM_MAX_TRACKED_CHATS", "100000"))
+
+# Waiting for a turn in the scheduler included
+TELEGRAM_REQUEST_SECONDS = Histogram('imagebot_telegram_request_seconds', "Telegram Bot API calls by method", ['method'])
+
+# Priority lanes, lower goes first
+INTERACTIVE = 0
+NORMAL = 1
+BULK = 2
+
+_priority: ContextVar[int] = ContextVar('send_priority', default=INTERACTIVE)
+
+# Methods that send or change messages and count towards the flood limits
+SCHEDULED_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendMediaGroup', 'sendAnimation', 'sendVideo',
+    'sendAudio', 'sendVoice', 'sendSticker', 'copyMessage', 'forwardMessage',
+    'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup',
+}
+EDIT_METHODS = {'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'}
+
+
+@contextmanager
+def send_priority(priority: int):
+    """Send everything in this block through the given lane"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class DebtBucket:
+    """Token bucket that hands out reservations instead of refusing.
+
+    reserve() takes the tokens even if the bucket goes negative and returns
+    how long the caller has to wait for them, so callers are served in order.
+    """
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def reserve(self, cost: float = 1) -> float:
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens -= cost
+        return max(0.0, -self.tokens / self.rate)
+
+    def pause(self, seconds: float):
+        """Nothing more is handed out for `seconds`"""
+        now = time.monotonic()
+        self._refill(now)
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def is_idle(self) -> bool:
+        self._refill(time.monotonic())
+        return self.tokens >= self.burst
+
+
+class PendingEdit:
+    def __init__(self, data: dict):
+        self.data = data
+        self.future = asyncio.get_running_loop().create_future()
+
+
+class OutboundScheduler:
+    """Paces outgoing Telegram messages to stay under the flood limits.
+
+    Every scheduled request first reserves its turn in its chat, then waits for
+    the global lane. The global lane serves INTERACTIVE before NORMAL before
+    BULK. A RetryAfter pauses the chat and the request is sent again. Edits
+    of a message that is still waiting are merged, so only the latest is sent.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, global_burst: float = TELEGRAM_GLOBAL_BURST,
+                 chat_rate: float = TELEGRAM_CHAT_RATE, chat_burst: float = TELEGRAM_CHAT_BURST,
+                 group_rate: float = TELEGRAM_GROUP_RATE, retries: int = TELEGRAM_SEND_RETRIES,
+                 max_chats: int = TELEGRAM_MAX_TRACKED_CHATS):
+        self.global_bucket = DebtBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.retries = retries
+        self.max_chats = max_chats
+        self._chats: OrderedDict = OrderedDict()
+        self._edits: Dict[tuple, PendingEdit] = {}
+        self._waiters: list = []
+        self._counter = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.sent = 0
+        self.merged_edits = 0
+        self.flood_waits = 0
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = start_background_task(self._dispatch())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for _, _, _, future in self._waiters:
+            future.cancel()
+        self._waiters.clear()
+
+    def _chat_bucket(self, chat_id) -> DebtBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Negative ids are groups and channels
+            is_group = isinstance(chat_id, int) and chat_id < 0 or str(chat_id).startswith('@')
+            bucket = self._chats[chat_id] = DebtBucket(
+                self.group_rate if is_group else self.chat_rate,
+                1 if is_group else self.chat_burst
+            )
+            # Dropping an idle bucket loses nothing, it would start full anyway
+            while len(self._chats) > self.max_chats:
+                oldest_id, oldest = next(iter(self._chats.items()))
+                if not oldest.is_idle():
+                    break
+                del self._chats[oldest_id]
+        self._chats.move_to_end(chat_id)
+        return bucket
+
+    async def _dispatch(self):
+        """Let waiters through the global lane at its rate, highest priority first"""
+        while True:
+            while not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            _, _, cost, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            delay = self.global_bucket.reserve(cost)
+            if delay:
+                await asyncio.sleep(delay)
+            if not future.done():
+                future.set_result(None)
+
+    async def _wait_turn(self, chat_id, priority: int, cost: float):
+        # Telegram counts a media group as one message in the chat, but every
+        # item towards the overall rate
+        if chat_id is not None:
+            delay = self._chat_bucket(chat_id).reserve(1)
+            if delay:
+                await asyncio.sleep(delay)
+
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), cost, future))
+        self._wakeup.set()
+        await future
+
+    async def send(self, method: str, data: dict, files: Optional[dict], request):
+        """Send `request(data, files)` when the limits allow it"""
+        chat_id = data.get('chat_id')
+        priority = _priority.get()
+
+        if method not in EDIT_METHODS or files:
+            return await self._send(method, chat_id, priority, self._cost(method, data), data, files, request)
+
+        key = (method, chat_id, data.get('message_id'), data.get('inline_message_id'))
+        pending = self._edits.get(key)
+        if pending is not None:
+            # Still waiting for its turn, so this edit replaces it
+            pending.data = data
+            self.merged_edits += 1
+            return await asyncio.shield(pending.future)
+
+        pending = self._edits[key] = PendingEdit(data)
+        try:
+            try:
+                await self._wait_turn(chat_id, priority, 1)
+            finally:
+                del self._edits[key]
+            result = await self._send(method, chat_id, priority, 0, pending.data, files, request)
+        except asyncio.CancelledError:
+            pending.future.cancel()
+            raise
+        except Exception as e:
+            if not pending.future.done():
+                pending.future.set_exception(e)
+                # Merged callers may not exist, do not warn about an unretrieved exception
+                pending.future.exception()
+            raise
+        pending.future.set_result(result)
+        return result
+
+    def _cost(self, method: str, data: dict) -> float:
+        if method == 'sendMediaGroup':
+            media = data.get('media')
+            try:
+                return len(json.loads(media) if isinstance(media, str) else media)
+            except (TypeError, ValueError):
+                return 1
+        return 1
+
+    async def _send(self, method: str, chat_id, priority: int, cost: float, data: dict, files, request):
+        """Send, waiting for a turn first unless `cost` is 0, and retry after flood waits"""
+        attempt = 0
+        while True:
+            if cost:
+                await self._wait_turn(chat_id, priority, cost)
+            try:
+                result = await request(data, files)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                self.flood_waits += 1
+                # Uploaded streams cannot be read a second time
+                if files or attempt >= self.retries:
+                    raise
+                logger.warning(f"Telegram flood wait of {e.timeout}s for {method} in chat {chat_id}")
+                if chat_id is not None:
+                    self._chat_bucket(chat_id).pause(e.timeout)
+                else:
+                    await asyncio.sleep(e.timeout)
+                attempt += 1
+                cost = cost or 1
+
+
+class ScheduledBot(Bot):
+    """Bot whose message sending goes through an OutboundScheduler.
+
+    Every send, reply and edit in the handlers passes through Bot.request, so
+    they are all paced without changing the call sites.
+    """
+
+    def __init__(self, *args, scheduler: Optional[OutboundScheduler] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler or OutboundScheduler()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        with TELEGRAM_REQUEST_SECONDS.time(method):
+            if method not in SCHEDULED_METHODS:
+                return await super().request(method, data, files, **kwargs)
+
+            async def request(data, files):
+                return await super(ScheduledBot, self).request(method, data, files, **kwargs)
+
+            return await self.scheduler.send(method, data or {}, files, request)
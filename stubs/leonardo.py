@@ -0,0 +1,186 @@
+"""Local stand-in for the Leonardo REST API.
+
+Point the bot at it with LEONARDO_API_URL=http://127.0.0.1:8090/api/rest/v1
+and run it with `python -m stubs.leonardo`. --latency, --failure-rate and
+--rate-limit-rate make the API calls slow, fail with 500 or answer 429.
+"""
+import time
+import uuid
+import random
+import base64
+import asyncio
+import argparse
+import logging
+from typing import Optional
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+API_PREFIX = "/api/rest/v1"
+STUB_USER_ID = "stub-user"
+
+# 1x1 transparent PNG
+PNG_PIXEL = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+class LeonardoStub:
+    def __init__(self, generation_time: float = 2.0, callback_url: Optional[str] = None,
+                 callback_secret: str = "", latency: float = 0.0, failure_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: int = 1):
+        self.generation_time = generation_time
+        self.callback_url = callback_url
+        self.callback_secret = callback_secret
+        # Seconds added to every API call, +-50%
+        self.latency = latency
+        # Shares of API calls answered with 500 and with 429
+        self.failure_rate = failure_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.generations = {}
+        self.requests = {}
+        self.base_url = None
+        self.runner: Optional[web.AppRunner] = None
+        self.session: Optional[aiohttp.ClientSession] = None
+
+    @web.middleware
+    async def disturb(self, request: web.Request, handler):
+        if not request.path.startswith(API_PREFIX):
+            return await handler(request)
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        roll = random.random()
+        if roll < self.rate_limit_rate:
+            self._count('429')
+            return web.json_response({'error': 'Too many requests'}, status=429,
+                                     headers={'Retry-After': str(self.retry_after)})
+        if roll < self.rate_limit_rate + self.failure_rate:
+            self._count('500')
+            return web.json_response({'error': 'Internal server error'}, status=500)
+        return await handler(request)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(middlewares=[self.disturb])
+        app.router.add_post(f"{API_PREFIX}/generations", self.create_generation)
+        app.router.add_get(f"{API_PREFIX}/generations/user/{{user_id}}", self.list_generations)
+        app.router.add_get(f"{API_PREFIX}/generations/{{generation_id}}", self.get_generation)
+        app.router.add_get(f"{API_PREFIX}/me", self.me)
+        app.router.add_get("/images/{generation_id}.png", self.image)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8090):
+        self.session = aiohttp.ClientSession()
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        logger.info(f"Leonardo stub listening on {self.base_url}{API_PREFIX}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+        if self.session:
+            await self.session.close()
+
+    def _count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _generation(self, generation_id: str) -> dict:
+        generation = self.generations[generation_id]
+        complete = time.monotonic() >= generation['ready_at']
+        return {
+            'id': generation_id,
+            'status': 'COMPLETE' if complete else 'PENDING',
+            'prompt': generation['prompt'],
+            'generated_images': [
+                {'id': f"{generation_id}-0", 'url': f"{self.base_url}/images/{generation_id}.png"}
+            ] if complete else []
+        }
+
+    async def create_generation(self, request: web.Request) -> web.Response:
+        self._count('create')
+        data = await request.json()
+        generation_id = str(uuid.uuid4())
+        self.generations[generation_id] = {
+            'prompt': data.get('prompt'),
+            'ready_at': time.monotonic() + self.generation_time
+        }
+        if self.callback_url:
+            asyncio.get_running_loop().call_later(
+                self.generation_time,
+                lambda: asyncio.ensure_future(self._send_callback(generation_id))
+            )
+        return web.json_response({'sdGenerationJob': {'generationId': generation_id, 'apiCreditCost': 1}})
+
+    async def get_generation(self, request: web.Request) -> web.Response:
+        self._count('get')
+        generation_id = request.match_info['generation_id']
+        if generation_id not in self.generations:
+            return web.json_response({'generations_by_pk': None})
+        return web.json_response({'generations_by_pk': self._generation(generation_id)})
+
+    async def list_generations(self, request: web.Request) -> web.Response:
+        self._count('list')
+        limit = int(request.query.get('limit', 10))
+        ids = list(self.generations)[-limit:]
+        return web.json_response({'generations': [self._generation(i) for i in reversed(ids)]})
+
+    async def me(self, request: web.Request) -> web.Response:
+        self._count('me')
+        return web.json_response({'user_details': [{'user': {'id': STUB_USER_ID, 'username': 'stub'}}]})
+
+    async def image(self, request: web.Request) -> web.Response:
+        self._count('image')
+        return web.Response(body=PNG_PIXEL, content_type='image/png')
+
+    async def _send_callback(self, generation_id: str):
+        generation = self._generation(generation_id)
+        payload = {
+            'type': 'image_generation.complete',
+            'object': 'generation',
+            'timestamp': int(time.time()),
+            'api_version': 'v1',
+            'data': {'object': {
+                'id': generation_id,
+                'status': generation['status'],
+                'images': generation['generated_images']
+            }}
+        }
+        headers = {'Authorization': f"Bearer {self.callback_secret}"} if self.callback_secret else {}
+        try:
+            async with self.session.post(self.callback_url, json=payload, headers=headers) as response:
+                self._count('callback')
+                if response.status != 200:
+                    logger.warning(f"Callback for {generation_id} returned {response.status}")
+        except aiohttp.ClientError as e:
+            logger.warning(f"Callback for {generation_id} failed: {str(e)}")
+
+
+async def main(args):
+    stub = LeonardoStub(args.generation_time, args.callback_url, args.callback_secret,
+                        args.latency, args.failure_rate, args.rate_limit_rate, args.retry_after)
+    await stub.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local Leonardo API stub")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--generation-time', type=float, default=2.0)
+    parser.add_argument('--callback-url')
+    parser.add_argument('--callback-secret', default='')
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--failure-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,58 @@
+"""POST recorded Telegram updates to a local webhook server.
+
+The file holds one Update object, a JSON list of them or one per line:
+
+    python -m stubs.replay_updates updates.json --url http://127.0.0.1:8080/telegram/webhook --secret s3cret
+"""
+import json
+import time
+import asyncio
+import argparse
+from typing import List
+
+import aiohttp
+
+from webhook import SECRET_HEADER
+
+
+def load_updates(path: str) -> List[dict]:
+    with open(path, encoding='utf-8') as f:
+        text = f.read().strip()
+    try:
+        data = json.loads(text)
+    except ValueError:
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    return data if isinstance(data, list) else [data]
+
+
+async def replay(updates: List[dict], url: str, secret: str = "", concurrency: int = 1) -> dict:
+    """POST every update and count the response statuses"""
+    statuses = {}
+    headers = {SECRET_HEADER: secret} if secret else {}
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def post(session: aiohttp.ClientSession, update: dict):
+        async with semaphore:
+            async with session.post(url, json=update, headers=headers) as response:
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    return statuses
+
+
+async def main(args):
+    updates = load_updates(args.file)
+    started = time.monotonic()
+    statuses = await replay(updates, args.url, args.secret, args.concurrency)
+    elapsed = time.monotonic() - started
+    print(f"Posted {len(updates)} updates in {elapsed:.2f}s, responses: {statuses}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Replay recorded Telegram updates against the webhook")
+    parser.add_argument('file')
+    parser.add_argument('--url', default='http://127.0.0.1:8080/telegram/webhook')
+    parser.add_argument('--secret', default='')
+    parser.add_argument('--concurrency', type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
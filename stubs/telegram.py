@@ -0,0 +1,135 @@
+"""Local stand-in for the Telegram Bot API.
+
+Answers the methods the bot calls with plausible results and counts them.
+Point the bot at it with TELEGRAM_API_URL=http://127.0.0.1:8091 and run it
+with `python -m stubs.telegram`.
+"""
+import json
+import time
+import random
+import asyncio
+import argparse
+import itertools
+import logging
+from typing import Optional
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'Stub', 'username': 'stub_bot'}
+
+SEND_METHODS = {
+    'sendMessage', 'sendPhoto', 'sendDocument', 'sendAnimation', 'sendVideo', 'sendAudio',
+    'sendVoice', 'sendSticker', 'copyMessage', 'forwardMessage',
+}
+EDIT_METHODS = {'editMessageText', 'editMessageCaption', 'editMessageMedia', 'editMessageReplyMarkup'}
+
+
+class TelegramStub:
+    def __init__(self, latency: float = 0.0, flood_rate: float = 0.0, retry_after: int = 1):
+        # Seconds added to every call, +-50%
+        self.latency = latency
+        # Share of sends answered with 429 and retry_after
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.requests = {}
+        self.base_url = None
+        self.runner: Optional[web.AppRunner] = None
+        self._message_ids = itertools.count(1)
+        self._file_ids = itertools.count(1)
+
+    def make_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post('/bot{token}/{method}', self.handle)
+        return app
+
+    async def start(self, host: str = "127.0.0.1", port: int = 8091):
+        self.runner = web.AppRunner(self.make_app())
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base_url = f"http://{host}:{port}"
+        logger.info(f"Telegram stub listening on {self.base_url}")
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def _count(self, name: str):
+        self.requests[name] = self.requests.get(name, 0) + 1
+
+    def _message(self, data, **fields) -> dict:
+        chat_id = int(data.get('chat_id') or 0)
+        message = {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': BOT_USER,
+        }
+        message.update(fields)
+        return message
+
+    def _photo(self) -> list:
+        file_id = f"stub-photo-{next(self._file_ids)}"
+        return [{'file_id': file_id, 'file_unique_id': file_id, 'width': 512, 'height': 512}]
+
+    def _result(self, method: str, data):
+        if method == 'getMe':
+            return BOT_USER
+        if method == 'sendPhoto':
+            return self._message(data, photo=self._photo(), caption=data.get('caption'))
+        if method == 'sendDocument':
+            file_id = f"stub-document-{next(self._file_ids)}"
+            return self._message(data, document={'file_id': file_id, 'file_unique_id': file_id})
+        if method == 'sendMediaGroup':
+            return [self._message(data, photo=self._photo()) for _ in json.loads(data.get('media') or '[]')]
+        if method in SEND_METHODS:
+            return self._message(data, text=data.get('text', ''))
+        if method in EDIT_METHODS:
+            if data.get('inline_message_id'):
+                return True
+            message = self._message(data, text=data.get('text', ''))
+            message['message_id'] = int(data.get('message_id') or 0)
+            return message
+        if method == 'getUpdates':
+            return []
+        return True
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self._count(method)
+        # aiogram posts form data, multipart when a file is uploaded
+        data = await request.post()
+        if self.latency:
+            await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if (method in SEND_METHODS or method in EDIT_METHODS) and random.random() < self.flood_rate:
+            self._count('429')
+            return web.json_response({
+                'ok': False,
+                'error_code': 429,
+                'description': f"Too Many Requests: retry after {self.retry_after}",
+                'parameters': {'retry_after': self.retry_after},
+            }, status=429)
+        return web.json_response({'ok': True, 'result': self._result(method, data)})
+
+
+async def main(args):
+    stub = TelegramStub(args.latency, args.flood_rate, args.retry_after)
+    await stub.start(args.host, args.port)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await stub.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Local Telegram Bot API stub")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8091)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--flood-rate', type=float, default=0.0)
+    parser.add_argument('--retry-after', type=int, default=1)
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(parser.parse_args()))
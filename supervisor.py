@@ -0,0 +1,402 @@
+"""Run the bot as several worker processes behind one update router.
+
+The supervisor receives updates by long polling, or through the webhook when
+WEBHOOK_URL is set, and hands each one to worker `user_id % SHARD_WORKERS`.
+Every worker imports bot.py in its own process, with its own database pool
+and Leonardo session, and handles one user's updates in order.
+
+    python supervisor.py
+"""
+import os
+import math
+import time
+import queue
+import signal
+import asyncio
+import logging
+import traceback
+import multiprocessing
+from typing import Dict, List, Optional
+
+import asyncpg
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from dotenv import load_dotenv
+
+from logs import setup_logging, LOG_FILE
+from migrations import migrate
+from metrics import Registry, CallbackMetric, MetricsServer, METRICS_ENABLED, METRICS_PORT
+from webhook import (
+    WebhookServer, set_webhook, wait_for_stop_signal, update_user_id,
+    WEBHOOK_URL, WEBHOOK_REGISTER, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_DRAIN_TIMEOUT,
+)
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", str(os.cpu_count() or 1)))
+# Updates waiting for each worker; the router stops reading when a queue is full
+SHARD_QUEUE_SIZE = int(os.getenv("SHARD_QUEUE_SIZE", "1000"))
+# Updates a worker handles at once, across different users
+SHARD_MAX_IN_FLIGHT = int(os.getenv("SHARD_MAX_IN_FLIGHT", "100"))
+SHARD_RESTART_DELAY = float(os.getenv("SHARD_RESTART_DELAY", "1"))
+SHARD_RESTART_MAX_DELAY = float(os.getenv("SHARD_RESTART_MAX_DELAY", "60"))
+SHARD_STATS_INTERVAL = float(os.getenv("SHARD_STATS_INTERVAL", "60"))
+POLLING_TIMEOUT = int(os.getenv("POLLING_TIMEOUT", "30"))
+
+# Workers import bot.py themselves; fork would copy the router's event loop and sessions
+context = multiprocessing.get_context('spawn')
+
+
+def shard_for(payload: dict, shards: int) -> int:
+    user_id = update_user_id(payload)
+    return (user_id if user_id is not None else payload.get('update_id', 0)) % shards
+
+
+def worker_env(index: int, shards: int) -> Dict[str, str]:
+    """Settings that are per process, scaled so the workers together keep the configured totals"""
+    from sender import TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST
+    from leonardo import LEONARDO_MAX_CONCURRENT_GENERATIONS
+    from ratelimit import RATE_LIMIT_GLOBAL_BURST, RATE_LIMIT_GLOBAL_PER_MINUTE
+    from redis_store import REDIS_URL
+    from jobs import JOB_OWNER_ID
+
+    env = {
+        'SHARD_INDEX': str(index),
+        'TELEGRAM_GLOBAL_RATE': str(TELEGRAM_GLOBAL_RATE / shards),
+        'TELEGRAM_GLOBAL_BURST': str(max(1.0, TELEGRAM_GLOBAL_BURST / shards)),
+        'LEONARDO_MAX_CONCURRENT_GENERATIONS': str(math.ceil(LEONARDO_MAX_CONCURRENT_GENERATIONS / shards)),
+        # Leonardo sends its callbacks to one port, the workers poll instead
+        'LEONARDO_CALLBACK_ENABLED': 'false',
+        # The supervisor serves its own metrics on METRICS_PORT
+        'METRICS_PORT': str(METRICS_PORT + 1 + index),
+        # The same for a restarted worker, which then takes back only the
+        # unfinished jobs of the worker it replaces
+        'JOB_OWNER_ID': f"{JOB_OWNER_ID}:shard{index}",
+    }
+    if LOG_FILE:
+        # Several processes cannot rotate one file
+        name, extension = os.path.splitext(LOG_FILE)
+        env['LOG_FILE'] = f"{name}-shard{index}{extension}"
+
+    if not REDIS_URL:
+        # Shared through Redis otherwise
+        env['RATE_LIMIT_GLOBAL_BURST'] = str(RATE_LIMIT_GLOBAL_BURST / shards)
+        env['RATE_LIMIT_GLOBAL_PER_MINUTE'] = str(RATE_LIMIT_GLOBAL_PER_MINUTE / shards)
+    return env
+
+
+def run_worker(index: int, updates, processed, env: Dict[str, str]):
+    """Process entry point; Ctrl+C and SIGTERM are left to the supervisor, which drains the queue"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    os.environ.update(env)
+    asyncio.run(worker_main(index, updates, processed))
+
+
+async def worker_main(index: int, updates, processed):
+    # Imported here so the settings from worker_env() are seen at import time
+    import bot
+
+    dp = bot.dp
+    Dispatcher.set_current(dp)
+    Bot.set_current(dp.bot)
+    await bot.on_startup(dp)
+    logger.info(f"Shard {index} started in process {os.getpid()}")
+
+    loop = asyncio.get_running_loop()
+    slots = asyncio.Semaphore(SHARD_MAX_IN_FLIGHT)
+    # Updates taken off the queue and not finished, waiting ones included;
+    # at most as many as the queue holds
+    in_hand = asyncio.Semaphore(SHARD_QUEUE_SIZE)
+    # Last task of each user, the next update of that user waits for it
+    chains: Dict[int, asyncio.Task] = {}
+
+    async def process(payload: dict, previous: Optional[asyncio.Task]):
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            # Taken only now, so updates waiting for their user's previous one hold no slot
+            async with slots:
+                await dp.process_update(types.Update(**payload))
+        except Exception as e:
+            logger.error(f"Error processing update {payload.get('update_id')} in shard {index}: "
+                         f"{str(e)}\n{traceback.format_exc()}")
+        finally:
+            in_hand.release()
+            with processed.get_lock():
+                processed[index] += 1
+
+    def forget(key, task):
+        if chains.get(key) is task:
+            del chains[key]
+
+    while True:
+        payload = await loop.run_in_executor(None, updates.get)
+        if payload is None:
+            break
+        await in_hand.acquire()
+        key = update_user_id(payload)
+        task = asyncio.create_task(process(payload, chains.get(key)))
+        chains[key] = task
+        task.add_done_callback(lambda task, key=key: forget(key, task))
+
+    if chains:
+        await asyncio.wait(list(chains.values()))
+    await bot.on_shutdown(dp)
+    await dp.storage.close()
+    await dp.storage.wait_closed()
+    await dp.bot.session.close()
+    logger.info(f"Shard {index} stopped")
+
+
+class Shard:
+    def __init__(self, index: int):
+        self.index = index
+        self.updates = context.Queue(SHARD_QUEUE_SIZE)
+        self.process: Optional[multiprocessing.Process] = None
+        self.started_at = 0.0
+        self.restarts = 0
+        self.restart_delay = SHARD_RESTART_DELAY
+        self.routed = 0
+
+
+class Supervisor:
+    """Starts the shard workers, routes updates to them and restarts the ones that die"""
+
+    def __init__(self, workers: int = SHARD_WORKERS):
+        self.shards = [Shard(index) for index in range(workers)]
+        # Updates each worker has finished, written by the workers
+        self.processed = context.Array('q', workers)
+        self.stopping = False
+        self._monitor_task: Optional[asyncio.Task] = None
+        self.registry = Registry()
+        self._register_metrics()
+
+    def _register_metrics(self):
+        def per_shard(value):
+            return lambda: {(str(shard.index),): value(shard) for shard in self.shards}
+
+        CallbackMetric('imagebot_shard_queue_depth', "Updates routed to the shard and not finished yet",
+                       per_shard(self.depth), labelnames=['shard'], registry=self.registry)
+        CallbackMetric('imagebot_shard_routed_total', "Updates routed to the shard",
+                       per_shard(lambda shard: shard.routed), type='counter', labelnames=['shard'],
+                       registry=self.registry)
+        CallbackMetric('imagebot_shard_restarts_total', "Times the shard worker was restarted",
+                       per_shard(lambda shard: shard.restarts), type='counter', labelnames=['shard'],
+                       registry=self.registry)
+        CallbackMetric('imagebot_shard_up', "1 while the shard worker process is alive",
+                       per_shard(lambda shard: int(bool(shard.process and shard.process.is_alive()))),
+                       labelnames=['shard'], registry=self.registry)
+
+    def _spawn(self, shard: Shard):
+        shard.process = context.Process(
+            target=run_worker,
+            args=(shard.index, shard.updates, self.processed, worker_env(shard.index, len(self.shards))),
+            name=f"shard-{shard.index}",
+            daemon=False
+        )
+        shard.process.start()
+        shard.started_at = time.monotonic()
+
+    def start(self):
+        for shard in self.shards:
+            self._spawn(shard)
+        self._monitor_task = asyncio.create_task(self._monitor())
+        logger.info(f"Started {len(self.shards)} shard workers")
+
+    def depth(self, shard: Shard) -> int:
+        """Updates routed to the shard and not finished yet"""
+        return shard.routed - self.processed[shard.index]
+
+    def stats(self) -> List[dict]:
+        return [{
+            'shard': shard.index,
+            'pid': shard.process.pid if shard.process else None,
+            'alive': bool(shard.process and shard.process.is_alive()),
+            'depth': self.depth(shard),
+            'routed': shard.routed,
+            'processed': self.processed[shard.index],
+            'restarts': shard.restarts,
+        } for shard in self.shards]
+
+    def route(self, payload: dict):
+        """Put the update on its shard's queue; raises queue.Full if the queue is full"""
+        shard = self.shards[shard_for(payload, len(self.shards))]
+        shard.updates.put_nowait(payload)
+        shard.routed += 1
+
+    async def route_wait(self, payload: dict):
+        """Route the update, waiting while its shard's queue is full"""
+        while True:
+            try:
+                return self.route(payload)
+            except queue.Full:
+                await asyncio.sleep(0.1)
+
+    def _replace_queue(self, shard: Shard):
+        """Give a restarted worker a new queue and move over what the old one still holds.
+
+        A worker killed inside Queue.get() keeps the queue's read lock forever,
+        so the old queue cannot be read by the next worker.
+        """
+        old = shard.updates
+        shard.updates = context.Queue(SHARD_QUEUE_SIZE)
+        try:
+            while True:
+                # A short wait lets the feeder thread flush what it still buffers
+                shard.updates.put_nowait(old.get(timeout=0.1))
+        except (queue.Empty, queue.Full):
+            pass
+        old.close()
+        old.cancel_join_thread()
+        # Whatever the dead worker had taken off the queue is lost
+        with self.processed.get_lock():
+            self.processed[shard.index] = shard.routed - shard.updates.qsize()
+
+    async def _monitor(self):
+        last_stats = time.monotonic()
+        while not self.stopping:
+            await asyncio.sleep(1)
+            for shard in self.shards:
+                if self.stopping or shard.process.is_alive():
+                    continue
+                logger.error(f"Shard {shard.index} exited with code {shard.process.exitcode}, "
+                             f"restarting in {shard.restart_delay:.0f}s")
+                # Back off while a worker keeps dying right after the start
+                uptime = time.monotonic() - shard.started_at
+                await asyncio.sleep(shard.restart_delay)
+                if uptime < SHARD_RESTART_MAX_DELAY:
+                    shard.restart_delay = min(shard.restart_delay * 2, SHARD_RESTART_MAX_DELAY)
+                else:
+                    shard.restart_delay = SHARD_RESTART_DELAY
+                if not self.stopping:
+                    self._replace_queue(shard)
+                    shard.restarts += 1
+                    self._spawn(shard)
+
+            if time.monotonic() - last_stats >= SHARD_STATS_INTERVAL:
+                last_stats = time.monotonic()
+                depths = ', '.join(f"{s['shard']}: {s['depth']}" for s in self.stats())
+                logger.info(f"Shard queue depths: {depths}")
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Let every worker finish its queue, killing the ones that take longer than `timeout`"""
+        self.stopping = True
+        if self._monitor_task:
+            self._monitor_task.cancel()
+            await asyncio.gather(self._monitor_task, return_exceptions=True)
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            # A worker stops at the None after the updates queued before it
+            while time.monotonic() < deadline:
+                try:
+                    shard.updates.put_nowait(None)
+                    break
+                except queue.Full:
+                    await asyncio.sleep(0.1)
+
+        loop = asyncio.get_running_loop()
+        for shard in self.shards:
+            await loop.run_in_executor(None, shard.process.join, max(0.0, deadline - time.monotonic()))
+            if shard.process.is_alive():
+                logger.warning(f"Shard {shard.index} did not stop in {timeout}s, killing it")
+                # The workers ignore SIGTERM
+                shard.process.kill()
+                shard.process.join()
+
+
+class ShardWebhookServer(WebhookServer):
+    """Webhook endpoint that hands updates to the shard workers instead of handling them"""
+
+    def __init__(self, supervisor: Supervisor, **kwargs):
+        super().__init__(None, **kwargs)
+        self.supervisor = supervisor
+
+    async def accept(self, payload: dict) -> web.Response:
+        try:
+            self.supervisor.route(payload)
+        except queue.Full:
+            self.rejected += 1
+            return web.Response(status=503)
+        self.received += 1
+        return web.json_response({'ok': True})
+
+
+async def poll_updates(bot: Bot, supervisor: Supervisor):
+    """Long poll getUpdates and route the raw updates; nothing is parsed beyond the user id"""
+    await bot.request('deleteWebhook', {})
+    offset = None
+    try:
+        while True:
+            try:
+                payload = {'timeout': POLLING_TIMEOUT}
+                if offset is not None:
+                    payload['offset'] = offset
+                updates = await bot.request('getUpdates', payload)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error getting updates: {str(e)}")
+                await asyncio.sleep(5)
+                continue
+
+            for update in updates:
+                await supervisor.route_wait(update)
+                offset = update['update_id'] + 1
+    finally:
+        if offset is not None:
+            # Confirm the routed updates so they are not delivered again after a restart
+            await bot.request('getUpdates', {'offset': offset, 'timeout': 0, 'limit': 1})
+
+
+async def migrate_database():
+    """Apply the migrations once, before the workers start and find nothing left to do.
+
+    Workers migrating at the same time would all wait on the migration lock
+    while one of them builds the indexes.
+    """
+    conn = await asyncpg.connect(os.getenv("DATABASE_URL"))
+    try:
+        applied = await migrate(conn)
+        if applied:
+            logger.info(f"Applied migrations {applied}")
+    finally:
+        await conn.close()
+
+
+async def main():
+    await migrate_database()
+    supervisor = Supervisor()
+    supervisor.start()
+    bot = Bot(token=os.getenv('TELEGRAM_TOKEN'))
+
+    metrics_server = MetricsServer(supervisor.registry)
+    if METRICS_ENABLED:
+        await metrics_server.start()
+
+    server = poller_task = None
+    try:
+        if WEBHOOK_URL:
+            server = ShardWebhookServer(supervisor)
+            await server.start(WEBHOOK_HOST, WEBHOOK_PORT)
+            if WEBHOOK_REGISTER:
+                await set_webhook(bot)
+        else:
+            poller_task = asyncio.create_task(poll_updates(bot, supervisor))
+        await wait_for_stop_signal()
+    finally:
+        if poller_task:
+            poller_task.cancel()
+            await asyncio.gather(poller_task, return_exceptions=True)
+        if server:
+            await server.stop()
+        await supervisor.stop()
+        await metrics_server.stop()
+        await bot.session.close()
+
+
+if __name__ == '__main__':
+    setup_logging()
+    asyncio.run(main())
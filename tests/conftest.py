@@ -0,0 +1,24 @@
+import os
+import sys
+
+# The modules live at the top of the repository and read their settings on import
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('TELEGRAM_TOKEN', '123456:test')
+os.environ.setdefault('ADMIN_ID', '1')
+os.environ.setdefault('LEONARDO_API_KEY', 'test')
+os.environ.setdefault('LOG_FILE', '')
+
+
+def message(update_id: int, user_id: int, text: str = 'hi') -> dict:
+    """A Telegram update carrying a private text message from the user"""
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': 0,
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Test'},
+            'text': text,
+        },
+    }
@@ -0,0 +1,23 @@
+import time
+
+from cache import TTLCache, prompt_key
+
+
+def test_entries_expire_and_least_recently_used_are_dropped(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, 'monotonic', lambda: now[0])
+    cache = TTLCache(max_size=2, ttl=10)
+
+    cache.set('a', 1)
+    cache.set('b', 2)
+    assert cache.get('a') == 1
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    now[0] += 11
+    assert cache.get('a') is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_prompts_differing_only_in_case_and_spaces_share_a_key():
+    assert prompt_key('  A cat\n on  mars ', 512, 512, 1) == prompt_key('a cat on mars', 512, 512, 1)
+    assert prompt_key('a cat', 512, 512, 1) != prompt_key('a cat', 768, 512, 1)
@@ -0,0 +1,39 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+
+from callbacks import CallbackServer, parse_callback
+
+
+def request(authorization: str = None):
+    headers = {'Authorization': authorization} if authorization is not None else {}
+    return make_mocked_request('POST', '/leonardo/callback', headers=headers)
+
+
+def test_callbacks_need_the_secret():
+    server = CallbackServer(secret='s3cret')
+
+    assert server._authorized(request('Bearer s3cret'))
+    assert server._authorized(request('s3cret'))
+    assert not server._authorized(request('Bearer wrong'))
+    assert not server._authorized(request())
+
+
+def test_without_a_secret_every_callback_is_refused():
+    server = CallbackServer(secret='')
+
+    assert not server._authorized(request())
+    assert not server._authorized(request('Bearer '))
+    with pytest.raises(ValueError):
+        asyncio.run(server.start(port=0))
+
+
+def test_parse_callback():
+    payload = {
+        'type': 'image_generation.complete',
+        'data': {'object': {'id': 'gen-1', 'images': [{'url': 'https://cdn.test/1.png'}]}},
+    }
+
+    assert parse_callback(payload) == ('gen-1', 'COMPLETE', 'https://cdn.test/1.png')
+    assert parse_callback({'data': {'object': {'id': 'gen-2'}}}) == ('gen-2', 'FAILED', None)
@@ -0,0 +1,307 @@
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import jobs
+from database import SHARED_QUEUE_OWNER
+from jobs import GenerationJob, JobQueue, JobStatus, JOB_OWNER_TTL
+from leonardo import GenerationGovernor, LeonardoError
+
+
+class FakeDatabase:
+    """The jobs table and job owner heartbeats of Database, kept in dicts"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.heartbeats = {}
+        self.clock = datetime(2024, 1, 1)
+
+    def now(self) -> datetime:
+        self.clock += timedelta(seconds=1)
+        return self.clock
+
+    async def add_job(self, telegram_id, chat_id, prompt, message_id=None, status_message_id=None, owner=None):
+        job_id = len(self.jobs) + 1
+        now = self.now()
+        self.jobs[job_id] = {
+            'id': job_id, 'telegram_id': telegram_id, 'chat_id': chat_id, 'prompt': prompt,
+            'message_id': message_id, 'status_message_id': status_message_id, 'generation_id': None,
+            'status': 'queued', 'error': None, 'created_at': now, 'updated_at': now, 'owner': owner,
+        }
+        return job_id
+
+    async def update_job(self, job_id, status, generation_id=None, error=None):
+        row = self.jobs[job_id]
+        row.update(status=status, updated_at=self.now())
+        row['generation_id'] = generation_id or row['generation_id']
+        row['error'] = error or row['error']
+
+    async def set_job_owner(self, job_id, owner):
+        self.jobs[job_id]['owner'] = owner
+
+    async def heartbeat_job_owner(self, owner):
+        self.heartbeats[owner] = self.now()
+        return self.heartbeats[owner]
+
+    async def remove_job_owner(self, owner):
+        self.heartbeats.pop(owner, None)
+
+    async def take_over_jobs(self, owner, new_owner, ttl, own_before=None, after_id=0, limit=100):
+        alive = {name for name, at in self.heartbeats.items() if at > self.clock - timedelta(seconds=ttl)}
+        rows = []
+        for row in sorted(self.jobs.values(), key=lambda row: row['id']):
+            if row['status'] in ('delivered', 'failed') or row['id'] <= after_id or row['owner'] == SHARED_QUEUE_OWNER:
+                continue
+            own = own_before is not None and row['owner'] == owner and row['updated_at'] < own_before
+            if row['owner'] is None or own or row['owner'] not in alive:
+                row['owner'] = new_owner
+                rows.append(dict(row, age=(self.clock - row['updated_at']).total_seconds()))
+            if len(rows) == limit:
+                break
+        return rows
+
+
+class FakeLeonardo:
+    def __init__(self):
+        self.submitted = []
+
+    async def create_generation(self, prompt, *args):
+        self.submitted.append(prompt)
+        return f'gen-{len(self.submitted)}'
+
+
+class FakePoller:
+    """Answers every generation with `result` once `ready` is set; an exception is raised"""
+
+    def __init__(self, result='https://cdn.test/1.png'):
+        self.result = result
+        self.ready = asyncio.Event()
+        self.ready.set()
+        self.waited = []
+
+    async def wait(self, generation_id, submitted_at=None):
+        self.waited.append((generation_id, submitted_at))
+        await self.ready.wait()
+        if isinstance(self.result, Exception):
+            raise self.result
+        return self.result
+
+
+class Callbacks:
+    def __init__(self):
+        self.delivered = []
+        self.shared = []
+        self.failed = []
+
+    async def deliver(self, job, image_url):
+        self.delivered.append((job.id, image_url))
+        return f'file-{job.id}'
+
+    async def share(self, job, file_id):
+        self.shared.append((job.id, file_id))
+
+    async def fail(self, job, failed_at):
+        self.failed.append((job.id, failed_at, job.error))
+
+
+@pytest.fixture
+def db(monkeypatch):
+    db = FakeDatabase()
+    monkeypatch.setattr(jobs, 'db', db)
+    return db
+
+
+@pytest.fixture
+def leonardo(monkeypatch):
+    leonardo = FakeLeonardo()
+    monkeypatch.setattr(jobs, 'leonardo', leonardo)
+    monkeypatch.setattr(jobs, 'generation_governor', GenerationGovernor(limit=10))
+    return leonardo
+
+
+@pytest.fixture
+def poller(monkeypatch):
+    poller = FakePoller()
+    monkeypatch.setattr(jobs, 'poller', poller)
+    return poller
+
+
+async def no_callback(*args):
+    pass
+
+
+def job_queue(callbacks: Callbacks = None, **kwargs) -> JobQueue:
+    if callbacks:
+        return JobQueue(deliver=callbacks.deliver, share=callbacks.share, fail=callbacks.fail, **kwargs)
+    return JobQueue(deliver=no_callback, share=no_callback, fail=no_callback, **kwargs)
+
+
+async def finish(queue: JobQueue):
+    await queue.backend.queue.join()
+    await queue.stop()
+
+
+async def queued_ids(queue: JobQueue) -> list:
+    return [(await queue.backend.get()).id for _ in range(await queue.depth())]
+
+
+def test_resume_takes_back_own_jobs_and_those_of_owners_without_heartbeats(db):
+    async def run():
+        db.heartbeats['dead'] = db.now() - timedelta(seconds=JOB_OWNER_TTL)
+        for owner in ('me', 'alive', 'dead', None, SHARED_QUEUE_OWNER):
+            await db.add_job(1, 1, f'a cat of {owner}', owner=owner)
+
+        queue = job_queue(workers=0, owner='me')
+        await queue.start()
+        await db.heartbeat_job_owner('alive')
+        await queue._resume_unfinished(own=True)
+        resumed = await queued_ids(queue)
+
+        # A job queued after the start is not mistaken for one of the previous run
+        await queue.enqueue(jobs.GenerationJob(user_id=2, chat_id=2, prompt='a dog'))
+        await queue.backend.get()
+        await queue._resume_unfinished(own=True)
+        again = await queued_ids(queue)
+        await queue.stop()
+        return resumed, again, {row['id']: row['owner'] for row in db.jobs.values()}, db.heartbeats
+
+    resumed, again, owners, heartbeats = asyncio.run(run())
+
+    assert resumed == [1, 3, 4]
+    assert again == []
+    assert owners == {1: 'me', 2: 'alive', 3: 'me', 4: 'me', 5: SHARED_QUEUE_OWNER, 6: 'me'}
+    # A stopped instance's jobs can be taken over right away
+    assert 'me' not in heartbeats
+
+
+def test_enqueued_job_is_generated_and_delivered(db, leonardo, poller):
+    callbacks = Callbacks()
+
+    async def run():
+        queue = job_queue(callbacks, workers=1, owner='me')
+        await queue.start()
+        position = await queue.enqueue(GenerationJob(user_id=1, chat_id=1, prompt='a cat'))
+        await finish(queue)
+        return position
+
+    assert asyncio.run(run()) == 1
+    assert leonardo.submitted == ['a cat']
+    # A new generation is polled as submitted now
+    assert poller.waited == [('gen-1', None)]
+    assert callbacks.delivered == [(1, 'https://cdn.test/1.png')]
+    assert db.jobs[1]['status'] == JobStatus.DELIVERED
+    assert db.jobs[1]['generation_id'] == 'gen-1'
+
+
+def test_failed_generation_is_marked_and_reported(db, leonardo, poller):
+    callbacks = Callbacks()
+    poller.result = LeonardoError("Generation failed")
+
+    async def run():
+        queue = job_queue(callbacks, workers=1, owner='me')
+        await queue.start()
+        await queue.enqueue(GenerationJob(user_id=1, chat_id=1, prompt='a cat'))
+        await finish(queue)
+
+    asyncio.run(run())
+
+    assert callbacks.delivered == []
+    assert callbacks.failed == [(1, JobStatus.POLLING, 'Generation failed')]
+    assert db.jobs[1]['status'] == JobStatus.FAILED
+    assert db.jobs[1]['error'] == 'Generation failed'
+
+
+def test_resumed_submitted_job_is_polled_without_a_new_generation(db, leonardo, poller):
+    callbacks = Callbacks()
+
+    async def run():
+        await db.add_job(1, 1, 'a queued cat')
+        await db.add_job(2, 2, 'a submitted dog')
+        await db.update_job(2, JobStatus.POLLING, generation_id='gen-old')
+        db.jobs[2]['updated_at'] -= timedelta(seconds=60)
+
+        queue = job_queue(callbacks, workers=1, owner='me')
+        await queue.start()
+        await queue._resume_unfinished(own=True)
+        await finish(queue)
+
+    asyncio.run(run())
+
+    assert leonardo.submitted == ['a queued cat']
+    waited = dict(poller.waited)
+    assert waited['gen-1'] is None
+    # Polled as submitted when the job was last updated, by the database clock
+    assert 59 < time.monotonic() - waited['gen-old'] < 63
+    assert sorted(callbacks.delivered) == [(1, 'https://cdn.test/1.png'), (2, 'https://cdn.test/1.png')]
+
+
+def test_identical_prompt_gets_the_image_of_the_job_in_flight(db, leonardo, poller):
+    callbacks = Callbacks()
+    poller.ready.clear()
+
+    async def run():
+        queue = job_queue(callbacks, workers=1, owner='me')
+        await queue.start()
+        first = await queue.enqueue(GenerationJob(user_id=1, chat_id=1, prompt='a cat'))
+        second = await queue.enqueue(GenerationJob(user_id=2, chat_id=2, prompt='A cat.'))
+        fresh = await queue.enqueue(GenerationJob(user_id=3, chat_id=3, prompt='a cat'), coalesce=False)
+        poller.ready.set()
+        await finish(queue)
+        return first, second, fresh
+
+    # 0 for a job attached to one in flight
+    assert asyncio.run(run()) == (1, 0, 2)
+    assert leonardo.submitted == ['a cat', 'a cat']
+    assert sorted(callbacks.delivered) == [(1, 'https://cdn.test/1.png'), (3, 'https://cdn.test/1.png')]
+    assert callbacks.shared == [(2, 'file-1')]
+    assert db.jobs[2]['status'] == JobStatus.DELIVERED
+
+
+def test_followers_fail_with_their_owner(db, leonardo, poller):
+    callbacks = Callbacks()
+    poller.ready.clear()
+    poller.result = LeonardoError("Generation failed")
+
+    async def run():
+        queue = job_queue(callbacks, workers=1, owner='me')
+        await queue.start()
+        await queue.enqueue(GenerationJob(user_id=1, chat_id=1, prompt='a cat'))
+        await queue.enqueue(GenerationJob(user_id=2, chat_id=2, prompt='a cat'))
+        poller.ready.set()
+        await finish(queue)
+        # Nothing is in flight for the prompt anymore
+        return await queue.backend.has_owner(GenerationJob(user_id=3, chat_id=3, prompt='a cat'))
+
+    assert asyncio.run(run()) is False
+    assert callbacks.shared == []
+    # The follower is told where its owner failed, it never had a status of its own
+    assert callbacks.failed == [(1, JobStatus.POLLING, 'Generation failed'), (2, JobStatus.POLLING, 'Generation failed')]
+    assert db.jobs[2]['status'] == JobStatus.FAILED
+
+
+def test_job_in_a_shared_queue_belongs_to_the_instance_that_runs_it(db, leonardo, poller):
+    import fakeredis
+    from redis_store import RedisJobBackend
+
+    owners = []
+
+    async def deliver(job, image_url):
+        owners.append(db.jobs[job.id]['owner'])
+        return 'file-1'
+
+    async def run():
+        backend = RedisJobBackend(fakeredis.FakeAsyncRedis(decode_responses=True))
+        queue = JobQueue(deliver=deliver, share=no_callback, fail=no_callback, workers=0, backend=backend, owner='me')
+        await queue.start()
+        await queue.enqueue(GenerationJob(user_id=1, chat_id=1, prompt='a cat'))
+        owners.append(db.jobs[1]['owner'])
+        queue._workers.append(asyncio.create_task(queue._worker(0)))
+        while db.jobs[1]['status'] != JobStatus.DELIVERED:
+            await asyncio.sleep(0.01)
+        await queue.stop()
+
+    asyncio.run(run())
+
+    assert owners == [SHARED_QUEUE_OWNER, 'me']
@@ -0,0 +1,109 @@
+import time
+import asyncio
+
+import pytest
+
+from leonardo import LeonardoClient, CircuitBreaker, CircuitOpenError
+
+
+class FakeResponse:
+    def __init__(self, status: int, headers: dict = None):
+        self.status = status
+        self.headers = headers or {}
+
+    def release(self):
+        pass
+
+
+class FakeSession:
+    """Answers each request with the next of `outcomes`, a status or an exception"""
+
+    def __init__(self, *outcomes):
+        self.outcomes = list(outcomes)
+        self.closed = False
+        self.calls = 0
+
+    async def request(self, method, url, headers=None, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, BaseException):
+            raise outcome
+        return FakeResponse(outcome, {'Retry-After': '0'})
+
+
+def half_open_client(*outcomes) -> LeonardoClient:
+    client = LeonardoClient()
+    client.session = FakeSession(*outcomes)
+    client.breaker = CircuitBreaker(threshold=1, reset_timeout=30)
+    client.breaker.record_failure()
+    client.breaker.opened_at = time.monotonic() - 31
+    assert client.breaker.state == 'half-open'
+    return client
+
+
+async def get(client: LeonardoClient) -> int:
+    async with client._request('GET', 'http://leonardo.test/me') as response:
+        return response.status
+
+
+def test_breaker_opens_after_threshold_and_lets_one_trial_through():
+    breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+    breaker.record_failure()
+    assert breaker.state == 'closed'
+    breaker.record_failure()
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.opened_at = time.monotonic() - 31
+    assert breaker.check() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+    breaker.record_success()
+    assert breaker.state == 'closed'
+    assert breaker.check() is False
+
+
+def test_trial_answered_with_429_does_not_leave_the_circuit_stuck():
+    client = half_open_client(429, 200)
+
+    assert asyncio.run(get(client)) == 200
+    assert client.breaker.state == 'closed'
+    assert client.session.calls == 2
+
+
+def test_trial_cut_short_releases_the_circuit():
+    client = half_open_client(asyncio.CancelledError())
+
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(get(client))
+    assert client.breaker.state == 'half-open'
+    assert client.breaker._trial is False
+
+    client.session.outcomes.append(200)
+    assert asyncio.run(get(client)) == 200
+    assert client.breaker.state == 'closed'
+
+
+def test_trial_failing_with_server_error_opens_the_circuit_again():
+    client = half_open_client(500)
+
+    with pytest.raises(CircuitOpenError):
+        asyncio.run(get(client))
+    assert client.breaker.state == 'open'
+    assert client.breaker._trial is False
+
+
+def test_post_is_not_retried_after_a_gateway_error():
+    async def post(client: LeonardoClient) -> int:
+        async with client._request('POST', 'http://leonardo.test/generations', json={}) as response:
+            return response.status
+
+    for status in (500, 502, 504):
+        client = LeonardoClient()
+        client.session = FakeSession(status)
+        assert asyncio.run(post(client)) == status
+        assert client.session.calls == 1
+
+    client = LeonardoClient()
+    client.session = FakeSession(503, 429, 200)
+    assert asyncio.run(post(client)) == 200
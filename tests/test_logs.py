@@ -0,0 +1,65 @@
+import json
+import asyncio
+import logging
+
+from logs import (
+    ContextQueueHandler, JsonFormatter, SamplingFilter, log_context, parse_settings,
+    set_log_context, _context,
+)
+from database import WriteBuffer
+from sender import OutboundScheduler
+
+
+def record(message: str, level: int = logging.INFO, name: str = 'jobs') -> logging.LogRecord:
+    return logging.LogRecord(name, level, __file__, 1, message, None, None)
+
+
+def test_records_carry_the_log_context():
+    handler = ContextQueueHandler(None, max_length=10)
+
+    with log_context(job_id=42, user_id=7):
+        prepared = handler.prepare(record('x' * 25))
+    entry = json.loads(JsonFormatter({'shard': 1}).format(prepared))
+
+    assert entry['job_id'] == 42 and entry['user_id'] == 7 and entry['shard'] == 1
+    assert entry['message'] == 'x' * 10 + '... [15 more characters]'
+    assert _context.get() == {}
+
+
+def test_errors_are_not_cut():
+    handler = ContextQueueHandler(None, max_length=10)
+
+    assert handler.prepare(record('y' * 25, logging.ERROR)).msg == 'y' * 25
+
+
+def test_sampling_keeps_warnings_and_unlisted_modules():
+    sampling = SamplingFilter({'poller': 0.0})
+
+    assert not sampling.filter(record('polled', name='poller.checks'))
+    assert sampling.filter(record('slow', logging.WARNING, name='poller'))
+    assert sampling.filter(record('sent', name='jobs'))
+    assert parse_settings('aiogram=WARNING, poller=0.1,bad') == {'aiogram': 'WARNING', 'poller': '0.1'}
+
+
+def test_background_tasks_do_not_inherit_the_handler_context():
+    async def run():
+        seen = []
+
+        async def write(rows):
+            seen.append(_context.get())
+            return rows
+
+        buffer = WriteBuffer('test', write, interval=0.01)
+        scheduler = OutboundScheduler(global_rate=1000, global_burst=100)
+
+        async def handler():
+            set_log_context(user_id=1)
+            await buffer.add('row')
+            await scheduler.send('sendMessage', {'chat_id': 1}, None, lambda data, files: asyncio.sleep(0))
+
+        await asyncio.create_task(handler())
+        await buffer.stop()
+        await scheduler.stop()
+        return seen
+
+    assert asyncio.run(run()) == [{}]
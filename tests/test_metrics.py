@@ -0,0 +1,73 @@
+import asyncio
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+from metrics import Registry, Counter, Histogram, CallbackMetric, MetricsServer
+
+
+def test_histogram_buckets_are_cumulative_with_sum_and_count():
+    registry = Registry()
+    histogram = Histogram('test_seconds', "Test durations", ['operation'], buckets=(0.1, 1), registry=registry)
+    for value in (0.05, 0.1, 0.5, 5):
+        histogram.observe(value, 'submit')
+
+    lines = asyncio.run(registry.render()).splitlines()
+
+    assert lines == [
+        '# HELP test_seconds Test durations',
+        '# TYPE test_seconds histogram',
+        # A value equal to a bound counts in that bucket
+        'test_seconds_bucket{operation="submit",le="0.1"} 2',
+        'test_seconds_bucket{operation="submit",le="1.0"} 3',
+        'test_seconds_bucket{operation="submit",le="+Inf"} 4',
+        'test_seconds_sum{operation="submit"} 5.65',
+        'test_seconds_count{operation="submit"} 4',
+    ]
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    counter = Counter('test_total', "Test counter", ['path'], registry=registry)
+    counter.inc('a "quoted"\\path\nnext', amount=2)
+
+    lines = asyncio.run(registry.render()).splitlines()
+
+    assert lines[-1] == 'test_total{path="a \\"quoted\\"\\\\path\\nnext"} 2.0'
+
+
+def test_failing_callback_metric_is_left_out():
+    registry = Registry()
+
+    def broken():
+        raise RuntimeError("gone")
+
+    async def pending():
+        return {('a',): 1, ('b',): 2}
+
+    CallbackMetric('test_broken', "Broken", broken, registry=registry)
+    CallbackMetric('test_pending', "Pending", pending, labelnames=['shard'], registry=registry)
+
+    text = asyncio.run(registry.render())
+
+    assert 'test_broken' not in text
+    assert 'test_pending{shard="a"} 1.0\ntest_pending{shard="b"} 2.0\n' in text
+
+
+def test_scrape_through_the_metrics_server():
+    registry = Registry()
+    Counter('test_requests_total', "Requests", registry=registry).inc()
+    server = MetricsServer(registry, path='/metrics')
+
+    async def run():
+        app = web.Application()
+        server.setup_routes(app)
+        async with TestClient(TestServer(app)) as client:
+            response = await client.get('/metrics')
+            return response.status, response.headers['Content-Type'], await response.text()
+
+    status, content_type, body = asyncio.run(run())
+
+    assert status == 200
+    assert content_type.startswith('text/plain; version=0.0.4')
+    assert body == '# HELP test_requests_total Requests\n# TYPE test_requests_total counter\ntest_requests_total 1.0\n'
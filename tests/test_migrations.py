@@ -0,0 +1,74 @@
+import asyncio
+
+from migrations import MIGRATIONS, migrate
+
+
+class FakeConnection:
+    """Records the statements and knows which indexes exist and whether they are valid"""
+
+    def __init__(self, applied=(), indexes=None):
+        self.applied = set(applied)
+        self.indexes = dict(indexes or {})
+        self.executed = []
+
+    async def execute(self, query, *args):
+        self.executed.append(' '.join(query.split()))
+        if query.startswith('INSERT INTO schema_migrations'):
+            self.applied.add(args[0])
+
+    async def fetch(self, query, *args):
+        if 'FROM schema_migrations' in query:
+            return [{'version': version} for version in self.applied]
+        return []
+
+    async def fetchval(self, query, *args):
+        if 'pg_try_advisory_lock' in query:
+            return True
+        if 'indisvalid' in query:
+            return self.indexes.get(args[0])
+        return None
+
+    def transaction(self):
+        return Transaction()
+
+
+class Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+
+def test_invalid_index_is_dropped_before_it_is_built_again():
+    conn = FakeConnection(applied=range(1, 4), indexes={'images_created_at_idx': False, 'users_username_idx': True})
+
+    applied = asyncio.run(migrate(conn, target=4))
+
+    assert applied == [4]
+    drop = 'DROP INDEX CONCURRENTLY IF EXISTS images_created_at_idx'
+    assert drop in conn.executed
+    build = next(i for i, q in enumerate(conn.executed) if 'IF NOT EXISTS images_created_at_idx' in q)
+    assert conn.executed.index(drop) < build
+    assert not any('DROP INDEX CONCURRENTLY IF EXISTS users_username_idx' in q for q in conn.executed)
+
+
+def test_applied_migrations_are_skipped():
+    conn = FakeConnection(applied=[migration.version for migration in MIGRATIONS])
+
+    assert asyncio.run(migrate(conn)) == []
+    assert not any(q.startswith('CREATE INDEX') for q in conn.executed)
+
+
+def test_not_null_is_set_through_a_validated_check():
+    conn = FakeConnection(applied=range(1, 8))
+
+    assert asyncio.run(migrate(conn, target=8)) == [8]
+    users = [q for q in conn.executed if q.startswith('ALTER TABLE users')]
+    assert users == [
+        'ALTER TABLE users DROP CONSTRAINT IF EXISTS users_created_at_not_null',
+        'ALTER TABLE users ADD CONSTRAINT users_created_at_not_null CHECK (created_at IS NOT NULL) NOT VALID',
+        'ALTER TABLE users VALIDATE CONSTRAINT users_created_at_not_null',
+        'ALTER TABLE users ALTER COLUMN created_at SET NOT NULL',
+        'ALTER TABLE users DROP CONSTRAINT users_created_at_not_null',
+    ]
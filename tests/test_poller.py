@@ -0,0 +1,100 @@
+import time
+import asyncio
+from datetime import datetime, timedelta
+
+from poller import GenerationPoller, POLL_MAX_INTERVAL, POLL_TIMEOUT
+from jobs import GenerationJob
+
+
+async def waiting(poller: GenerationPoller, generation_id: str, submitted_at: float = None) -> asyncio.Task:
+    task = asyncio.create_task(poller.wait(generation_id, submitted_at))
+    await asyncio.sleep(0)
+    return task
+
+
+def test_callback_resolves_the_waiter_and_updates_the_expected_duration():
+    async def run():
+        poller = GenerationPoller()
+        poller.expected_duration = 10
+        task = await waiting(poller, 'gen-1')
+        poller._pending['gen-1'].submitted_at -= 30
+        poller.complete('gen-1', 'COMPLETE', 'https://cdn.test/1.png')
+        return await task, poller.expected_duration, poller.pending_count
+
+    url, expected, pending = asyncio.run(run())
+
+    assert url == 'https://cdn.test/1.png'
+    assert 13.9 < expected < 14.1
+    assert pending == 0
+
+
+def test_resumed_and_hung_generations_do_not_push_out_the_first_poll():
+    async def run():
+        poller = GenerationPoller()
+        poller.expected_duration = 12
+        resumed = await waiting(poller, 'resumed', time.monotonic() - 3600)
+        poller.complete('resumed', 'COMPLETE', 'https://cdn.test/1.png')
+        await resumed
+        after_resumed = poller.expected_duration
+
+        hung = await waiting(poller, 'hung')
+        poller._pending['hung'].submitted_at -= 3600
+        poller.complete('hung', 'COMPLETE', 'https://cdn.test/2.png')
+        await hung
+        return after_resumed, poller.expected_duration, poller._first_delay()
+
+    after_resumed, after_hung, first_delay = asyncio.run(run())
+
+    assert after_resumed == 12
+    # The sample is clamped to POLL_TIMEOUT
+    assert after_hung <= 12 + 0.2 * (POLL_TIMEOUT - 12) + 0.1
+    assert first_delay <= POLL_MAX_INTERVAL
+
+
+def test_callback_before_wait_is_kept():
+    async def run():
+        poller = GenerationPoller()
+        poller.complete('gen-1', 'COMPLETE', 'https://cdn.test/1.png')
+        poller.complete('gen-2', 'FAILED')
+        return await poller.wait('gen-1'), await poller.wait('gen-2')
+
+    assert asyncio.run(run()) == ('https://cdn.test/1.png', None)
+
+
+def test_timeout_counts_from_the_submit():
+    async def run():
+        poller = GenerationPoller()
+        old = await waiting(poller, 'old', time.monotonic() - POLL_TIMEOUT - 1)
+        new = await waiting(poller, 'new')
+        poller._update(poller._pending['old'], {'status': 'PENDING'})
+        poller._update(poller._pending['new'], {'status': 'PENDING'})
+        result = await old
+        still_waiting = not new.done()
+        new.cancel()
+        return result, still_waiting
+
+    assert asyncio.run(run()) == (None, True)
+
+
+def test_resumed_job_keeps_its_submit_time():
+    submitted_at = datetime.now() - timedelta(seconds=120)
+    job = GenerationJob(user_id=1, chat_id=1, prompt='a cat', generation_id='gen-1', submitted_at=submitted_at)
+
+    restored = GenerationJob.from_dict(job.to_dict())
+
+    assert restored.submitted_at == submitted_at
+    assert 119 < time.monotonic() - restored.submitted_monotonic() < 121
+    assert GenerationJob(user_id=1, chat_id=1, prompt='a cat').submitted_monotonic() is None
+
+
+def test_resumed_job_is_dated_by_the_database_age():
+    record = {
+        'telegram_id': 1, 'chat_id': 1, 'prompt': 'a cat', 'message_id': None, 'status_message_id': None,
+        'status': 'polling', 'generation_id': 'gen-1', 'error': None, 'created_at': datetime(2000, 1, 1),
+        'id': 7, 'updated_at': datetime(2000, 1, 1), 'age': 90.0
+    }
+
+    job = GenerationJob.from_record(record)
+
+    assert 89 < time.monotonic() - job.submitted_monotonic() < 91
+    assert GenerationJob.from_record(dict(record, generation_id=None)).submitted_at is None
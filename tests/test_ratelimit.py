@@ -0,0 +1,67 @@
+import asyncio
+
+import fakeredis
+import pytest
+
+from ratelimit import Budget, LocalRateLimiter, buckets_for, USER_BUDGET, ADMIN_BUDGET
+from redis_store import RedisRateLimiter
+
+
+def limiters():
+    return [LocalRateLimiter(), RedisRateLimiter(fakeredis.FakeAsyncRedis(decode_responses=True))]
+
+
+@pytest.mark.parametrize('limiter', limiters(), ids=['local', 'redis'])
+def test_burst_then_wait_for_refill(limiter):
+    buckets = [('generate:user:1', Budget(burst=2, per_minute=60))]
+
+    async def run():
+        return [await limiter.acquire(buckets) for _ in range(3)]
+
+    first, second, third = asyncio.run(run())
+
+    assert first == (None, 0.0) and second == (None, 0.0)
+    key, retry_after = third
+    assert key == 'generate:user:1'
+    assert 0.9 < retry_after <= 1.0
+
+
+@pytest.mark.parametrize('limiter', limiters(), ids=['local', 'redis'])
+def test_tokens_are_taken_from_every_bucket_or_none(limiter):
+    user = ('generate:user:1', Budget(burst=5, per_minute=60))
+    other = ('generate:user:2', Budget(burst=5, per_minute=60))
+    shared = ('generate:global', Budget(burst=1, per_minute=1))
+
+    async def run():
+        allowed = await limiter.acquire([user, shared])
+        refused = await limiter.acquire([other, shared])
+        # The refusal did not take a token from user 2
+        user_two = [await limiter.acquire([other]) for _ in range(5)]
+        return allowed, refused, user_two
+
+    allowed, refused, user_two = asyncio.run(run())
+
+    assert allowed == (None, 0.0)
+    assert refused[0] == 'generate:global'
+    assert all(result == (None, 0.0) for result in user_two)
+
+
+def test_admins_get_the_larger_budget_and_everyone_shares_the_global_one():
+    assert buckets_for('generate', 7)[0] == ('generate:user:7', USER_BUDGET)
+    assert buckets_for('generate', 7, is_admin=True)[0] == ('generate:user:7', ADMIN_BUDGET)
+    assert buckets_for('generate', 7)[-1][0] == 'generate:global'
+    assert not Budget(burst=3, per_minute=0).enabled
+
+
+def test_local_limiter_drops_the_least_recently_used_buckets():
+    limiter = LocalRateLimiter(max_buckets=2)
+    budget = Budget(burst=1, per_minute=1)
+
+    async def run():
+        for user_id in range(3):
+            await limiter.acquire([(f"user:{user_id}", budget)])
+        # user:0 was dropped, so it starts full again
+        return await limiter.acquire([("user:0", budget)])
+
+    assert asyncio.run(run()) == (None, 0.0)
+    assert len(limiter._buckets) == 2
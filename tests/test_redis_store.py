@@ -0,0 +1,73 @@
+import asyncio
+from datetime import date, datetime
+
+import fakeredis
+import pytest
+
+from jobs import GenerationJob, QueueFullError
+from redis_store import RedisJobBackend, RedisStorage, RedisUserCache
+
+
+def job(job_id: int, prompt: str = 'a cat', user_id: int = 1) -> GenerationJob:
+    return GenerationJob(user_id=user_id, chat_id=user_id, prompt=prompt, id=job_id)
+
+
+def test_queue_is_bounded_and_first_in_first_out():
+    async def run():
+        backend = RedisJobBackend(fakeredis.FakeAsyncRedis(decode_responses=True), max_size=2)
+        positions = [await backend.put(job(1)), await backend.put(job(2))]
+        with pytest.raises(QueueFullError):
+            await backend.put(job(3))
+        first = await backend.get()
+        return positions, first.id, await backend.size()
+
+    assert asyncio.run(run()) == ([1, 2], 1, 1)
+
+
+def test_followers_of_an_in_flight_prompt_are_handed_to_its_owner():
+    async def run():
+        backend = RedisJobBackend(fakeredis.FakeAsyncRedis(decode_responses=True))
+        nobody = await backend.attach(job(2))
+        await backend.claim(job(1))
+        owner = await backend.attach(job(2, user_id=2))
+        other_prompt = await backend.attach(job(3, prompt='a dog'))
+        followers = await backend.release(job(1))
+        return nobody, owner, other_prompt, [(f.id, f.user_id) for f in followers], await backend.has_owner(job(1))
+
+    assert asyncio.run(run()) == (None, 1, None, [(2, 2)], False)
+
+
+def test_fsm_state_and_data_round_trip():
+    async def run():
+        redis = fakeredis.FakeAsyncRedis(decode_responses=True)
+        storage = RedisStorage(redis, ttl=60)
+        await storage.set_state(chat=1, user=1, state='GenerateImage:waiting_for_prompt')
+        await storage.update_data(chat=1, user=1, data={'page': 2})
+        state = await storage.get_state(chat=1, user=1)
+        data = await storage.get_data(chat=1, user=1)
+        await storage.reset_state(chat=1, user=1, with_data=True)
+        return state, data, await storage.get_state(chat=1, user=1), await storage.get_data(chat=1, user=1)
+
+    assert asyncio.run(run()) == ('GenerateImage:waiting_for_prompt', {'page': 2}, None, {})
+
+
+def test_user_cache_invalidation():
+    async def run():
+        cache = RedisUserCache(fakeredis.FakeAsyncRedis(decode_responses=True), ttl=60)
+        await cache.set(1, {'telegram_id': 1, 'is_admin': False})
+        cached = await cache.get(1)
+        await cache.invalidate(1)
+        return cached, await cache.get(1)
+
+    assert asyncio.run(run()) == ({'telegram_id': 1, 'is_admin': False}, None)
+
+
+def test_cached_users_keep_their_date_types():
+    user = {'telegram_id': 1, 'created_at': datetime(2024, 1, 2, 3, 4, 5, 6), 'last_image_on': date(2024, 1, 2)}
+
+    async def run():
+        cache = RedisUserCache(fakeredis.FakeAsyncRedis(decode_responses=True), ttl=60)
+        await cache.set(1, user)
+        return await cache.get(1)
+
+    assert asyncio.run(run()) == user
@@ -0,0 +1,88 @@
+import json
+import time
+import asyncio
+
+from sender import DebtBucket, OutboundScheduler, BULK, INTERACTIVE, send_priority
+
+
+class Recorder:
+    def __init__(self):
+        self.sent = []
+
+    def __call__(self, method: str):
+        async def request(data, files):
+            self.sent.append((method, dict(data)))
+            return {'method': method, 'text': data.get('text')}
+        return request
+
+
+def test_debt_bucket_hands_out_reservations_in_order():
+    bucket = DebtBucket(rate=10, burst=2)
+
+    assert bucket.reserve() == 0
+    assert bucket.reserve() == 0
+    assert 0.09 < bucket.reserve() <= 0.1
+    assert 0.19 < bucket.reserve() <= 0.2
+    assert not bucket.is_idle()
+
+
+def test_media_group_counts_as_one_message_in_the_chat():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=1000, global_burst=100, chat_rate=1, chat_burst=3)
+        media = json.dumps([{'type': 'photo', 'media': f"file-{i}"} for i in range(10)])
+        started = time.monotonic()
+        await scheduler.send('sendMediaGroup', {'chat_id': 5, 'media': media}, None, Recorder()('sendMediaGroup'))
+        elapsed = time.monotonic() - started
+        chat_tokens = scheduler._chat_bucket(5).tokens
+        global_tokens = scheduler.global_bucket.tokens
+        await scheduler.stop()
+        return elapsed, chat_tokens, global_tokens
+
+    elapsed, chat_tokens, global_tokens = asyncio.run(run())
+
+    assert elapsed < 0.5
+    assert 1.9 < chat_tokens <= 2.1
+    assert 89 < global_tokens <= 91
+
+
+def test_edits_waiting_for_their_turn_are_merged():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=1000, global_burst=100, chat_rate=20, chat_burst=1)
+        recorder = Recorder()
+        await scheduler.send('sendMessage', {'chat_id': 5, 'text': 'hi'}, None, recorder('sendMessage'))
+        edits = [
+            scheduler.send('editMessageText', {'chat_id': 5, 'message_id': 1, 'text': text}, None,
+                           recorder('editMessageText'))
+            for text in ('10%', '50%', '90%')
+        ]
+        results = await asyncio.gather(*edits)
+        await scheduler.stop()
+        return recorder.sent, results, scheduler.merged_edits
+
+    sent, results, merged = asyncio.run(run())
+
+    assert [data['text'] for _, data in sent] == ['hi', '90%']
+    assert all(result['text'] == '90%' for result in results)
+    assert merged == 2
+
+
+def test_interactive_sends_go_before_bulk():
+    async def run():
+        scheduler = OutboundScheduler(global_rate=20, global_burst=1, chat_rate=1000, chat_burst=1000)
+        recorder = Recorder()
+        # Uses the only token, the next sends have to queue for the global lane
+        await scheduler.send('sendMessage', {'chat_id': 1, 'text': 'first'}, None, recorder('sendMessage'))
+
+        async def send(chat_id, priority):
+            with send_priority(priority):
+                await scheduler.send('sendMessage', {'chat_id': chat_id, 'text': str(chat_id)}, None,
+                                     recorder('sendMessage'))
+
+        await asyncio.gather(*(send(chat_id, BULK) for chat_id in (2, 3)), send(4, INTERACTIVE))
+        await scheduler.stop()
+        return [data['text'] for _, data in recorder.sent]
+
+    order = asyncio.run(run())
+
+    assert order[0] == 'first'
+    assert order.index('4') < order.index('3')
@@ -0,0 +1,65 @@
+import queue
+
+import pytest
+
+from conftest import message
+from supervisor import Supervisor, shard_for, worker_env
+
+
+def test_a_user_always_lands_on_the_same_shard():
+    shards = {shard_for(message(update_id, 12345), 4) for update_id in range(20)}
+
+    assert shards == {12345 % 4}
+    assert {shard_for(message(1, user_id), 4) for user_id in range(8)} == {0, 1, 2, 3}
+    # Without a sender the update id spreads them
+    assert shard_for({'update_id': 7}, 4) == 3
+
+
+def test_worker_settings_split_the_totals_between_shards(monkeypatch):
+    monkeypatch.setattr('supervisor.LOG_FILE', 'bot.log')
+
+    first, second = worker_env(0, 2), worker_env(1, 2)
+
+    assert first['SHARD_INDEX'] == '0' and second['SHARD_INDEX'] == '1'
+    assert first['LEONARDO_CALLBACK_ENABLED'] == 'false'
+    assert first['METRICS_PORT'] != second['METRICS_PORT']
+    assert (first['LOG_FILE'], second['LOG_FILE']) == ('bot-shard0.log', 'bot-shard1.log')
+    # Each shard resumes the jobs it owns, restarted or not
+    assert first['JOB_OWNER_ID'] != second['JOB_OWNER_ID']
+    assert worker_env(1, 2)['JOB_OWNER_ID'] == second['JOB_OWNER_ID']
+    assert 'JOB_RESUME_ON_START' not in second
+
+
+@pytest.fixture
+def supervisor():
+    supervisor = Supervisor(workers=2)
+    yield supervisor
+    for shard in supervisor.shards:
+        shard.updates.close()
+        shard.updates.cancel_join_thread()
+
+
+def test_updates_are_routed_to_their_shard_queue(supervisor):
+    for update_id, user_id in enumerate([2, 3, 4]):
+        supervisor.route(message(update_id, user_id))
+
+    even, odd = supervisor.shards
+    assert [even.updates.get(timeout=1)['message']['from']['id'] for _ in range(2)] == [2, 4]
+    assert odd.updates.get(timeout=1)['message']['from']['id'] == 3
+    assert supervisor.depth(even) == 2 and supervisor.depth(odd) == 1
+
+
+def test_restarted_shard_gets_the_updates_left_in_its_old_queue(supervisor):
+    shard = supervisor.shards[0]
+    for update_id in range(3):
+        supervisor.route(message(update_id, 2))
+    # The dead worker had taken the first one
+    shard.updates.get(timeout=1)
+
+    supervisor._replace_queue(shard)
+
+    assert [shard.updates.get(timeout=1)['update_id'] for _ in range(2)] == [1, 2]
+    with pytest.raises(queue.Empty):
+        shard.updates.get(timeout=0.1)
+    # The lost update counts as finished, so the depth does not stay off by one
+    assert supervisor.depth(shard) == 2
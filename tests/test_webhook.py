@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+from aiohttp.test_utils import make_mocked_request
+from aiogram import Bot, Dispatcher
+
+from conftest import message
+from webhook import WebhookServer, update_user_id, SECRET_HEADER
+
+
+class RecordingDispatcher(Dispatcher):
+    """Takes longer for /generate than for the prompt that follows it"""
+
+    def __init__(self):
+        super().__init__(Bot(token='123456:test'))
+        self.events = []
+
+    async def process_update(self, update):
+        text = update.message.text
+        self.events.append(('start', update.message.from_user.id, text))
+        await asyncio.sleep(0.05 if text == '/generate' else 0)
+        self.events.append(('end', update.message.from_user.id, text))
+
+
+def test_update_user_id():
+    assert update_user_id(message(1, 42, 'hi')) == 42
+    assert update_user_id({'update_id': 1, 'callback_query': {'id': 'q', 'from': {'id': 7}}}) == 7
+    assert update_user_id({'update_id': 1}) is None
+
+
+def test_updates_of_one_user_are_handled_in_order():
+    async def run():
+        dispatcher = RecordingDispatcher()
+        server = WebhookServer(dispatcher, secret='', max_in_flight=10)
+        for payload in (message(1, 1, '/generate'), message(2, 1, 'a cat'), message(3, 2, '/start')):
+            response = await server.accept(payload)
+            assert response.status == 200
+        await server.stop(timeout=1)
+        return dispatcher.events
+
+    events = asyncio.run(run())
+
+    first_user = [event for event in events if event[1] == 1]
+    assert first_user == [('start', 1, '/generate'), ('end', 1, '/generate'), ('start', 1, 'a cat'), ('end', 1, 'a cat')]
+    # Another user is not held up by the first one
+    assert events.index(('end', 2, '/start')) < events.index(('end', 1, '/generate'))
+
+
+def test_slots_run_out_with_503():
+    async def run():
+        dispatcher = RecordingDispatcher()
+        server = WebhookServer(dispatcher, secret='', max_in_flight=1, slot_timeout=0.01)
+        first = await server.accept(message(1, 1, '/generate'))
+        second = await server.accept(message(2, 2, '/generate'))
+        await server.stop(timeout=1)
+        return first.status, second.status, server.rejected
+
+    assert asyncio.run(run()) == (200, 503, 1)
+
+
+def test_one_user_cannot_take_every_slot():
+    async def run():
+        dispatcher = RecordingDispatcher()
+        server = WebhookServer(dispatcher, secret='', max_in_flight=10, slot_timeout=0.01, max_user_queue=2)
+        burst = [(await server.accept(message(n, 1, '/generate'))).status for n in range(5)]
+        other = await server.accept(message(5, 2, '/start'))
+        await server.stop(timeout=1)
+        return burst, other.status, server._user_updates
+
+    burst, other, user_updates = asyncio.run(run())
+
+    # The one being handled and two waiting behind it
+    assert burst == [200, 200, 200, 503, 503]
+    assert other == 200
+    assert user_updates == {}
+
+
+def test_without_a_secret_every_update_is_refused():
+    server = WebhookServer(None, secret='')
+    forged = make_mocked_request('POST', '/telegram/webhook', headers={SECRET_HEADER: ''})
+
+    assert not server._authorized(forged)
+    assert not server._authorized(make_mocked_request('POST', '/telegram/webhook'))
+    with pytest.raises(ValueError):
+        asyncio.run(server.start(port=0))
+    assert WebhookServer(None, secret='s3cret')._authorized(
+        make_mocked_request('POST', '/telegram/webhook', headers={SECRET_HEADER: 's3cret'})
+    )
@@ -0,0 +1,118 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import asyncpg
+import pytest
+
+from database import Database, WriteBuffer
+
+
+class Writer:
+    """Stands in for a batched INSERT; rows named 'bad' are rejected like invalid data"""
+
+    def __init__(self, error: Exception = None):
+        self.error = error
+        self.calls = []
+
+    async def __call__(self, rows: list) -> list:
+        self.calls.append(list(rows))
+        if self.error:
+            raise self.error
+        if 'bad' in rows:
+            raise asyncpg.DataError("invalid input")
+        return [f"{row}-id" for row in rows]
+
+
+async def write_all(buffer: WriteBuffer, rows: list) -> list:
+    futures = [buffer.add(row) for row in rows]
+    await buffer.stop()
+    return await asyncio.gather(*futures, return_exceptions=True)
+
+
+def test_rows_are_written_in_batches():
+    writer = Writer()
+    buffer = WriteBuffer('test', writer, batch_size=3, interval=0.01)
+
+    results = asyncio.run(write_all(buffer, ['a', 'b', 'c', 'd']))
+
+    assert results == ['a-id', 'b-id', 'c-id', 'd-id']
+    assert writer.calls == [['a', 'b', 'c'], ['d']]
+
+
+def test_a_bad_row_only_fails_its_own_future():
+    writer = Writer()
+    buffer = WriteBuffer('test', writer, batch_size=8, interval=0.01)
+
+    results = asyncio.run(write_all(buffer, ['a', 'b', 'bad', 'c']))
+
+    assert results[:2] == ['a-id', 'b-id']
+    assert isinstance(results[2], asyncpg.DataError)
+    assert results[3] == 'c-id'
+
+
+@pytest.mark.parametrize('error', [
+    asyncio.TimeoutError(),
+    ConnectionRefusedError(),
+    asyncpg.InterfaceError("connection is closed"),
+])
+def test_an_unreachable_database_fails_the_batch_without_splitting(error):
+    writer = Writer(error)
+    buffer = WriteBuffer('test', writer, batch_size=500, interval=0.01)
+
+    results = asyncio.run(write_all(buffer, [str(i) for i in range(100)]))
+
+    assert len(writer.calls) == 1
+    assert all(result is error for result in results)
+
+
+def test_writes_after_stop_are_rejected():
+    async def run():
+        buffer = WriteBuffer('test', Writer(), interval=0.01)
+        await buffer.add('a')
+        await buffer.stop()
+        with pytest.raises(RuntimeError):
+            buffer.add('b')
+        assert buffer._task is None
+
+    asyncio.run(run())
+
+
+class FakeConnection:
+    """Commits every statement; add_user's upsert reports one new user"""
+
+    def transaction(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def fetchval(self, query, *args):
+        return 1
+
+    async def execute(self, query, *args):
+        pass
+
+
+class BrokenUserCache:
+    async def invalidate(self, telegram_id):
+        raise ConnectionError("Redis is down")
+
+
+def test_saved_users_are_reported_saved_when_the_cache_fails():
+    async def run():
+        database = Database()
+        database.user_cache = BrokenUserCache()
+
+        @asynccontextmanager
+        async def acquire(method):
+            yield FakeConnection()
+
+        database.acquire = acquire
+        saved = await asyncio.gather(database.add_user(1, 'alice'), database.add_user(2, 'bob'))
+        await database.user_writes.stop()
+        return saved
+
+    assert asyncio.run(run()) == [True, True]
@@ -0,0 +1,247 @@
+import os
+import hmac
+import signal
+import asyncio
+import logging
+import traceback
+from typing import Dict, Optional, Set
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher, types
+from dotenv import load_dotenv
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Public https URL Telegram posts updates to, e.g. https://bot.example.com/telegram/webhook.
+# The bot runs in webhook mode when it is set and falls back to long polling otherwise
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+# Sent back by Telegram in X-Telegram-Bot-Api-Secret-Token; 1-256 of A-Z, a-z, 0-9, _ and -
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+# Updates being handled at once; further requests wait for a free slot
+WEBHOOK_MAX_IN_FLIGHT = int(os.getenv("WEBHOOK_MAX_IN_FLIGHT", "100"))
+# How long a request waits for a slot before Telegram is told to deliver it again later
+WEBHOOK_SLOT_TIMEOUT = float(os.getenv("WEBHOOK_SLOT_TIMEOUT", "10"))
+# Updates of one user that may wait behind the one being handled, each holds a
+# slot; further ones get 503 so a single user cannot take every slot
+WEBHOOK_MAX_USER_QUEUE = int(os.getenv("WEBHOOK_MAX_USER_QUEUE", "5"))
+# Connections Telegram opens to the webhook at once, 1-100
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+# How long shutdown waits for the updates being handled
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "30"))
+# Only one instance has to register the webhook, the others can skip it
+WEBHOOK_REGISTER = os.getenv("WEBHOOK_REGISTER", "true").lower() in ('1', 'true', 'yes')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def update_user_id(payload: dict) -> Optional[int]:
+    """Id of the user who sent the update, or of the chat if there is no user"""
+    for value in payload.values():
+        if isinstance(value, dict):
+            sender = value.get('from') or value.get('user') or value.get('chat')
+            if sender and 'id' in sender:
+                return sender['id']
+    return None
+
+
+async def set_webhook(bot: Bot, url: str = WEBHOOK_URL, secret: str = WEBHOOK_SECRET,
+                      max_connections: int = WEBHOOK_MAX_CONNECTIONS) -> bool:
+    """Register the webhook with Telegram.
+
+    Bot.set_webhook in aiogram 2.14 does not know secret_token yet, so the
+    method is called directly. Pending updates are kept.
+    """
+    payload = {'url': url, 'max_connections': max_connections}
+    if secret:
+        payload['secret_token'] = secret
+    return await bot.request('setWebhook', payload)
+
+
+class WebhookServer:
+    """HTTP endpoint that feeds Telegram updates to the dispatcher.
+
+    Each update is answered as soon as it has one of `max_in_flight` slots and
+    is then handled in the background, after the previous update of the same
+    user, so a command and the reply to it do not race on the FSM state. At
+    most `max_user_queue` updates of a user wait like that, more get 503, so
+    a burst from one user cannot hold every slot.
+    While stopping, new updates get 503 so
+    Telegram delivers them again, to another replica behind the load balancer
+    or to this one after the restart, and the updates in hand are finished.
+    """
+
+    def __init__(self, dispatcher: Dispatcher, path: str = WEBHOOK_PATH, secret: str = WEBHOOK_SECRET,
+                 max_in_flight: int = WEBHOOK_MAX_IN_FLIGHT, slot_timeout: float = WEBHOOK_SLOT_TIMEOUT,
+                 max_user_queue: int = WEBHOOK_MAX_USER_QUEUE):
+        self.dispatcher = dispatcher
+        self.path = path
+        self.secret = secret
+        self.slot_timeout = slot_timeout
+        self.max_user_queue = max_user_queue
+        self.slots = asyncio.Semaphore(max_in_flight)
+        self.runner: Optional[web.AppRunner] = None
+        self.draining = False
+        self._tasks: Set[asyncio.Task] = set()
+        # Last task of each user, the next update of that user waits for it
+        self._chains: Dict[Optional[int], asyncio.Task] = {}
+        # Updates of each user in hand, running or waiting
+        self._user_updates: Dict[Optional[int], int] = {}
+        self.received = 0
+        self.rejected = 0
+        self.failed = 0
+
+    @property
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    def setup_routes(self, app: web.Application):
+        app.router.add_post(self.path, self.handle)
+        app.router.add_get('/healthz', self.health)
+
+    async def start(self, host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+        # Without it anyone who finds the URL could post forged updates, admin commands included
+        if not self.secret:
+            raise ValueError("WEBHOOK_SECRET is required for webhook mode")
+        app = web.Application()
+        self.setup_routes(app)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        logger.info(f"Telegram webhook server listening on {host}:{port}{self.path}")
+
+    async def stop(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        """Stop taking updates and wait up to `timeout` seconds for the ones in hand"""
+        self.draining = True
+        if self._tasks:
+            logger.info(f"Waiting for {len(self._tasks)} updates to finish")
+            _, pending = await asyncio.wait(set(self._tasks), timeout=timeout)
+            for task in pending:
+                task.cancel()
+            if pending:
+                logger.warning(f"Cancelled {len(pending)} updates still running after {timeout}s")
+                await asyncio.gather(*pending, return_exceptions=True)
+        if self.runner:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _authorized(self, request: web.Request) -> bool:
+        if not self.secret:
+            return False
+        return hmac.compare_digest(request.headers.get(SECRET_HEADER, ''), self.secret)
+
+    async def health(self, request: web.Request) -> web.Response:
+        # Lets the load balancer take a draining replica out of rotation
+        if self.draining:
+            return web.Response(status=503)
+        return web.json_response({'ok': True, 'in_flight': self.in_flight})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not self._authorized(request):
+            logger.warning(f"Rejected webhook request without a valid secret token from {request.remote}")
+            return web.Response(status=401)
+        if self.draining:
+            return web.Response(status=503)
+
+        try:
+            payload = await request.json()
+        except ValueError as e:
+            logger.error(f"Invalid webhook payload: {str(e)}")
+            return web.Response(status=400)
+        return await self.accept(payload)
+
+    async def accept(self, payload: dict) -> web.Response:
+        """Take the update in hand, or answer 503 so Telegram delivers it again later"""
+        try:
+            update = types.Update(**payload)
+        except Exception as e:
+            logger.error(f"Invalid webhook update: {str(e)}\n{traceback.format_exc()}")
+            return web.Response(status=400)
+
+        key = update_user_id(payload)
+        if self._user_updates.get(key, 0) > self.max_user_queue:
+            self.rejected += 1
+            logger.warning(f"Too many updates of user {key} in hand, asking Telegram to retry {update.update_id}")
+            return web.Response(status=503)
+
+        # Counted before waiting for the slot, so concurrent requests see it
+        self._user_updates[key] = self._user_updates.get(key, 0) + 1
+        try:
+            await asyncio.wait_for(self.slots.acquire(), self.slot_timeout)
+        except asyncio.TimeoutError:
+            self._release_user(key)
+            self.rejected += 1
+            logger.warning(f"No free slot for update {update.update_id}, asking Telegram to retry")
+            return web.Response(status=503)
+
+        self.received += 1
+        task = asyncio.create_task(self._process(update, self._chains.get(key)))
+        self._chains[key] = task
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        task.add_done_callback(lambda task: self._forget(key, task))
+        return web.json_response({'ok': True})
+
+    def _release_user(self, key: Optional[int]):
+        self._user_updates[key] -= 1
+        if not self._user_updates[key]:
+            del self._user_updates[key]
+
+    def _forget(self, key: Optional[int], task: asyncio.Task):
+        self._release_user(key)
+        if self._chains.get(key) is task:
+            del self._chains[key]
+
+    async def _process(self, update: types.Update, previous: Optional[asyncio.Task] = None):
+        Dispatcher.set_current(self.dispatcher)
+        Bot.set_current(self.dispatcher.bot)
+        try:
+            if previous:
+                await asyncio.wait([previous])
+            await self.dispatcher.process_update(update)
+        except Exception as e:
+            self.failed += 1
+            logger.error(f"Error processing update {update.update_id}: {str(e)}\n{traceback.format_exc()}")
+        finally:
+            self.slots.release()
+
+
+async def wait_for_stop_signal():
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+
+
+async def serve(dispatcher: Dispatcher, on_startup=None, on_shutdown=None,
+                host: str = WEBHOOK_HOST, port: int = WEBHOOK_PORT):
+    """Run the webhook server until SIGINT or SIGTERM, then drain and shut down"""
+    server = WebhookServer(dispatcher)
+    Dispatcher.set_current(dispatcher)
+    Bot.set_current(dispatcher.bot)
+    if on_startup:
+        await on_startup(dispatcher)
+
+    try:
+        await server.start(host, port)
+        if WEBHOOK_URL and WEBHOOK_REGISTER:
+            await set_webhook(dispatcher.bot)
+            logger.info(f"Webhook registered at {WEBHOOK_URL}")
+        await wait_for_stop_signal()
+    finally:
+        # The webhook stays registered, other replicas or the next start keep receiving
+        await server.stop()
+        if on_shutdown:
+            await on_shutdown(dispatcher)
+        await dispatcher.storage.close()
+        await dispatcher.storage.wait_closed()
+        await dispatcher.bot.session.close()
+
+
+def start_webhook(dispatcher: Dispatcher, on_startup=None, on_shutdown=None):
+    asyncio.run(serve(dispatcher, on_startup, on_shutdown))